@@ -0,0 +1,211 @@
+# -*- coding: UTF-8 -*-
+
+"""Command line interface of the Austin crime and permit pipelines.
+
+Each step of `austin_crime.py` and `austin_permits.py` can be run on its own:
+
+  python austin.py ingest              # refresh the columnar caches
+  python austin.py aggregate           # aggregate crimes onto the grid
+  python austin.py render crime        # shade the stored aggregates
+  python austin.py render permits      # animate permits over the years
+  python austin.py render tiles        # zoomable tile pyramids of crimes
+  python austin.py render temporal     # animate crimes over time
+  python austin.py legend crime        # SVG legends
+
+Only the standard library is imported at startup; NumPy, pandas, matplotlib,
+datashader and Dask are imported by the commands that use them, so that e.g.
+`--help` or `legend` don't pay for the imports of `render`.
+"""
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+import os
+import sys
+import argparse
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+# what each subcommand of `render` and `legend` draws
+render_targets = ( 'crime', 'permits', 'tiles', 'temporal' )
+legend_targets = ( 'crime', 'permits' )
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+def ingest( log, args ):
+
+  """Read the exports into their columnar caches, if they changed.
+  """
+
+  import austin_crime
+  import austin_permits
+  from austin_ingest import load_crime, load_crime_dask, load_permits
+
+  # without a choice, refresh both caches
+  both = not ( args.crime or args.permits )
+
+  if args.crime or both:
+    with log.stage( 'ingest crime' ) as stage:
+      if args.backend == 'dask':
+        df = load_crime_dask( austin_crime.input_csv )
+      else:
+        df = load_crime( austin_crime.input_csv )
+      stage['rows_out'] = austin_crime.n_rows( df )
+
+  if args.permits or both:
+    with log.stage( 'ingest permits' ) as stage:
+      stage['rows_out'] = len( load_permits( austin_permits.input_csv ) )
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+def aggregate( log, args ):
+
+  """Categorize and aggregate crimes, and save the aggregates.
+  """
+
+  import austin_crime
+
+  austin_crime.aggregate(
+    log,
+    refresh = args.refresh,
+    backend = args.backend,
+    index = not args.no_index )
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+def render( log, args ):
+
+  """Render maps and animations from the stored aggregates or the caches.
+  """
+
+  if args.target == 'permits':
+
+    import austin_permits
+
+    index = austin_permits.load_index( log )
+    austin_permits.animate( log, index )
+    austin_permits.first_and_last( log, index )
+
+    return
+
+  import austin_crime
+
+  if args.target in ( 'crime', 'tiles' ):
+
+    from austin_aggregates import aggregate_file, load_aggregates
+
+    if not os.path.exists( aggregate_file ):
+      sys.exit(
+        f'{aggregate_file} not found, run `{sys.argv[0]} aggregate` first' )
+
+    aggregates = load_aggregates( aggregate_file )
+
+  if args.target == 'crime':
+
+    austin_crime.render( log, aggregates )
+
+  elif args.target == 'tiles':
+
+    # tiles on disk are reused while the aggregated crimes don't change
+    austin_crime.tiles(
+      log,
+      fingerprint = str( aggregates['high_water'] ) )
+
+  else:
+
+    austin_crime.animate(
+      log,
+      bucket = args.bucket,
+      window = args.window,
+      step = args.step,
+      video_format = args.format )
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+def legend( log, args ):
+
+  """Generate the SVG legends, which only need matplotlib.
+  """
+
+  if args.target == 'permits':
+    import austin_permits
+    austin_permits.colorbar( log )
+  else:
+    import austin_crime
+    austin_crime.legend( log )
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+def parser( ):
+
+  """Return the parser of the command line.
+  """
+
+  main = argparse.ArgumentParser(
+    description = 'Map crimes and construction permits in Austin, Texas.' )
+  main.add_argument( '--profile', choices = [ 'cprofile', 'py-spy' ],
+    help = 'profile each step, see instrument.StageLog' )
+  main.add_argument( '--trace-memory', action = 'store_true',
+    help = 'trace Python allocations of each step, which slows them down' )
+
+  commands = main.add_subparsers( dest = 'command', required = True )
+
+  command = commands.add_parser( 'ingest',
+    help = 'read the exports into their columnar caches' )
+  command.add_argument( '--crime', action = 'store_true',
+    help = 'only the crime reports' )
+  command.add_argument( '--permits', action = 'store_true',
+    help = 'only the construction permits' )
+  command.add_argument( '--backend', choices = [ 'pandas', 'dask' ],
+    default = 'pandas', help = 'see austin_crime.backend' )
+  command.set_defaults( run = ingest )
+
+  command = commands.add_parser( 'aggregate',
+    help = 'categorize crimes and aggregate them onto the grid' )
+  command.add_argument( '--refresh', action = 'store_true',
+    help = 'only add crimes reported since the stored aggregates' )
+  command.add_argument( '--backend', choices = [ 'pandas', 'dask' ],
+    default = 'pandas', help = 'see austin_crime.backend' )
+  command.add_argument( '--no-index', action = 'store_true',
+    help = "don't update the spatial index, see austin_crime.spatial_index" )
+  command.set_defaults( run = aggregate )
+
+  command = commands.add_parser( 'render',
+    help = 'render maps and animations' )
+  command.add_argument( 'target', choices = render_targets )
+  command.add_argument( '--bucket', choices = [ 'month', 'week', 'hour' ],
+    default = 'month', help = 'time bucket of `render temporal`' )
+  command.add_argument( '--window', type = int, default = 12,
+    help = 'number of time buckets in each frame of `render temporal`' )
+  command.add_argument( '--step', type = int, default = 1,
+    help = 'number of time buckets between frames of `render temporal`' )
+  command.add_argument( '--format', default = 'gif',
+    help = 'animation format of `render temporal`' )
+  command.set_defaults( run = render )
+
+  command = commands.add_parser( 'legend',
+    help = 'generate the SVG legends' )
+  command.add_argument( 'target', choices = legend_targets )
+  command.set_defaults( run = legend )
+
+  return main
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+if __name__ == '__main__':
+
+  args = parser( ).parse_args( )
+
+  from instrument import StageLog
+
+  # record the time and memory used by each step of the command
+  log = StageLog(
+    f'austin_{args.command}',
+    trace_memory = args.trace_memory,
+    profiler = args.profile )
+
+  args.run( log, args )
+
+  log.save( )
+  print( log.report( ) )
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
@@ -0,0 +1,229 @@
+# -*- coding: UTF-8 -*-
+
+"""Persisted crime aggregates, refreshed incrementally from new reports.
+
+The store holds the pixel counts of all crimes and of each crime category,
+monthly counts per category, and a high-water mark: the largest incident number
+aggregated so far. A refresh only aggregates reports with a larger incident
+number and adds them into the stored arrays.
+"""
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+import os
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+# file the aggregates are stored in
+aggregate_file = 'crime_aggregates.npz'
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+def aggregate_crimes( grid, ndf, nndf, n_categories ):
+
+  """Aggregate crimes onto a pixel grid, overall, by category and by month.
+
+  Parameters
+  ----------
+  grid : austin_grid.PixelGrid
+    Pixel grid to aggregate onto.
+  ndf : pd.DataFrame or dask.dataframe.DataFrame
+    All crimes, with columns 'lon', 'lat' and 'incident'. Dask DataFrames are
+    aggregated partition by partition.
+  nndf : pd.DataFrame or dask.dataframe.DataFrame
+    Categorized crimes, with columns 'lon', 'lat', 'occurred' and categorical
+    'code' with known categories.
+  n_categories : int
+    Number of crime categories.
+
+  Returns
+  -------
+  aggregates : dict
+    'all' is the (lat, lon) count of all crimes, 'by_category' the (lat, lon,
+    code) count of categorized crimes, 'monthly' a DataFrame of the counts of
+    each category (columns) in each month (index, months since 1970) and
+    'high_water' the largest incident number aggregated, or -1 if none.
+
+  """
+
+  # count crimes by month and category at once, with a combined key
+  occurred = nndf['occurred'].dt
+  months = (
+    occurred.year.astype( np.int64 ) * 12 + occurred.month - 1 - 1970 * 12 )
+  keys = months * n_categories + nndf['code'].cat.codes.astype( np.int64 )
+
+  counts = _compute( keys.value_counts( ) )
+  keys = counts.index.to_numpy( dtype = np.int64 )
+
+  monthly = pd.Series(
+    counts.to_numpy( dtype = np.int64 ),
+    index = pd.MultiIndex.from_arrays(
+      [ keys // n_categories, keys % n_categories ] ) ).unstack(
+        fill_value = 0 ).reindex(
+          columns = range( n_categories ),
+          fill_value = 0 ).sort_index( )
+
+  high_water = _compute( ndf['incident'].max( ) )
+
+  return dict(
+    all = grid.as_aggregate( _pixel_counts( grid, ndf ) ),
+    by_category = grid.as_aggregate(
+      _pixel_counts( grid, nndf, n_categories ) ),
+    monthly = monthly.rename_axis( index = None, columns = None ),
+    high_water = -1 if pd.isna( high_water ) else int( high_water ) )
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+def _pixel_counts( grid, df, n_categories = None ):
+
+  """Return the pixel counts of crimes, by category if a number of categories
+  is given; Dask DataFrames are counted partition by partition.
+  """
+
+  if hasattr( df, 'to_delayed' ):
+
+    import dask
+
+    parts = [
+      dask.delayed( _pixel_counts )( grid, part, n_categories )
+      for part in df.to_delayed( ) ]
+
+    return dask.delayed( sum )( parts ).compute( )
+
+  if n_categories is None:
+    return grid.project( df['lon'], df['lat'] ).counts( )
+
+  return grid.project(
+    df['lon'],
+    df['lat'],
+    df['code'].cat.codes ).counts_by_code( n_categories )
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+def _compute( value ):
+
+  """Return the value of a lazy Dask result, or a pandas result as it is.
+  """
+
+  return value.compute( ) if hasattr( value, 'compute' ) else value
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+def merge_aggregates( old, new ):
+
+  """Add newly aggregated crimes into stored aggregates.
+
+  Parameters
+  ----------
+  old, new : dict
+    Aggregates on the same grid, as returned by `aggregate_crimes`.
+
+  Returns
+  -------
+  aggregates : dict
+    Sum of both aggregates, with the larger of both high-water marks.
+
+  """
+
+  return dict(
+    all = old['all'] + new['all'].values,
+    by_category = old['by_category'] + new['by_category'].values,
+    monthly = old['monthly'].add( new['monthly'], fill_value = 0 ).astype(
+      np.int64 ),
+    high_water = max( old['high_water'], new['high_water'] ) )
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+def matches_grid( aggregates, grid ):
+
+  """Return whether aggregates were computed on the given pixel grid.
+  """
+
+  x, y = grid.x_range, grid.y_range
+  agg = aggregates['all']
+
+  return (
+    agg.shape == grid.shape and
+    np.allclose( agg.attrs.get( 'x_range', ( ) ), x ) and
+    np.allclose( agg.attrs.get( 'y_range', ( ) ), y ) )
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+def save_aggregates( aggregates, grid, path = aggregate_file ):
+
+  """Atomically save aggregates to a compressed NumPy archive.
+
+  Parameters
+  ----------
+  aggregates : dict
+    Aggregates, as returned by `aggregate_crimes` or `merge_aggregates`.
+  grid : austin_grid.PixelGrid
+    Pixel grid the aggregates were computed on.
+  path : str
+    Name of the archive.
+
+  """
+
+  agg = aggregates['by_category']
+  monthly = aggregates['monthly']
+
+  # np.savez appends '.npz' to names without it, so keep the suffix
+  tmp_path = f'{path}.tmp.npz'
+  np.savez_compressed(
+    tmp_path,
+    all = aggregates['all'].values,
+    by_category = agg.values,
+    lon = agg.coords['lon'].values,
+    lat = agg.coords['lat'].values,
+    code = agg.coords['code'].values,
+    x_range = np.asarray( grid.x_range ),
+    y_range = np.asarray( grid.y_range ),
+    months = monthly.index.to_numpy( dtype = np.int64 ),
+    monthly = monthly.to_numpy( dtype = np.int64 ),
+    high_water = np.int64( aggregates['high_water'] ) )
+  os.replace( tmp_path, path )
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+def load_aggregates( path = aggregate_file ):
+
+  """Load aggregates saved by `save_aggregates`.
+
+  Parameters
+  ----------
+  path : str
+    Name of the archive.
+
+  Returns
+  -------
+  aggregates : dict
+    Aggregates, in the format returned by `aggregate_crimes`; the grid ranges
+    are kept in the attributes of the DataArrays.
+
+  """
+
+  with np.load( path ) as f:
+
+    attrs = dict(
+      x_range = tuple( f['x_range'] ),
+      y_range = tuple( f['y_range'] ) )
+
+    coords = [ ( 'lat', f['lat'] ), ( 'lon', f['lon'] ) ]
+
+    return dict(
+      all = xr.DataArray( f['all'], coords = coords, attrs = attrs ),
+      by_category = xr.DataArray(
+        f['by_category'],
+        coords = coords + [ ( 'code', f['code'] ) ],
+        attrs = attrs ),
+      monthly = pd.DataFrame(
+        f['monthly'],
+        index = f['months'],
+        columns = range( f['monthly'].shape[1] ) ),
+      high_water = int( f['high_water'] ) )
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
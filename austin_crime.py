@@ -3,19 +3,19 @@
 #++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
 
 import os
-from collections import Counter
+import re
+import fnmatch
+import warnings
 
 import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
-from matplotlib.colors import ListedColormap
-plt.style.use('trislee')
-from matplotlib.lines import Line2D
 
-import datashader as ds
-from datashader import transfer_functions as tf
+# pixel grid spanning the city of Austin, shared by all maps
+from austin_grid import PixelGrid
 
-import colorcet
+# matplotlib, datashader, colorcet and the modules built on them take seconds to
+# import, so they are imported by the steps that use them; this keeps quick
+# commands of `austin.py` fast
 
 #++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
 
@@ -23,6 +23,48 @@ import colorcet
 # https://data.austintexas.gov/Public-Safety/Crime-Reports/fdj4-gpfu
 input_csv = 'Crime_Reports.csv'
 
+# if True, and aggregates of an earlier run are stored in `aggregate_file`, only
+# crimes reported since that run are read and added into the stored aggregates.
+# Use this when `input_csv` is a newer export of the same data.
+refresh_aggregates = False
+
+# backend the crimes are loaded and aggregated with: 'pandas' loads them into
+# memory at once; 'dask' reads them as a partitioned Dask DataFrame, and
+# aggregates the partitions in parallel with bounded memory. Both give the same
+# results; steps 6. and 7. load all crimes in memory either way
+backend = 'pandas'
+
+# if True, index categorized crimes by location for area queries, see
+# `austin_spatial`; the index holds all categorized crimes in memory, so it is
+# not built with the Dask backend
+spatial_index = True
+
+# if True, also render zoomable XYZ tile pyramids of all crimes and of crimes
+# by category into `tile_dir`, for browsing with a slippy-map viewer
+render_tiles = False
+
+# if not None, also animate crimes by category over time, with timestamps
+# bucketed by 'month', 'week' or 'hour' of day; each frame shows a rolling
+# window of `temporal_window` buckets, moving by `temporal_step` buckets
+temporal_bucket = None
+temporal_window = 12
+temporal_step = 1
+temporal_format = 'gif'
+
+# matplotlib style of the SVG figures; the default style is used if it isn't
+# installed
+plot_style = 'trislee'
+
+# width of the maps in pixels; their height follows from the aspect ratio
+plot_width = 1000
+
+# whether to trace Python allocations of each step, which slows down the steps
+# several times, and the profiler run on each step, None, 'cprofile' or
+# 'py-spy'; time and resident memory of every run are saved in
+# `instrument.stats_dir` either way
+trace_memory = False
+profiler = None
+
 # categorizing crimes
 #------------------------------------------------------------------------------#
 
@@ -130,214 +172,627 @@ category_crimes['Misc'] = (
   'HARASSMENT',
   'DISTURBANCE - OTHER' )
 
-# latitude and longitude, and aspect ratio for city of Austin
-#------------------------------------------------------------------------------#
+# wildcard (or compiled regex) rules for offenses not listed above, so that new
+# spellings of an offense still end up in a category. Rules are tried in the
+# order of `category_codes`, the first match wins.
+category_patterns = dict()
+
+category_patterns['Assault'] = ( 'ASSAULT*', 'AGG *' )
+category_patterns['Auto'] = ( 'DWI*', )
+category_patterns['Burglary'] = ( 'BURGLARY*', )
+category_patterns['Domestic'] = ( 'FAMILY DISTURBANCE*', )
+category_patterns['Fraud'] = ( 'FORGERY*', 'CRED CARD ABUSE*' )
+category_patterns['Property'] = ( 'CRIMINAL MISCHIEF*', 'CRIMINAL TRESPASS*' )
+category_patterns['Theft'] = ( 'THEFT*', )
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+def compile_offense_rules(
+  category_codes,
+  category_crimes,
+  category_patterns = None ):
+
+  """Compile crime categories into rules mapping offenses onto category codes.
+
+  Parameters
+  ----------
+  category_codes : dict
+    Maps category names onto integer category codes.
+  category_crimes : dict
+    Maps category names onto tuples of offense descriptions.
+  category_patterns : dict or None
+    Maps category names onto tuples of wildcard patterns (e.g. 'THEFT*') or
+    compiled regular expressions, used for offenses not in `category_crimes`.
+
+  Returns
+  -------
+  rules : tuple
+    Tuple of (dict mapping offenses onto codes, list of (regex, code) tuples).
 
-x_range = x_lb, x_ub = -97.95, -97.5968
-y_range = y_lb, y_ub = 30.13, 30.51
+  """
 
-ratio = ((y_ub - y_lb) / (x_ub - x_lb))
+  exact = dict( )
+  for category, code in category_codes.items():
+    for crime in category_crimes.get( category, ( ) ):
+      exact[crime] = code
+
+  patterns = list( )
+  for category, code in category_codes.items():
+    for pattern in ( category_patterns or dict( ) ).get( category, ( ) ):
+      if isinstance( pattern, str ):
+        pattern = re.compile( fnmatch.translate( pattern ) )
+      patterns.append( ( pattern, code ) )
+
+  return exact, patterns
 
 #++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
 
-if __name__ == '__main__':
+def classify_offense( offense, rules ):
 
-  # 1. load in data, remove and rename extraneous columns
-  #----------------------------------------------------------------------------#
+  """Return the category code of a single offense, or -1 if uncategorized.
+  """
 
-  # read csv data
-  df = pd.read_csv( input_csv )
+  exact, patterns = rules
 
-  # we're only interested in these fields
-  ndf = df[[
-    'Highest Offense Description',
-    'Latitude',
-    'Longitude',
-    'Occurred Date Time']].copy()
+  code = exact.get( offense )
+  if code is not None:
+    return code
 
-  # ignore any entry containing None or nan
-  ndf = ndf.dropna()
+  for regex, code in patterns:
+    if regex.match( offense ):
+      return code
 
-  # rename columns
-  ndf = ndf.rename(
-    columns = {
-      'Highest Offense Description' : 'offense',
-      'Latitude' : 'lat',
-      'Longitude' : 'lon' })
+  return -1
 
-  # 2. generate dict that maps crimes onto category codes, apply to DataFrame
-  #----------------------------------------------------------------------------#
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
 
-  # create dict that maps crimes onto category codes
-  crime_codes = dict( )
-  for category, code in category_codes.items():
-    for crime in category_crimes[category]:
-      crime_codes[crime] = code
+def categorize_offenses( offenses, rules ):
 
-  # initialize empty DataFrame
-  nndf = pd.DataFrame()
+  """Map a column of offense descriptions onto category codes.
 
-  # copy latitude and longitude columns of full dataframe from step 1.
-  nndf['lon'] = ndf['lon']
-  nndf['lat'] = ndf['lat']
+  Each distinct offense is classified once, and the per-row codes are then
+  looked up with a single vectorized take, so the cost of classification
+  depends on the number of distinct offenses rather than the number of rows.
 
-  # create column of the crime category code for a given crime
-  nndf['code'] = ndf['offense'].apply(crime_codes.get).astype('category')
+  Parameters
+  ----------
+  offenses : pd.Series
+    Offense descriptions, ideally of categorical dtype.
+  rules : tuple
+    Rules returned by `compile_offense_rules`.
+
+  Returns
+  -------
+  codes : np.ndarray
+    Array of int8 category codes, -1 for uncategorized or missing offenses.
+
+  """
+
+  offenses = pd.Categorical( offenses )
+
+  # lookup table of the code of each distinct offense; the trailing -1 is
+  # picked up by the -1 codes pandas uses for missing values
+  lut = np.array(
+    [ classify_offense( offense, rules ) for offense in offenses.categories ]
+    + [ -1 ],
+    dtype = np.int8 )
+
+  return lut.take( offenses.codes )
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+def categorize_crimes( ndf, rules, n_categories ):
+
+  """Keep the categorized crimes of a DataFrame, with their category codes.
+
+  Parameters
+  ----------
+  ndf : pd.DataFrame
+    Crimes, as returned by `load_crime`, or one partition of them.
+  rules : tuple
+    Rules returned by `compile_offense_rules`.
+  n_categories : int
+    Number of crime categories.
+
+  Returns
+  -------
+  nndf : pd.DataFrame
+    Categorized crimes, with columns 'lon', 'lat', 'occurred' and 'code'. The
+    codes are categorical with categories 0 to `n_categories` - 1 whatever the
+    crimes, so partitions processed separately share the same categories.
+
+  """
+
+  # category code for each crime, -1 for uncategorized crimes
+  codes = categorize_offenses( ndf['offense'], rules )
 
   # remove rows containing uncategorized crimes
-  nndf = nndf.dropna()
+  categorized = codes >= 0
 
-  # 3. generate plot of all crimes
-  #----------------------------------------------------------------------------#
+  return pd.DataFrame( {
+    'lon' : ndf['lon'].values[categorized],
+    'lat' : ndf['lat'].values[categorized],
+    'occurred' : ndf['occurred'].values[categorized],
+    'code' : pd.Categorical.from_codes(
+      codes[categorized],
+      categories = np.arange( n_categories ) ) } )
 
-  plot_width = 1000
-  plot_height = int(ratio * plot_width)
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
 
-  # initialize datashader canvas
-  cvs = ds.Canvas(
-    plot_width = plot_width,
-    plot_height = plot_height,
-    x_range = x_range,
-    y_range = y_range)
+def n_rows( df ):
 
-  # aggregate data onto datashader canvas
-  agg = cvs.points(ndf, 'lon', 'lat',)
+  """Return the number of rows of a pandas DataFrame, or None for a Dask
+  DataFrame, whose length is only known after a pass over the data.
+  """
 
-  # rasterize and color canvas data using a transfer function based on
-  # equally-spaced histogram bins and the colorcet `fire` colormap
-  img = tf.shade(agg, cmap = colorcet.palette.fire, how='eq_hist')
+  return len( df ) if isinstance( df, pd.DataFrame ) else None
 
-  # export image
-  ds.utils.export_image(
-    img = img,
-    filename = 'datashader_all',
-    fmt = ".png",
-    background = 'black')
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
 
-  # 3.1 generate SVG of colorbar that can be formatted nicely using a vector
-  # graphics editing program like Inkscape
-  #............................................................................#
+def use_style( style = plot_style ):
 
-  # generate custom-labelled colormap based on
-  # https://matplotlib.org/3.1.1/gallery/ticks_and_spines/colorbar_tick_labelling_demo.html
+  """Use a matplotlib style, falling back to the default style if missing.
+  """
 
-  fig, ax = plt.subplots()
+  import matplotlib.pyplot as plt
 
-  data = np.clip(np.random.randn(250, 250), -1, 1)
+  try:
+    plt.style.use( style )
+  except OSError:
+    warnings.warn( f'matplotlib style {style!r} not found, using the default' )
 
-  cax = ax.imshow(
-    data,
-    interpolation = 'nearest',
-    cmap = ListedColormap( colorcet.fire ) )
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
 
-  # Add colorbar, make sure to specify tick locations to match desired ticklabels
-  cbar = fig.colorbar(cax, ticks=[-1, 1])
-  cbar.ax.set_yticklabels(['less\ncrime', 'more\ncrime'])
+def crime_grid( ):
 
-  # save SVG of colormap to file
-  plt.savefig('colorbar.svg')
-  plt.close()
+  """Return the pixel grid of the maps, spanning the Austin extent.
+  """
 
+  return PixelGrid( plot_width )
 
-  # 4. generate plot of crimes colored by category
-  #----------------------------------------------------------------------------#
-  # use the first 9 colors of the `Glasbey Light` colormap from the colorcet package
-  colors = colorcet.palette.glasbey_light[:9]
-
-  # initialize datashader canvas
-  cvs = ds.Canvas(
-    plot_width = plot_width,
-    plot_height = plot_height,
-    x_range = x_range,
-    y_range = y_range)
-
-  # aggregate data onto datashader canvas, crouping by the column 'code'
-  agg = cvs.points(nndf, 'lon', 'lat', ds.count_cat('code'))
-
-  # rasterize and color canvas data using a transfer function based on
-  # the list of colors we defined
-  img = tf.shade(
-    agg,
-    color_key = colors)
-
-  # export image
-  ds.utils.export_image(
-    img = img,
-    filename = 'datashader_by_category_black',
-    fmt = ".png",
-    background = 'black')
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
 
-  # 4.1 generate SVG of legend that can be formatted nicely using a vector
-  # graphics editing program like Inkscape
+def category_colors( ):
+
+  """Return the color of each crime category.
+  """
+
+  import colorcet
+
+  # use the first 9 colors of the `Glasbey Light` colormap from the colorcet
+  # package
+  return colorcet.palette.glasbey_light[:9]
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+def aggregate(
+  log,
+  refresh = refresh_aggregates,
+  backend = backend,
+  index = spatial_index ):
+
+  """Load, categorize, index and aggregate crimes; steps 1. to 3.
+
+  Parameters
+  ----------
+  log : StageLog
+    Records the time and memory used by each step.
+  refresh : bool
+    See `refresh_aggregates`.
+  backend : str
+    See `backend`.
+  index : bool
+    See `spatial_index`.
+
+  Returns
+  -------
+  aggregates : dict
+    Aggregates of all crimes, as saved in `aggregate_file`.
+  ndf : pd.DataFrame or None
+    All crimes, if they were loaded in memory, for steps 6. and 7.
+
+  """
+
+  from austin_ingest import load_crime, load_crime_since, load_crime_dask
+  from austin_aggregates import (
+    aggregate_file,
+    aggregate_crimes,
+    merge_aggregates,
+    matches_grid,
+    save_aggregates,
+    load_aggregates )
+  from austin_spatial import index_file, CrimeIndex
+
+  # 1. load in data, keeping only the columns we need
+  #----------------------------------------------------------------------------#
+  with log.stage( '1 load' ) as stage:
+
+    # initialize the pixel grid of the maps
+    grid = crime_grid( )
+
+    # aggregates of an earlier run, if they were computed on the same grid
+    stored = None
+    if refresh and os.path.exists( aggregate_file ):
+      stored = load_aggregates( aggregate_file )
+      if not matches_grid( stored, grid ):
+        stored = None
+
+    # read only the columns we're interested in, with compact dtypes and
+    # without entries containing None or nan, through a columnar cache; when
+    # refreshing stored aggregates, only read crimes reported since. The Dask
+    # backend reads the crimes lazily, one partition at a time
+    if backend == 'dask':
+      ndf = load_crime_dask( input_csv )
+      if stored is not None:
+        ndf = ndf[ndf['incident'] > stored['high_water']]
+    elif stored is None:
+      ndf = load_crime( input_csv )
+    else:
+      ndf = load_crime_since( input_csv, stored['high_water'] )
+
+    stage['rows_out'] = n_rows( ndf )
+
+  # 2. map crimes onto category codes, apply to DataFrame
+  #----------------------------------------------------------------------------#
+  with log.stage( '2 categorize', rows_in = n_rows( ndf ) ) as stage:
+
+    # compile category definitions into lookup rules
+    rules = compile_offense_rules(
+      category_codes,
+      category_crimes,
+      category_patterns )
+
+    # copy latitude and longitude columns of full dataframe from step 1., along
+    # with the category code of each crime, keeping only categorized crimes;
+    # with the Dask backend, each partition is categorized separately
+    if backend == 'dask':
+      nndf = ndf.map_partitions(
+        categorize_crimes,
+        rules,
+        len( category_codes ),
+        meta = categorize_crimes( ndf._meta, rules, len( category_codes ) ) )
+    else:
+      nndf = categorize_crimes( ndf, rules, len( category_codes ) )
+
+    stage['rows_out'] = n_rows( nndf )
+
+  # the index would load all categorized crimes in memory, which the Dask
+  # backend avoids
+  if index and backend == 'dask':
+    warnings.warn(
+      f'{index_file} is not updated with the Dask backend, aggregate with the '
+      f'pandas backend to update it' )
+    index = False
+
+  # 2.1 index categorized crimes by location, for bbox, radius and polygon
+  # queries with `austin_spatial.CrimeIndex.load`
   #............................................................................#
+  if index:
+    with log.stage( '2.1 spatial index', rows_in = n_rows( nndf ) ):
+
+      # when refreshing, add the new crimes to the stored index; an index that
+      # was never stored is built on the next full run
+      if stored is None:
+        CrimeIndex( nndf, len( category_codes ) ).save( index_file )
+      elif os.path.exists( index_file ):
+        CrimeIndex(
+          pd.concat(
+            [ CrimeIndex.load( index_file ).to_frame( ), nndf ],
+            ignore_index = True ),
+          len( category_codes ) ).save( index_file )
+
+  # 3. aggregate data onto the grid, and add it into the stored aggregates
+  #----------------------------------------------------------------------------#
+  with log.stage( '3 aggregate', rows_in = n_rows( ndf ) ):
 
-  legend_elements = list()
+    # project all crimes, and categorized crimes with their column 'code',
+    # onto the pixel grid once, and count them in each pixel; the 3-D
+    # aggregate by category is reused for the maps of steps 4. and 5.
+    aggregates = aggregate_crimes( grid, ndf, nndf, len( category_codes ) )
 
-  # generate custom legend based on
-  # https://matplotlib.org/3.1.1/gallery/text_labels_and_annotations/custom_legends.html
+    if stored is not None:
+      aggregates = merge_aggregates( stored, aggregates )
 
-  # loop over categories, create legend entry with category name, code, and color
-  for category, category_code in category_codes.items( ):
-    element = Line2D(
-      [0],
-      [0],
-      marker='o',
-      color='k',
-      label=category,
-      markerfacecolor=colorcet.palette.glasbey_light[category_code],
-      markersize=10)
+    save_aggregates( aggregates, grid, aggregate_file )
 
-    # append legend entry to list of legend entries
-    legend_elements.append( element )
+  # steps 6. and 7. need all crimes in memory; when refreshing, step 1. only
+  # loaded new crimes, and the Dask backend didn't load them in memory
+  if stored is None and backend == 'pandas':
+    return aggregates, ndf
 
-  # create arbitrary plot, we're only interested in the legend
-  fig, ax = plt.subplots()
-  legend = ax.legend(handles=legend_elements, loc='center')
+  return aggregates, None
 
-  # format the legend the way I want
-  legend.get_frame().set_linewidth(1)
-  legend.get_frame().set_facecolor('k')
-  plt.setp(legend.get_texts(), color='w')
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
 
-  # save SVG of legend to file
-  plt.savefig('legend.svg')
-  plt.close()
+def render( log, aggregates ):
 
-  # 5. Save plot of all crimes for each category in separate plots.
-  #----------------------------------------------------------------------------#
+  """Shade the aggregates of all crimes and of each category; steps 3.1, 4. and
+  5.
 
-  # create output directory if it doesn't exist
-  os.makedirs( 'datashader_by_category', exist_ok = True )
+  Parameters
+  ----------
+  log : StageLog
+    Records the time and memory used by each step.
+  aggregates : dict
+    Aggregates, as returned by `aggregate` or `load_aggregates`.
 
-  for code in range(9):
+  """
 
-    # initialize datashader canvas
-    cvs = ds.Canvas(
-      plot_width = plot_width,
-      plot_height = plot_height,
-      x_range = x_range,
-      y_range = y_range)
+  import datashader as ds
+  from datashader import transfer_functions as tf
+  import colorcet
 
-    # aggregate data onto datashader canvas, crouping by the column 'code'
-    agg = cvs.points(
-      nndf[nndf['code'] == code],
-      'lon',
-      'lat',
-      ds.count_cat('code'))
+  agg = aggregates['all']
+  cat_agg = aggregates['by_category']
+
+  colors = category_colors( )
+
+  # 3.1 generate plot of all crimes
+  #............................................................................#
+  with log.stage( '3.1 plot all crimes' ):
+
+    # rasterize and color canvas data using a transfer function based on
+    # equally-spaced histogram bins and the colorcet `fire` colormap
+    img = tf.shade(agg, cmap = colorcet.palette.fire, how='eq_hist')
+
+    # export image
+    ds.utils.export_image(
+      img = img,
+      filename = 'datashader_all',
+      fmt = ".png",
+      background = 'black')
+
+  # 4. generate plot of crimes colored by category
+  #----------------------------------------------------------------------------#
+  with log.stage( '4 plot by category' ):
 
     # rasterize and color canvas data using a transfer function based on
     # the list of colors we defined
     img = tf.shade(
-      agg,
+      cat_agg,
       color_key = colors)
 
     # export image
     ds.utils.export_image(
       img = img,
-      filename = f'datashader_by_category/code={code}',
+      filename = 'datashader_by_category_black',
       fmt = ".png",
       background = 'black')
 
+  # 5. Save plot of all crimes for each category in separate plots.
   #----------------------------------------------------------------------------#
+  with log.stage( '5 plot each category' ):
+
+    # create output directory if it doesn't exist
+    os.makedirs( 'datashader_by_category', exist_ok = True )
+
+    for code in range(9):
 
-#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
\ No newline at end of file
+      # rasterize and color the slice of the aggregate from step 3. belonging to
+      # the given category, using that category's color
+      img = tf.shade(
+        cat_agg.isel( code = [ code ] ),
+        color_key = [ colors[code] ] )
+
+      # export image
+      ds.utils.export_image(
+        img = img,
+        filename = f'datashader_by_category/code={code}',
+        fmt = ".png",
+        background = 'black')
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+def legend( log ):
+
+  """Generate the SVGs of the colorbar and of the category legend; steps 3.2
+  and 4.1.
+
+  Parameters
+  ----------
+  log : StageLog
+    Records the time and memory used by each step.
+
+  """
+
+  import matplotlib.pyplot as plt
+  from matplotlib.colors import ListedColormap
+  from matplotlib.lines import Line2D
+  import colorcet
+
+  use_style( )
+
+  # 3.2 generate SVG of colorbar that can be formatted nicely using a vector
+  # graphics editing program like Inkscape
+  #............................................................................#
+  with log.stage( '3.2 colorbar' ):
+
+    # generate custom-labelled colormap based on
+    # https://matplotlib.org/3.1.1/gallery/ticks_and_spines/colorbar_tick_labelling_demo.html
+
+    fig, ax = plt.subplots()
+
+    data = np.clip(np.random.randn(250, 250), -1, 1)
+
+    cax = ax.imshow(
+      data,
+      interpolation = 'nearest',
+      cmap = ListedColormap( colorcet.fire ) )
+
+    # Add colorbar, make sure to specify tick locations to match desired ticklabels
+    cbar = fig.colorbar(cax, ticks=[-1, 1])
+    cbar.ax.set_yticklabels(['less\ncrime', 'more\ncrime'])
+
+    # save SVG of colormap to file
+    plt.savefig('colorbar.svg')
+    plt.close()
+
+  # 4.1 generate SVG of legend that can be formatted nicely using a vector
+  # graphics editing program like Inkscape
+  #............................................................................#
+  with log.stage( '4.1 legend' ):
+
+    legend_elements = list()
+
+    # generate custom legend based on
+    # https://matplotlib.org/3.1.1/gallery/text_labels_and_annotations/custom_legends.html
+
+    # loop over categories, create legend entry with category name, code, and color
+    for category, category_code in category_codes.items( ):
+      element = Line2D(
+        [0],
+        [0],
+        marker='o',
+        color='k',
+        label=category,
+        markerfacecolor=colorcet.palette.glasbey_light[category_code],
+        markersize=10)
+
+      # append legend entry to list of legend entries
+      legend_elements.append( element )
+
+    # create arbitrary plot, we're only interested in the legend
+    fig, ax = plt.subplots()
+    legend = ax.legend(handles=legend_elements, loc='center')
+
+    # format the legend the way I want
+    legend.get_frame().set_linewidth(1)
+    legend.get_frame().set_facecolor('k')
+    plt.setp(legend.get_texts(), color='w')
+
+    # save SVG of legend to file
+    plt.savefig('legend.svg')
+    plt.close()
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+def _all_crimes( ndf ):
+
+  """Return all crimes and their category codes, loading them if needed.
+  """
+
+  from austin_ingest import load_crime
+
+  if ndf is None:
+    ndf = load_crime( input_csv )
+
+  rules = compile_offense_rules(
+    category_codes,
+    category_crimes,
+    category_patterns )
+
+  return ndf, categorize_offenses( ndf['offense'], rules )
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+def tiles( log, ndf = None, fingerprint = None ):
+
+  """Render zoomable tile pyramids of all crimes and of crimes by category;
+  step 6.
+
+  Parameters
+  ----------
+  log : StageLog
+    Records the time and memory used by each step.
+  ndf : pd.DataFrame or None
+    All crimes, as returned by `load_crime`. If None, they are loaded.
+  fingerprint : str or None
+    See `austin_tiles.render_pyramid`.
+
+  """
+
+  import colorcet
+  from austin_tiles import tile_dir, render_pyramid
+
+  # 6. generate zoomable tile pyramids of all crimes and of crimes by category
+  #----------------------------------------------------------------------------#
+  with log.stage( '6 tiles', rows_in = None if ndf is None else len( ndf ) ):
+
+    ndf, codes = _all_crimes( ndf )
+
+    render_pyramid(
+      ndf['lon'].values,
+      ndf['lat'].values,
+      codes,
+      cmap = colorcet.palette.fire,
+      colors = category_colors( ),
+      out_dir = tile_dir,
+      fingerprint = fingerprint )
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+def animate(
+  log,
+  ndf = None,
+  bucket = temporal_bucket,
+  window = temporal_window,
+  step = temporal_step,
+  video_format = temporal_format ):
+
+  """Animate crimes by category over time; step 7.
+
+  Parameters
+  ----------
+  log : StageLog
+    Records the time and memory used by each step.
+  ndf : pd.DataFrame or None
+    All crimes, as returned by `load_crime`. If None, they are loaded.
+  bucket, window, step, video_format
+    See `temporal_bucket`, `temporal_window`, `temporal_step` and
+    `temporal_format`.
+
+  """
+
+  from austin_temporal import CrimeCube, write_cube_animation
+
+  # 7. animate crimes by category over time
+  #----------------------------------------------------------------------------#
+  with log.stage( '7 temporal', rows_in = None if ndf is None else len( ndf ) ):
+
+    ndf, codes = _all_crimes( ndf )
+
+    # count crimes by time bucket, category and pixel once; every frame is
+    # then summed from a slice of this cube
+    cube = CrimeCube(
+      crime_grid( ),
+      ndf['lon'].values,
+      ndf['lat'].values,
+      ndf['occurred'].values,
+      codes,
+      len( category_codes ),
+      bucket )
+
+    write_cube_animation(
+      cube,
+      f'datashader_by_{bucket}.{video_format}',
+      category_colors( ),
+      window = window,
+      step = step )
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+if __name__ == '__main__':
+
+  from instrument import StageLog
+
+  # record the time and memory used by each numbered step
+  log = StageLog(
+    'austin_crime',
+    trace_memory = trace_memory,
+    profiler = profiler )
+
+  aggregates, ndf = aggregate( log )
+
+  render( log, aggregates )
+  legend( log )
+
+  if render_tiles:
+    tiles( log, ndf, fingerprint = str( aggregates['high_water'] ) )
+
+  if temporal_bucket is not None:
+    animate( log, ndf )
+
+  log.save( )
+  print( log.report( ) )
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
@@ -0,0 +1,327 @@
+# -*- coding: UTF-8 -*-
+
+"""Pixel grid of the Austin maps, and points projected onto it.
+
+Longitudes and latitudes are projected once onto the pixels of a grid spanning
+the Austin extent, and kept as uint16 pixel columns and rows, with an optional
+uint8 code per point, e.g. a crime category, in separate arrays: 4 or 5 bytes
+per point, rather than 16 for float64 coordinates. Maps and frames are then
+counted from the flat pixel index of the points with `np.bincount`.
+"""
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+import numpy as np
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+# latitude and longitude, and aspect ratio for city of Austin
+x_range = x_lb, x_ub = -97.95, -97.5968
+y_range = y_lb, y_ub = 30.13, 30.51
+
+ratio = ((y_ub - y_lb) / (x_ub - x_lb))
+
+# largest width and height of a grid, so that pixel coordinates fit in uint16
+max_size = np.iinfo( np.uint16 ).max + 1
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+class PixelGrid:
+
+  """Grid of pixels spanning a range of longitudes and latitudes.
+
+  Attributes are named as those of a `datashader.Canvas`, and points are
+  binned as datashader bins them, including points on the upper edges, so the
+  counts on a grid equal the aggregates of datashader on a canvas of the same
+  size and extent. Rows are numbered from the southern edge.
+
+  Parameters
+  ----------
+  plot_width : int
+    Width of the grid in pixels.
+  plot_height : int or None
+    Height of the grid in pixels. If None, the width times the aspect ratio of
+    the extent.
+  x_range, y_range : tuple of float
+    Longitudes and latitudes spanned by the grid.
+
+  """
+
+  def __init__(
+    self,
+    plot_width,
+    plot_height = None,
+    x_range = x_range,
+    y_range = y_range ):
+
+    if plot_height is None:
+      plot_height = int( np.ptp( y_range ) / np.ptp( x_range ) * plot_width )
+
+    if not ( 0 < plot_width <= max_size and 0 < plot_height <= max_size ):
+      raise ValueError(
+        f'grid of {plot_width} x {plot_height} pixels, expected at most '
+        f'{max_size} x {max_size}' )
+
+    self.plot_width = int( plot_width )
+    self.plot_height = int( plot_height )
+    self.x_range = tuple( x_range )
+    self.y_range = tuple( y_range )
+
+  @property
+  def shape( self ):
+    return ( self.plot_height, self.plot_width )
+
+  @property
+  def size( self ):
+    return self.plot_height * self.plot_width
+
+  def _project( self, lons, lats ):
+
+    """Return the float pixel columns and rows of points, and which points are
+    inside of the grid.
+    """
+
+    width, height = self.plot_width, self.plot_height
+    ( x0, x1 ), ( y0, y1 ) = self.x_range, self.y_range
+
+    lons = np.asarray( lons, dtype = np.float64 )
+    lats = np.asarray( lats, dtype = np.float64 )
+
+    inside = ( lons >= x0 ) & ( lons <= x1 ) & ( lats >= y0 ) & ( lats <= y1 )
+
+    # points on the upper edges belong to the last row or column
+    px = np.minimum( ( lons - x0 ) * ( width / ( x1 - x0 ) ), width - 1 )
+    py = np.minimum( ( lats - y0 ) * ( height / ( y1 - y0 ) ), height - 1 )
+
+    return px, py, inside
+
+  def contains( self, lons, lats ):
+
+    """Return which points are inside of the grid.
+    """
+
+    return self._project( lons, lats )[2]
+
+  def pixels( self, lons, lats ):
+
+    """Return the flat pixel index of points.
+
+    Parameters
+    ----------
+    lons, lats : array_like
+      Longitudes and latitudes of points.
+
+    Returns
+    -------
+    pixels : np.ndarray
+      int64 index of the pixel of each point, row by row from the southern
+      edge, or -1 for points outside of the grid.
+
+    """
+
+    px, py, inside = self._project( lons, lats )
+
+    pixels = np.full( len( px ), -1, dtype = np.int64 )
+    pixels[inside] = (
+      py[inside].astype( np.int64 ) * self.plot_width +
+      px[inside].astype( np.int64 ) )
+
+    return pixels
+
+  def project( self, lons, lats, codes = None ):
+
+    """Project points onto the grid, dropping those outside of it.
+
+    Parameters
+    ----------
+    lons, lats : array_like
+      Longitudes and latitudes of points.
+    codes : array_like or None
+      Code of each point, between 0 and 255.
+
+    Returns
+    -------
+    points : PixelPoints
+      Points inside of the grid, in their original order.
+
+    """
+
+    px, py, inside = self._project( lons, lats )
+
+    if codes is not None:
+      codes = np.asarray( codes )[inside].astype( np.uint8 )
+
+    return PixelPoints(
+      self,
+      px[inside].astype( np.uint16 ),
+      py[inside].astype( np.uint16 ),
+      codes )
+
+  def as_aggregate( self, counts ):
+
+    """Wrap counts on the grid as a datashader aggregate.
+
+    Parameters
+    ----------
+    counts : np.ndarray
+      (height, width) counts, or (code, height, width) counts by code.
+
+    Returns
+    -------
+    agg : xr.DataArray
+      (lat, lon) or (lat, lon, code) uint32 counts, with the coordinates of
+      the pixel centers, as returned by `datashader.Canvas.points`.
+
+    """
+
+    import xarray as xr
+
+    height, width = self.shape
+    ( x0, x1 ), ( y0, y1 ) = self.x_range, self.y_range
+
+    # pixel centers, as in aggregates computed by datashader
+    dx = ( x1 - x0 ) / width
+    dy = ( y1 - y0 ) / height
+
+    coords = [
+      ( 'lat', y0 + dy * ( np.arange( height ) + 0.5 ) ),
+      ( 'lon', x0 + dx * ( np.arange( width ) + 0.5 ) ) ]
+
+    if counts.ndim == 3:
+      coords.append( ( 'code', np.arange( len( counts ) ) ) )
+      counts = np.moveaxis( counts, 0, -1 )
+
+    return xr.DataArray(
+      counts.astype( np.uint32 ),
+      coords = coords,
+      attrs = dict( x_range = self.x_range, y_range = self.y_range ) )
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+class PixelPoints:
+
+  """Points projected onto a pixel grid, as a struct of arrays.
+
+  Indexing selects points, e.g. `points[start:stop]` is a view of a range of
+  points.
+
+  Parameters
+  ----------
+  grid : PixelGrid
+    Grid the points are projected onto.
+  px, py : np.ndarray
+    uint16 pixel column and row of each point.
+  codes : np.ndarray or None
+    uint8 code of each point.
+
+  """
+
+  def __init__( self, grid, px, py, codes = None ):
+
+    self.grid = grid
+    self.px = px
+    self.py = py
+    self.codes = codes
+
+  def __len__( self ):
+    return len( self.px )
+
+  def __getitem__( self, key ):
+
+    return PixelPoints(
+      self.grid,
+      self.px[key],
+      self.py[key],
+      None if self.codes is None else self.codes[key] )
+
+  @classmethod
+  def concatenate( cls, parts ):
+
+    """Concatenate points on the same grid.
+    """
+
+    parts = list( parts )
+
+    return cls(
+      parts[0].grid,
+      np.concatenate( [ part.px for part in parts ] ),
+      np.concatenate( [ part.py for part in parts ] ),
+      None if parts[0].codes is None else np.concatenate(
+        [ part.codes for part in parts ] ) )
+
+  @property
+  def nbytes( self ):
+    return sum(
+      array.nbytes for array in ( self.px, self.py, self.codes )
+      if array is not None )
+
+  def pixels( self ):
+
+    """Return the flat int64 pixel index of the points, see
+    `PixelGrid.pixels`.
+    """
+
+    return (
+      self.py.astype( np.int64 ) * self.grid.plot_width +
+      self.px.astype( np.int64 ) )
+
+  def counts( self ):
+
+    """Return the number of points in each pixel.
+
+    Returns
+    -------
+    counts : np.ndarray
+      (height, width) int64 counts, the first row at the southern edge.
+
+    """
+
+    return np.bincount(
+      self.pixels( ),
+      minlength = self.grid.size ).reshape( self.grid.shape )
+
+  def mask( self ):
+
+    """Return which pixels contain at least one point.
+
+    Cheaper than `counts` when only occupancy matters, as no counts are
+    allocated.
+
+    Returns
+    -------
+    mask : np.ndarray
+      (height, width) boolean array, the first row at the southern edge.
+
+    """
+
+    mask = np.zeros( self.grid.size, dtype = bool )
+    mask[self.pixels( )] = True
+
+    return mask.reshape( self.grid.shape )
+
+  def counts_by_code( self, n_codes ):
+
+    """Return the number of points of each code in each pixel.
+
+    Parameters
+    ----------
+    n_codes : int
+      Number of codes; points with a larger code are ignored.
+
+    Returns
+    -------
+    counts : np.ndarray
+      (code, height, width) int64 counts, the first row at the southern edge.
+
+    """
+
+    keep = self.codes < n_codes
+    keys = self.codes[keep].astype( np.int64 ) * self.grid.size
+    keys += self.pixels( )[keep]
+
+    return np.bincount(
+      keys,
+      minlength = n_codes * self.grid.size ).reshape(
+        ( n_codes, ) + self.grid.shape )
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
@@ -0,0 +1,486 @@
+# -*- coding: UTF-8 -*-
+
+"""Typed, cached ingest of the City of Austin CSV exports.
+
+Only the columns the analysis scripts use are parsed, with compact dtypes, and
+the result is cached as a columnar file next to a JSON sidecar recording the
+size, modification time and hash of the source CSV.
+"""
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+import os
+import json
+import shutil
+import hashlib
+
+import pandas as pd
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+# directory holding the columnar caches and their sidecars
+cache_dir = 'ingest_cache'
+
+# columnar format of the cache, either 'parquet' or 'feather'
+cache_format = 'parquet'
+
+# format of timestamps in the city exports, e.g. '10/04/2019 05:30:00 PM'
+date_format = '%m/%d/%Y %I:%M:%S %p'
+
+# size of blocks read when hashing source files
+hash_block_size = 1 << 24
+
+# size of the partitions CSV files are split into by the Dask backend
+dask_blocksize = '64MB'
+
+# columns of Crime_Reports.csv we keep, mapped onto (name, dtype)
+crime_columns = {
+  'Incident Number' : ('incident', 'int64'),
+  'Highest Offense Description' : ('offense', 'category'),
+  'Latitude' : ('lat', 'float32'),
+  'Longitude' : ('lon', 'float32'),
+  'Occurred Date Time' : ('occurred', 'datetime64[ns]') }
+
+# columns of Issued_Construction_Permits.csv we keep, mapped onto (name, dtype)
+permit_columns = {
+  'Calendar Year Issued' : ('year', 'int16'),
+  'Latitude' : ('lat', 'float32'),
+  'Longitude' : ('lon', 'float32'),
+  'Work Class' : ('work_class', 'category') }
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+def file_hash( path ):
+
+  """Return the BLAKE2b hex digest of a file, read in blocks.
+
+  Parameters
+  ----------
+  path : str
+    Path of file to hash.
+
+  Returns
+  -------
+  digest : str
+    Hex digest of the file contents.
+
+  """
+
+  h = hashlib.blake2b( digest_size = 20 )
+
+  with open( path, 'rb' ) as f:
+    for block in iter( lambda: f.read( hash_block_size ), b'' ):
+      h.update( block )
+
+  return h.hexdigest()
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+def _read_dtypes( columns ):
+
+  """Return the dtypes CSV columns are read with, before `_finalize` casts them.
+
+  Datetime columns are read as strings, to be parsed with `date_format`, and
+  integer columns as floats, as they may have missing values. Used by both the
+  pandas and Dask readers, so their caches have the same schema.
+  """
+
+  read_dtypes = dict( )
+  for column, ( name, dtype ) in columns.items( ):
+    if dtype.startswith( 'datetime' ):
+      read_dtypes[column] = 'str'
+    elif dtype.startswith( 'int' ):
+      read_dtypes[column] = 'float64'
+    else:
+      read_dtypes[column] = dtype
+
+  return read_dtypes
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+def read_columns( input_csv, columns, dropna = None, **kwargs ):
+
+  """Read selected columns of a CSV file with explicit, compact dtypes.
+
+  Parameters
+  ----------
+  input_csv : str
+    Path of CSV file.
+  columns : dict
+    Maps CSV column names onto tuples of (new name, dtype). Integer columns are
+    parsed as floats and cast once missing values have been dropped, datetime
+    columns are parsed using `date_format`, malformed timestamps being treated
+    as missing values.
+  dropna : list of str or None
+    New names of columns in which missing values cause a row to be dropped.
+    If None, rows with a missing value in any column are dropped.
+  **kwargs
+    Additional keyword arguments passed to `pd.read_csv`, e.g. `chunksize`.
+
+  Returns
+  -------
+  df : pd.DataFrame or iterator of pd.DataFrame
+    DataFrame with renamed, typed columns. If `chunksize` is given, an iterator
+    over such DataFrames.
+
+  """
+
+  reader = pd.read_csv(
+    input_csv,
+    usecols = list( columns ),
+    dtype = _read_dtypes( columns ),
+    **kwargs )
+
+  if 'chunksize' in kwargs:
+    return ( _finalize( df, columns, dropna ) for df in reader )
+
+  return _finalize( reader, columns, dropna )
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+def _finalize( df, columns, dropna ):
+
+  """Rename, drop missing values and cast the columns of a raw DataFrame.
+  """
+
+  df = df[list( columns )].rename(
+    columns = { column : name for column, ( name, _ ) in columns.items( ) } )
+
+  # cast to the declared resolution, which pandas may otherwise infer from the
+  # values, so every chunk or partition ends up with the same dtype; malformed
+  # timestamps become missing values, dropped with the rows missing values
+  for name, dtype in columns.values( ):
+    if dtype.startswith( 'datetime' ):
+      df[name] = pd.to_datetime(
+        df[name],
+        format = date_format,
+        errors = 'coerce' ).astype( dtype )
+
+  df = df.dropna( subset = dropna ).reset_index( drop = True )
+
+  for name, dtype in columns.values( ):
+    if dtype.startswith( 'int' ):
+      df[name] = df[name].astype( dtype )
+
+  return df
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+def cached_read( input_csv, columns, dropna = None, cache_dir = cache_dir ):
+
+  """Read selected columns of a CSV file, through a columnar cache.
+
+  The cache is reused as long as the source file has the same size, and either
+  the same modification time or the same contents hash, as when the cache was
+  written. Changing `columns` or `dropna` also invalidates the cache.
+
+  Parameters
+  ----------
+  input_csv : str
+    Path of CSV file.
+  columns : dict
+    Maps CSV column names onto tuples of (new name, dtype), see `read_columns`.
+  dropna : list of str or None
+    See `read_columns`.
+  cache_dir : str or None
+    Directory of the cache. If None, the CSV file is always read directly.
+
+  Returns
+  -------
+  df : pd.DataFrame
+    DataFrame with renamed, typed columns.
+
+  """
+
+  if cache_dir is None:
+    return read_columns( input_csv, columns, dropna )
+
+  stem = os.path.splitext( os.path.basename( input_csv ) )[0]
+  cache_file = os.path.join( cache_dir, f'{stem}.{cache_format}' )
+  sidecar = os.path.join( cache_dir, f'{stem}.json' )
+
+  spec = json.dumps( [ columns, dropna, date_format ], sort_keys = True )
+
+  if _cache_valid( input_csv, cache_file, sidecar, spec ):
+    if cache_format == 'feather':
+      return pd.read_feather( cache_file )
+    return pd.read_parquet( cache_file )
+
+  stat = os.stat( input_csv )
+  df = read_columns( input_csv, columns, dropna )
+
+  os.makedirs( cache_dir, exist_ok = True )
+
+  # write cache to a temporary file first, so an interrupted run never leaves
+  # a truncated cache behind
+  tmp_file = f'{cache_file}.tmp'
+  if cache_format == 'feather':
+    df.to_feather( tmp_file )
+  else:
+    df.to_parquet( tmp_file, index = False )
+  os.replace( tmp_file, cache_file )
+
+  _write_key( sidecar, input_csv, stat, spec )
+
+  return df
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+def _cache_valid( input_csv, cache_path, sidecar, spec ):
+
+  """Return whether a cache of a CSV file is up to date.
+
+  The cache is valid if it exists and its sidecar records the same spec and
+  size as now, and either the same modification time or the same contents hash.
+  """
+
+  if not ( os.path.exists( cache_path ) and os.path.exists( sidecar ) ):
+    return False
+
+  with open( sidecar ) as f:
+    key = json.load( f )
+
+  stat = os.stat( input_csv )
+
+  valid = (
+    key.get( 'spec' ) == spec and
+    key.get( 'size' ) == stat.st_size )
+
+  # only hash the source file if its modification time changed
+  if valid and key.get( 'mtime_ns' ) != stat.st_mtime_ns:
+    valid = key.get( 'hash' ) == file_hash( input_csv )
+    if valid:
+      key['mtime_ns'] = stat.st_mtime_ns
+      _write_json( sidecar, key )
+
+  return valid
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+def _write_key( sidecar, input_csv, stat, spec ):
+
+  """Record the source file a cache was written from in its sidecar.
+  """
+
+  _write_json(
+    sidecar,
+    dict(
+      spec = spec,
+      size = stat.st_size,
+      mtime_ns = stat.st_mtime_ns,
+      hash = file_hash( input_csv ) ) )
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+def _write_json( path, obj ):
+
+  """Atomically write an object to a JSON file.
+  """
+
+  tmp_path = f'{path}.tmp'
+  with open( tmp_path, 'w' ) as f:
+    json.dump( obj, f, indent = 2 )
+  os.replace( tmp_path, path )
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+def load_crime( input_csv, cache_dir = cache_dir ):
+
+  """Load the crime reports needed by `austin_crime.py`.
+
+  Parameters
+  ----------
+  input_csv : str
+    Path of Crime_Reports.csv.
+  cache_dir : str or None
+    Directory of the columnar cache, or None to bypass it.
+
+  Returns
+  -------
+  df : pd.DataFrame
+    DataFrame with columns 'incident' (int64), 'offense' (categorical), 'lat'
+    and 'lon' (float32) and 'occurred' (datetime), without missing values.
+
+  """
+
+  return cached_read( input_csv, crime_columns, cache_dir = cache_dir )
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+def load_crime_since( input_csv, high_water, chunksize = 1 << 20 ):
+
+  """Load the crime reports with an incident number above a high-water mark.
+
+  The CSV file is read in chunks, bypassing the cache, so memory use is bounded
+  by the chunk size plus the number of new reports.
+
+  Parameters
+  ----------
+  input_csv : str
+    Path of Crime_Reports.csv.
+  high_water : int
+    Largest incident number already processed.
+  chunksize : int
+    Number of rows read at a time.
+
+  Returns
+  -------
+  df : pd.DataFrame
+    DataFrame in the format returned by `load_crime`, of the new reports only.
+
+  """
+
+  # CSV column of the incident numbers
+  incident = next(
+    column for column, ( name, _ ) in crime_columns.items( )
+    if name == 'incident' )
+
+  reader = pd.read_csv(
+    input_csv,
+    usecols = list( crime_columns ),
+    dtype = _read_dtypes( crime_columns ),
+    chunksize = chunksize )
+
+  # only the new reports of each chunk have their timestamps parsed
+  chunks = [
+    _finalize( df[df[incident] > high_water], crime_columns, None )
+    for df in reader ]
+
+  df = pd.concat( chunks, ignore_index = True )
+
+  # chunks may have different categories, so make offenses categorical again
+  df['offense'] = df['offense'].astype( 'category' )
+
+  return df
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+def cached_read_dask(
+  input_csv,
+  columns,
+  dropna = None,
+  cache_dir = cache_dir,
+  blocksize = dask_blocksize ):
+
+  """Read selected columns of a CSV file as a partitioned Dask DataFrame.
+
+  On the first read, the CSV file is converted partition by partition into a
+  directory of Parquet files, so it never has to fit in memory; later reads
+  load the Parquet files, as long as the CSV file is unchanged, see
+  `cached_read`. Requires Dask.
+
+  Parameters
+  ----------
+  input_csv : str
+    Path of CSV file.
+  columns : dict
+    Maps CSV column names onto tuples of (new name, dtype), see `read_columns`.
+  dropna : list of str or None
+    See `read_columns`.
+  cache_dir : str or None
+    Directory of the cache. If None, the CSV file is always read directly.
+  blocksize : str or int
+    Size of the partitions the CSV file is split into.
+
+  Returns
+  -------
+  ddf : dask.dataframe.DataFrame
+    DataFrame with renamed, typed columns. Categorical columns may have
+    different categories in each partition.
+
+  """
+
+  # Dask is only needed by this backend
+  import dask.dataframe as dd
+
+  # each partition is finalized as a pandas DataFrame would be; the metadata
+  # is that of an empty partition, as made-up values wouldn't parse as dates
+  def read_csv( ):
+    raw = dd.read_csv(
+      input_csv,
+      usecols = list( columns ),
+      dtype = _read_dtypes( columns ),
+      blocksize = blocksize )
+    return raw.map_partitions(
+      _finalize,
+      columns,
+      dropna,
+      meta = _finalize( raw._meta, columns, dropna ) )
+
+  if cache_dir is None:
+    return read_csv( )
+
+  stem = os.path.splitext( os.path.basename( input_csv ) )[0]
+  cache_path = os.path.join( cache_dir, f'{stem}.dask.parquet' )
+  sidecar = os.path.join( cache_dir, f'{stem}.dask.json' )
+
+  spec = json.dumps( [ columns, dropna, date_format ], sort_keys = True )
+
+  if not _cache_valid( input_csv, cache_path, sidecar, spec ):
+
+    stat = os.stat( input_csv )
+
+    # convert partitions into a temporary directory first, so an interrupted
+    # run never leaves a partial cache behind
+    tmp_path = f'{cache_path}.tmp'
+    shutil.rmtree( tmp_path, ignore_errors = True )
+    read_csv( ).to_parquet( tmp_path, write_index = False )
+    shutil.rmtree( cache_path, ignore_errors = True )
+    os.replace( tmp_path, cache_path )
+
+    _write_key( sidecar, input_csv, stat, spec )
+
+  # the directory is a single dataset, whatever its name looks like
+  return dd.read_parquet( cache_path, dataset = dict( partitioning = None ) )
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+def load_crime_dask( input_csv, cache_dir = cache_dir ):
+
+  """Load the crime reports as a partitioned Dask DataFrame.
+
+  Parameters
+  ----------
+  input_csv : str
+    Path of Crime_Reports.csv.
+  cache_dir : str or None
+    Directory of the partitioned cache, or None to bypass it.
+
+  Returns
+  -------
+  ddf : dask.dataframe.DataFrame
+    DataFrame in the format returned by `load_crime`, one partition per block
+    of the CSV file.
+
+  """
+
+  return cached_read_dask( input_csv, crime_columns, cache_dir = cache_dir )
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+def load_permits( input_csv, cache_dir = cache_dir ):
+
+  """Load the construction permits needed by `austin_permits.py`.
+
+  Parameters
+  ----------
+  input_csv : str
+    Path of Issued_Construction_Permits.csv.
+  cache_dir : str or None
+    Directory of the columnar cache, or None to bypass it.
+
+  Returns
+  -------
+  df : pd.DataFrame
+    DataFrame with columns 'year' (int16), 'lat' and 'lon' (float32) and
+    'work_class' (categorical). Rows without a year or location are dropped.
+
+  """
+
+  return cached_read(
+    input_csv,
+    permit_columns,
+    dropna = [ 'year', 'lat', 'lon' ],
+    cache_dir = cache_dir )
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
@@ -6,13 +6,18 @@
 #++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
 
 import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 
 import numpy as np
-import pandas as pd
 
-import matplotlib.pyplot as plt
-from matplotlib.colors import ListedColormap
-from matplotlib.cm import get_cmap
+# latitude and longitude, and aspect ratio for city of Austin, shared by all
+# maps
+from austin_grid import x_range, y_range, x_lb, x_ub, y_lb, y_ub, ratio
+from austin_grid import PixelGrid, PixelPoints
+
+# matplotlib and imageio are imported by the functions that use them, which
+# keeps quick commands of `austin.py` fast
 
 #++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
 
@@ -24,211 +29,517 @@ input_csv = 'Issued_Construction_Permits.csv'
 output_dir_new = 'new_permits_all_years'
 output_dir_all = 'all_permits_all_years'
 
-# latitude and longitude, and aspect ratio for city of Austin
-x_range = x_lb, x_ub = -97.95, -97.5968
-y_range = y_lb, y_ub = 30.13, 30.51
+# years covered by the animation; each frame (superyear) shows the permits of
+# all years up to and including the superyear
+first_year, last_year = 1981, 2018
+
+# size of the rendered frames, in inches and dots per inch
+frame_size = (8, 8 * ratio)
+frame_dpi = 200
+
+# size of the pixel grid permits are binned into, one pixel per frame pixel
+frame_width = int(round(frame_size[0] * frame_dpi))
+frame_height = int(round(frame_size[1] * frame_dpi))
+
+frame_grid = PixelGrid( frame_width, frame_height )
+
+# animation written next to each output directory, e.g. 'mp4' or 'gif', and its
+# frame rate; writing MP4 files requires the imageio-ffmpeg plugin
+video_format = 'mp4'
+video_fps = 4
 
-ratio = ((y_ub - y_lb) / (x_ub - x_lb))
+# whether to also save every frame as a PNG in the output directories
+save_pngs = True
+
+# number of processes rendering frames, None for one per CPU
+processes = None
+
+# whether to trace Python allocations of each step, which slows down the steps
+# several times, and the profiler run on each step, None, 'cprofile' or
+# 'py-spy'; time and resident memory of every run are saved in
+# `instrument.stats_dir` either way
+trace_memory = False
+profiler = None
 
 #++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
 
-if __name__ == '__main__':
+def bin_points( points ):
 
-  # create directory if it doesn't already exist
-  os.makedirs( output_dir_new, exist_ok = True )
-  os.makedirs( output_dir_all, exist_ok = True )
+  """Bin points into a boolean pixel grid.
+
+  Parameters
+  ----------
+  points : austin_grid.PixelPoints
+    Points projected onto a pixel grid, e.g. selected with
+    `PermitIndex.select`.
+
+  Returns
+  -------
+  grid : np.ndarray
+    (height, width) boolean array, True for pixels containing at least one
+    point. The first row is the northern edge, as in an image.
+
+  """
+
+  return np.flipud( points.mask( ) )
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+class PermitIndex:
+
+  """Permit locations projected once onto a pixel grid, and sorted by year and
+  work class.
+
+  Every (year, work class) group occupies a contiguous range of the sorted
+  arrays, so selecting a year, a year and work class, or a range of years is a
+  lookup in an array of offsets that returns views rather than copies.
+  Permits outside of the grid are dropped.
+
+  Parameters
+  ----------
+  df : pd.DataFrame
+    Permits, with columns 'year', 'lat', 'lon' and categorical 'work_class',
+    as returned by `load_permits`.
+  grid : austin_grid.PixelGrid
+    Pixel grid permits are projected onto.
+
+  """
+
+  def __init__( self, df, grid = frame_grid ):
+
+    years = df['year'].to_numpy( )
+    classes = df['work_class'].cat.codes.to_numpy( )
+
+    self.work_classes = list( df['work_class'].cat.categories )
+
+    # permits without a work class get their own group, before all others
+    self.n_groups = len( self.work_classes ) + 1
+
+    self.first_year = int( years.min( ) ) if len( years ) else 0
+    self.last_year = int( years.max( ) ) if len( years ) else -1
+
+    lons = df['lon'].to_numpy( )
+    lats = df['lat'].to_numpy( )
+
+    inside = grid.contains( lons, lats )
+
+    # sort by year, then by work class
+    keys = (
+      ( years[inside].astype( np.int64 ) - self.first_year ) * self.n_groups +
+      classes[inside] + 1 )
+    order = np.argsort( keys, kind = 'stable' )
+
+    self.points = grid.project( lons[inside], lats[inside] )[order]
+
+    # offsets[k] is the position of the first permit of group k
+    n_keys = ( self.last_year - self.first_year + 1 ) * self.n_groups
+    self.offsets = np.searchsorted( keys[order], np.arange( n_keys + 1 ) )
+
+  def _offset( self, year, group ):
+
+    """Return the offset of the first permit of a group, clipped to the data.
+    """
+
+    key = ( year - self.first_year ) * self.n_groups + group
+
+    return self.offsets[ min( max( key, 0 ), len( self.offsets ) - 1 ) ]
+
+  def select( self, first_year, last_year = None, work_class = None ):
+
+    """Select the locations of permits issued in a range of years.
+
+    Parameters
+    ----------
+    first_year : int
+      First year of the selection.
+    last_year : int or None
+      Last year of the selection, inclusive. If None, only `first_year`.
+    work_class : str or None
+      If given, only select permits of this work class, e.g. 'New'.
+
+    Returns
+    -------
+    points : austin_grid.PixelPoints
+      Pixels of the selected permits. These are views of the sorted arrays,
+      except when selecting a work class over several years, which requires
+      concatenating one view per year.
+
+    """
+
+    if last_year is None:
+      last_year = first_year
+
+    if work_class is None:
+      start = self._offset( first_year, 0 )
+      stop = self._offset( last_year + 1, 0 )
+      return self.points[start:stop]
+
+    if work_class not in self.work_classes:
+      return self.points[:0]
+
+    group = self.work_classes.index( work_class ) + 1
+
+    slices = [
+      slice( self._offset( year, group ), self._offset( year, group + 1 ) )
+      for year in range( first_year, last_year + 1 ) ]
+
+    if len( slices ) == 1:
+      return self.points[slices[0]]
+
+    return PixelPoints.concatenate( [ self.points[s] for s in slices ] )
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+def cumulative_frames( layers, colors ):
+
+  """Composite per-year pixel layers into cumulative frames.
+
+  Earlier years are kept on top of later ones, so each pixel takes the color of
+  the earliest year with a permit in that pixel, as if all years up to the
+  superyear were drawn from latest to earliest.
+
+  Parameters
+  ----------
+  layers : sequence of np.ndarray
+    (height, width) boolean pixel grid of each year, in chronological order.
+  colors : sequence of color
+    Color of each year.
+
+  Yields
+  ------
+  frame : np.ndarray
+    (height, width, 3) uint8 RGB frame of all years up to and including the
+    current one, on a black background. The same buffer is updated in place
+    and yielded for every year.
+
+  """
+
+  from matplotlib.colors import to_rgb
+
+  frame = np.zeros( layers[0].shape + (3,), dtype = np.uint8 )
+  filled = np.zeros( layers[0].shape, dtype = bool )
+
+  for layer, color in zip( layers, colors ):
+
+    # only color pixels not already covered by an earlier year
+    new = layer & ~filled
+    frame[new] = np.round( 255 * np.asarray( to_rgb( color ) ) )
+    filled |= layer
+
+    yield frame
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+def render_frame( frame, label, filename = None ):
+
+  """Render a frame with a label drawn in its upper right corner.
+
+  Parameters
+  ----------
+  frame : np.ndarray
+    (height, width, 3) uint8 RGB frame spanning the Austin extent.
+  label : str
+    Text drawn in the upper right corner, e.g. the year.
+  filename : str or None
+    If given, name of an image file the rendered frame is also saved to.
+
+  Returns
+  -------
+  image : np.ndarray
+    Rendered (height, width, 3) uint8 RGB image.
+
+  """
+
+  from matplotlib.figure import Figure
+  from matplotlib.backends.backend_agg import FigureCanvasAgg
+  import imageio
 
-  # load in data and remove empty rows
-  df = pd.read_csv( input_csv )
+  # draw on an Agg canvas directly rather than through pyplot, so frames can be
+  # rendered in worker processes
+  fig = Figure(figsize = frame_size, dpi = frame_dpi)
+  canvas = FigureCanvasAgg(fig)
+  ax = fig.add_axes([0, 0, 1, 1])
 
-  ndf = df[[
-    'Calendar Year Issued',
-    'Latitude',
-    'Longitude',
-    'Work Class' ]]
+  ax.imshow(
+    frame,
+    extent = (x_lb, x_ub, y_lb, y_ub),
+    interpolation = 'nearest',
+    aspect = 'auto')
+
+  # draw label in upper right corner
+  ax.text(
+    x_ub-0.01,
+    y_ub-0.01,
+    label,
+    fontsize = 20,
+    color = 'w',
+    ha = 'right',
+    va = 'top')
+
+  # set latitude and longitude limits
+  ax.set_xlim(x_range)
+  ax.set_ylim(y_range)
+
+  canvas.draw()
+  image = np.asarray(canvas.buffer_rgba())[..., :3].copy()
+
+  if filename is not None:
+    imageio.imwrite(filename, image)
+
+  return image
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+def write_animation(
+  frames,
+  labels,
+  video_file,
+  png_dir = None,
+  processes = processes ):
+
+  """Render frames in a process pool and stream them into an animation.
+
+  Frames are rendered concurrently but written to the animation in order, with
+  at most two frames per process in flight, so memory use doesn't grow with
+  the number of frames.
+
+  Parameters
+  ----------
+  frames : iterable of np.ndarray
+    (height, width, 3) uint8 RGB frames, e.g. from `cumulative_frames`.
+  labels : iterable of str
+    Label of each frame, also used as the name of its PNG.
+  video_file : str
+    Name of the animation file; its extension selects the format.
+  png_dir : str or None
+    If given, directory each rendered frame is also saved to as a PNG.
+  processes : int or None
+    Number of worker processes, None for one per CPU.
+
+  """
+
+  import imageio
+
+  processes = processes or os.cpu_count( )
+
+  with ProcessPoolExecutor( max_workers = processes ) as executor, \
+    imageio.get_writer( video_file, fps = video_fps ) as writer:
+
+    max_pending = 2 * processes
+    pending = deque( )
+
+    for frame, label in zip( frames, labels ):
+
+      filename = None
+      if png_dir is not None:
+        filename = os.path.join( png_dir, f'{label}.png' )
+
+      # frames may be a buffer that is updated in place, so submit a copy
+      pending.append(
+        executor.submit( render_frame, frame.copy( ), label, filename ) )
+
+      # write the oldest frame once enough frames are in flight
+      if len( pending ) >= max_pending:
+        writer.append_data( pending.popleft( ).result( ) )
+
+    while pending:
+      writer.append_data( pending.popleft( ).result( ) )
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+def load_index( log ):
+
+  """Load the permits and index them by year and work class.
+
+  Parameters
+  ----------
+  log : StageLog
+    Records the time and memory used by each step.
+
+  Returns
+  -------
+  index : PermitIndex
+    Index of all permits with a year and a location.
+
+  """
+
+  from austin_ingest import load_permits
+
+  with log.stage( '0 load' ) as stage:
+
+    # load in data and remove empty rows, through a columnar cache
+    ndf = load_permits( input_csv )
+
+    # sort and index permits by year and work class once, so each selection
+    # below is a slice
+    index = PermitIndex( ndf )
+
+    stage['rows_out'] = len( ndf )
+
+  return index
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+def animate( log, index ):
+
+  """Animate new permits, and all permits, over the years; steps 1. and 2.
+
+  Parameters
+  ----------
+  log : StageLog
+    Records the time and memory used by each step.
+  index : PermitIndex
+    Index of the permits, as returned by `load_index`.
+
+  """
+
+  import matplotlib.pyplot as plt
+
+  # create directory if it doesn't already exist
+  if save_pngs:
+    os.makedirs( output_dir_new, exist_ok = True )
+    os.makedirs( output_dir_all, exist_ok = True )
 
   # use Matplotlib's Viridis cmap
-  cmap = get_cmap('viridis')
+  cmap = plt.get_cmap('viridis')
+
+  # all superyears, and the color of each; a year's index between 0 and 1 is
+  # used for the colormap
+  superyears = range( first_year, last_year )
+  colors = [
+    cmap( (year - first_year) / float(last_year - first_year) )
+    for year in superyears ]
 
   # 1. generate plots for new permits only
   #----------------------------------------------------------------------------#
-
-  # loop over all superyears
-  for superyear in range( 1981, 2018):
-
-    # initialize figure with correct aspect ratio
-    fig, ax = plt.subplots(figsize = (8, 8 * ratio))
-
-    # set background color to black
-    ax.set_facecolor('k')
-
-    # loop over all years before superyear
-    for year in range(superyear, 1980, -1):
-
-      # convert year to index between 0 and 1, for colormap
-      color_idx = (year - 1981) / float(2018 - 1981)
-
-      # get latitude and longitude of all new permits in the given year
-      lats = ndf[(
-        (ndf['Calendar Year Issued'] == year) &
-        (ndf['Work Class'] == 'New'))]['Latitude']
-      lons = ndf[(
-        (ndf['Calendar Year Issued'] == year) &
-        (ndf['Work Class'] == 'New'))]['Longitude']
-
-      # plot latitude and longitude
-      ax.scatter(
-        lons,
-        lats,
-        s = 0.15,
-        linewidth = 0,
-        facecolor = cmap(color_idx),
-        marker = ',')
-
-      # draw year in upper right corner
-      ax.text(
-        x_ub-0.01,
-        y_ub-0.01,
-        str(superyear),
-        fontsize = 20,
-        color = 'w',
-        ha = 'right',
-        va = 'top')
-
-      # set latitude and longitude limits
-      ax.set_xlim(x_range)
-      ax.set_ylim(y_range)
-
-      plt.subplots_adjust(0,0,1,1)
-
-    # save figure
-    plt.savefig(
-      os.path.join(output_dir_new, f'{superyear}.png' ),
-      dpi = 200)
-    plt.close()
+  with log.stage( '1 new permits' ):
+
+    # bin the new permits of each year into a pixel grid once
+    with log.stage( '1 bin', rows_in = len( index.points ) ):
+      layers = [
+        bin_points( index.select( year, work_class = 'New' ) )
+        for year in superyears ]
+
+    # composite each superyear's frame onto the frame of the previous one, and
+    # render the frames into an animation
+    with log.stage( '1 animate', rows_in = len( layers ) ):
+      write_animation(
+        cumulative_frames( layers, colors ),
+        [ str(superyear) for superyear in superyears ],
+        f'{output_dir_new}.{video_format}',
+        png_dir = output_dir_new if save_pngs else None )
 
   # 2. generate plots for all permits, on both new and existing buildings
   #----------------------------------------------------------------------------#
+  with log.stage( '2 all permits' ):
+
+    # bin all permits of each year into a pixel grid once
+    with log.stage( '2 bin', rows_in = len( index.points ) ):
+      layers = [
+        bin_points( index.select( year ) )
+        for year in superyears ]
+
+    # composite each superyear's frame onto the frame of the previous one, and
+    # render the frames into an animation
+    with log.stage( '2 animate', rows_in = len( layers ) ):
+      write_animation(
+        cumulative_frames( layers, colors ),
+        [ str(superyear) for superyear in superyears ],
+        f'{output_dir_all}.{video_format}',
+        png_dir = output_dir_all if save_pngs else None )
 
-  # loop over all superyears
-  for superyear in range( 1981, 2018):
-
-    # initialize figure with correct aspect ratio
-    fig, ax = plt.subplots(figsize = (8, 8 * ratio))
-
-    # set background color to black
-    ax.set_facecolor('k')
-
-    # loop over all years before superyear
-    for year in range(superyear, 1980, -1):
-
-      # convert year to index between 0 and 1, for colormap
-      color_idx = (year - 1981) / float(2018 - 1981)
-
-      # get latitude and longitude of all new permits in the given year
-      lats = ndf[((ndf['Calendar Year Issued'] == year))]['Latitude']
-      lons = ndf[((ndf['Calendar Year Issued'] == year))]['Longitude']
-
-      # plot latitude and longitude
-      ax.scatter(
-        lons,
-        lats, s = 0.15,
-        linewidth = 0,
-        facecolor = cmap(color_idx),
-        marker = ',')
-
-      # draw year in upper right corner
-      ax.text(
-        x_ub-0.01,
-        y_ub-0.01,
-        str(superyear),
-        fontsize = 20,
-        color = 'w',
-        ha = 'right',
-        va = 'top')
-
-      # set latitude and longitude limits
-      ax.set_xlim(x_range)
-      ax.set_ylim(y_range)
-
-      plt.subplots_adjust(0,0,1,1)
-
-    # save figure
-    plt.savefig(
-      os.path.join(output_dir_all, f'{superyear}.png' ),
-      dpi = 200)
-    plt.close()
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+def colorbar( log ):
+
+  """Generate the SVG of the colorbar of the years; step 3.
+
+  Parameters
+  ----------
+  log : StageLog
+    Records the time and memory used by each step.
+
+  """
+
+  import matplotlib.pyplot as plt
 
   # 3. generate SVG of colorbar for legend, that can be formatted nicely using
   # a vector graphics editing program like Inkscape
   #............................................................................#
+  with log.stage( '3 colorbar' ):
 
-  # generate custom-labelled colormap based on
-  # https://matplotlib.org/3.1.1/gallery/ticks_and_spines/colorbar_tick_labelling_demo.html
+    # generate custom-labelled colormap based on
+    # https://matplotlib.org/3.1.1/gallery/ticks_and_spines/colorbar_tick_labelling_demo.html
 
-  fig, ax = plt.subplots()
+    fig, ax = plt.subplots()
 
-  data = np.clip(np.random.randn(250, 250), -1, 1)
+    data = np.clip(np.random.randn(250, 250), -1, 1)
 
-  cax = ax.imshow(
-    data,
-    interpolation = 'nearest',
-    cmap = 'viridis' )
+    cax = ax.imshow(
+      data,
+      interpolation = 'nearest',
+      cmap = 'viridis' )
+
+    # Add colorbar, make sure to specify tick locations to match desired
+    # ticklabels
+    cbar = fig.colorbar(cax, ticks= np.linspace(-1, 1, 5))
+
+    years = np.linspace( 1980, 2020, 5)
+    years = [f'{int(year)}' for year in years]
+    cbar.ax.set_yticklabels(years)
+
+    # save SVG of colormap to file
+    plt.savefig('colorbar.svg')
+    plt.close()
 
-  # Add colorbar, make sure to specify tick locations to match desired ticklabels
-  cbar = fig.colorbar(cax, ticks= np.linspace(-1, 1, 5))
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+def first_and_last( log, index ):
 
-  years = np.linspace( 1980, 2020, 5)
-  years = [f'{int(year)}' for year in years]
-  cbar.ax.set_yticklabels(years)
+  """Plot all permits of the first and of the last year, uncolored; step 4.
 
-  # save SVG of colormap to file
-  plt.savefig('colorbar.svg')
-  plt.close()
+  Parameters
+  ----------
+  log : StageLog
+    Records the time and memory used by each step.
+  index : PermitIndex
+    Index of the permits, as returned by `load_index`.
+
+  """
 
   # 4. generate plots for all permits, for the first and last years, uncolored
   #----------------------------------------------------------------------------#
+  with log.stage( '4 first and last years' ):
+
+    for year in [first_year, last_year]:
 
-  for year in [1981, 2018]:
+      # get latitude and longitude of all permits in the given year
+      layer = bin_points( index.select( year ) )
 
-    # convert year to index between 0 and 1, for colormap
-    # color_idx = (year - 1981) / float(2018 - 1981)
+      # draw the permits in Matplotlib's default color on a black background
+      frame, = cumulative_frames( [ layer ], [ 'C0' ] )
 
-    # get latitude and longitude of all new permits in the given year
-    lats = ndf[((ndf['Calendar Year Issued'] == year))]['Latitude']
-    lons = ndf[((ndf['Calendar Year Issued'] == year))]['Longitude']
+      render_frame( frame, str(year), f'{year}.png' )
 
-    fig, ax = plt.subplots(figsize = (8, 8 * ratio))
-    ax.set_facecolor('k')
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
 
-    # plot latitude and longitude
-    ax.scatter(
-      lons,
-      lats,
-      s = 0.15,
-      linewidth = 0,
-      marker = ',')
+if __name__ == '__main__':
 
-    # draw year in upper right corner
-    ax.text(
-      x_ub-0.01,
-      y_ub-0.01,
-      str(year),
-      fontsize = 20,
-      color = 'w',
-      ha = 'right',
-      va = 'top')
+  from instrument import StageLog
 
-    # set latitude and longitude limits
-    ax.set_xlim(x_range)
-    ax.set_ylim(y_range)
+  # record the time and memory used by each numbered step
+  log = StageLog(
+    'austin_permits',
+    trace_memory = trace_memory,
+    profiler = profiler )
 
-    plt.subplots_adjust(0,0,1,1)
+  index = load_index( log )
 
-    # save figure
-    plt.savefig(f'{year}.png', dpi = 200)
-    plt.close()
+  animate( log, index )
+  colorbar( log )
+  first_and_last( log, index )
 
-  #----------------------------------------------------------------------------#
+  log.save( )
+  print( log.report( ) )
 
 #++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
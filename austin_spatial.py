@@ -0,0 +1,342 @@
+# -*- coding: UTF-8 -*-
+
+"""Persisted spatial index of categorized crimes, for area queries.
+
+Crimes are sorted by the cell of a regular longitude/latitude grid they fall
+in, so the crimes in any row of cells are a contiguous slice. A bounding box,
+radius or polygon query only tests the crimes in the cells overlapping the
+shape, and returns either the number of crimes of each category or the
+matching crimes.
+"""
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+import os
+
+import numpy as np
+import pandas as pd
+
+# matplotlib is imported by `CrimeIndex.polygon`, the only query using it, which
+# keeps `austin.py aggregate` from importing it
+
+# latitude and longitude of the city of Austin, the default extent of the grid
+from austin_grid import x_range, y_range
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+# file the index is stored in
+index_file = 'crime_index.npz'
+
+
+# size of the grid cells in degrees, about 200 m
+cell_size = 0.002
+
+# mean radius of the Earth in meters
+earth_radius = 6371008.8
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+def haversine( lon0, lat0, lons, lats ):
+
+  """Return the great-circle distance in meters from a point to other points.
+  """
+
+  lon0, lat0 = np.radians( lon0 ), np.radians( lat0 )
+  lons, lats = np.radians( lons ), np.radians( lats )
+
+  a = (
+    np.sin( ( lats - lat0 ) / 2 )**2 +
+    np.cos( lat0 ) * np.cos( lats ) * np.sin( ( lons - lon0 ) / 2 )**2 )
+
+  return 2 * earth_radius * np.arcsin( np.sqrt( np.minimum( a, 1 ) ) )
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+class CrimeIndex:
+
+  """Crime locations sorted once by grid cell, for bbox, radius and polygon
+  queries.
+
+  Every cell of the grid occupies a contiguous range of the sorted arrays, and
+  cells are ordered row by row, so the crimes in a row of cells are a single
+  slice. Crimes outside of the extent are kept in the nearest edge cell.
+
+  Parameters
+  ----------
+  df : pd.DataFrame
+    Categorized crimes, with columns 'lon', 'lat' and categorical 'code', and
+    optionally 'occurred', e.g. `nndf` of `austin_crime.py`.
+  n_categories : int
+    Number of crime categories.
+  x_range, y_range : tuple of float
+    Longitudes and latitudes spanned by the grid.
+  cell_size : float
+    Size of the grid cells in degrees.
+
+  """
+
+  def __init__(
+    self,
+    df,
+    n_categories,
+    x_range = x_range,
+    y_range = y_range,
+    cell_size = cell_size ):
+
+    self.n_categories = n_categories
+    self.x_range = tuple( x_range )
+    self.y_range = tuple( y_range )
+    self.cell_size = cell_size
+
+    # size of the grid, in cells
+    self.nx = max( int( np.ceil( np.ptp( x_range ) / cell_size ) ), 1 )
+    self.ny = max( int( np.ceil( np.ptp( y_range ) / cell_size ) ), 1 )
+
+    lons = df['lon'].to_numpy( dtype = np.float64 )
+    lats = df['lat'].to_numpy( dtype = np.float64 )
+
+    codes = df['code']
+    if isinstance( codes.dtype, pd.CategoricalDtype ):
+      codes = codes.cat.codes
+    codes = codes.to_numpy( ).astype( np.int8 )
+
+    occurred = None
+    if 'occurred' in df:
+      occurred = df['occurred'].to_numpy( dtype = 'datetime64[ns]' )
+
+    cells = self._cells( lons, lats )
+    order = np.argsort( cells, kind = 'stable' )
+
+    self.rows = order.astype( np.int64 )
+    self.lons = lons[order]
+    self.lats = lats[order]
+    self.codes = codes[order]
+    self.occurred = None if occurred is None else occurred[order]
+
+    # offsets[k] is the position of the first crime of cell k
+    self.offsets = np.searchsorted(
+      cells[order],
+      np.arange( self.nx * self.ny + 1 ) )
+
+  def __len__( self ):
+    return len( self.rows )
+
+  def _cell_xy( self, lons, lats ):
+
+    """Return the grid column and row of points, clipped to the grid.
+    """
+
+    cx = np.floor( ( np.asarray( lons ) - self.x_range[0] ) / self.cell_size )
+    cy = np.floor( ( np.asarray( lats ) - self.y_range[0] ) / self.cell_size )
+
+    return (
+      np.clip( cx, 0, self.nx - 1 ).astype( np.int64 ),
+      np.clip( cy, 0, self.ny - 1 ).astype( np.int64 ) )
+
+  def _cells( self, lons, lats ):
+
+    """Return the flat grid cell of points.
+    """
+
+    cx, cy = self._cell_xy( lons, lats )
+
+    return cy * self.nx + cx
+
+  def _candidates( self, x0, y0, x1, y1 ):
+
+    """Return the positions of the crimes in the cells overlapping a box.
+    """
+
+    ( cx0, cx1 ), ( cy0, cy1 ) = self._cell_xy( [ x0, x1 ], [ y0, y1 ] )
+
+    # the crimes in a row of cells are a single slice
+    starts = self.offsets[ np.arange( cy0, cy1 + 1 ) * self.nx + cx0 ]
+    stops = self.offsets[ np.arange( cy0, cy1 + 1 ) * self.nx + cx1 + 1 ]
+
+    if len( starts ) == 0:
+      return np.zeros( 0, dtype = np.int64 )
+
+    return np.concatenate( [
+      np.arange( start, stop ) for start, stop in zip( starts, stops ) ] )
+
+  def _result( self, positions, rows ):
+
+    """Return the counts by category, or the rows, of selected crimes.
+    """
+
+    if not rows:
+      return np.bincount(
+        self.codes[positions],
+        minlength = self.n_categories ).astype( np.int64 )
+
+    columns = dict(
+      lon = self.lons[positions],
+      lat = self.lats[positions],
+      code = self.codes[positions] )
+    if self.occurred is not None:
+      columns['occurred'] = self.occurred[positions]
+
+    return pd.DataFrame(
+      columns,
+      index = pd.Index( self.rows[positions], name = 'row' ) ).sort_index( )
+
+  def bbox( self, x0, y0, x1, y1, rows = False ):
+
+    """Select the crimes inside a bounding box.
+
+    Parameters
+    ----------
+    x0, y0, x1, y1 : float
+      Smallest and largest longitudes and latitudes of the box, inclusive.
+    rows : bool
+      If True, return the matching crimes instead of their counts.
+
+    Returns
+    -------
+    counts : np.ndarray
+      Number of matching crimes of each category, if `rows` is False.
+    df : pd.DataFrame
+      Matching crimes, with columns 'lon', 'lat', 'code' and, if indexed,
+      'occurred', indexed by their row in the indexed DataFrame, if `rows` is
+      True.
+
+    """
+
+    positions = self._candidates( x0, y0, x1, y1 )
+
+    lons, lats = self.lons[positions], self.lats[positions]
+    inside = ( lons >= x0 ) & ( lons <= x1 ) & ( lats >= y0 ) & ( lats <= y1 )
+
+    return self._result( positions[inside], rows )
+
+  def radius( self, lon, lat, meters, rows = False ):
+
+    """Select the crimes within a distance of a point.
+
+    Parameters
+    ----------
+    lon, lat : float
+      Longitude and latitude of the center.
+    meters : float
+      Radius in meters.
+    rows : bool
+      If True, return the matching crimes instead of their counts.
+
+    Returns
+    -------
+    counts or df
+      See `bbox`.
+
+    """
+
+    # box around the circle, widest at the latitude closest to a pole
+    dlat = np.degrees( meters / earth_radius )
+    dlon = dlat / max(
+      np.cos( np.radians( min( abs( lat ) + dlat, 90. ) ) ),
+      1e-12 )
+
+    positions = self._candidates(
+      lon - dlon,
+      lat - dlat,
+      lon + dlon,
+      lat + dlat )
+
+    inside = haversine(
+      lon,
+      lat,
+      self.lons[positions],
+      self.lats[positions] ) <= meters
+
+    return self._result( positions[inside], rows )
+
+  def polygon( self, vertices, rows = False ):
+
+    """Select the crimes inside a polygon.
+
+    Parameters
+    ----------
+    vertices : array_like
+      (n, 2) longitudes and latitudes of the vertices of the polygon.
+    rows : bool
+      If True, return the matching crimes instead of their counts.
+
+    Returns
+    -------
+    counts or df
+      See `bbox`.
+
+    """
+
+    from matplotlib.path import Path
+
+    vertices = np.asarray( vertices, dtype = np.float64 )
+    ( x0, y0 ), ( x1, y1 ) = vertices.min( axis = 0 ), vertices.max( axis = 0 )
+
+    positions = self._candidates( x0, y0, x1, y1 )
+
+    inside = Path( vertices ).contains_points(
+      np.column_stack( ( self.lons[positions], self.lats[positions] ) ) )
+
+    return self._result( positions[inside], rows )
+
+  def to_frame( self ):
+
+    """Return all indexed crimes, in the order of the indexed DataFrame.
+
+    This can be concatenated with newer crimes to index all of them.
+    """
+
+    return self._result(
+      np.arange( len( self ) ),
+      rows = True ).reset_index( drop = True )
+
+  def save( self, path = index_file ):
+
+    """Atomically save the index to a NumPy archive.
+    """
+
+    arrays = dict(
+      rows = self.rows,
+      lons = self.lons,
+      lats = self.lats,
+      codes = self.codes,
+      offsets = self.offsets,
+      n_categories = np.int64( self.n_categories ),
+      x_range = np.asarray( self.x_range ),
+      y_range = np.asarray( self.y_range ),
+      cell_size = np.float64( self.cell_size ),
+      shape = np.asarray( [ self.ny, self.nx ] ) )
+    if self.occurred is not None:
+      arrays['occurred'] = self.occurred
+
+    # np.savez appends '.npz' to names without it, so keep the suffix
+    tmp_path = f'{path}.tmp.npz'
+    np.savez( tmp_path, **arrays )
+    os.replace( tmp_path, path )
+
+  @classmethod
+  def load( cls, path = index_file ):
+
+    """Load an index saved by `save`.
+    """
+
+    index = cls.__new__( cls )
+
+    with np.load( path ) as f:
+
+      index.rows = f['rows']
+      index.lons = f['lons']
+      index.lats = f['lats']
+      index.codes = f['codes']
+      index.offsets = f['offsets']
+      index.occurred = f['occurred'] if 'occurred' in f else None
+
+      index.n_categories = int( f['n_categories'] )
+      index.x_range = tuple( f['x_range'] )
+      index.y_range = tuple( f['y_range'] )
+      index.cell_size = float( f['cell_size'] )
+      index.ny, index.nx = ( int( n ) for n in f['shape'] )
+
+    return index
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
@@ -0,0 +1,329 @@
+# -*- coding: UTF-8 -*-
+
+"""Crime counts binned by time, category and grid pixel, and animated.
+
+Timestamps are bucketed by month, week or hour of day, and all crimes are
+counted once into a (time bucket, category, y, x) cube. The cube is sparse:
+only non-empty cells are kept, sorted by time bucket, so the frame of a period
+or of a rolling window of periods is a contiguous slice of the cube rather than
+a new pass over the crimes.
+"""
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+import numpy as np
+
+from datashader import transfer_functions as tf
+from PIL import ImageDraw
+
+import imageio
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+# supported time buckets
+time_buckets = ( 'month', 'week', 'hour' )
+
+# day of the first Monday since 1970-01-01, weeks start on Mondays
+first_monday = 4
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+def bucket_times( occurred, bucket ):
+
+  """Return the time bucket of timestamps.
+
+  Parameters
+  ----------
+  occurred : array_like
+    Timestamps, convertible to datetime64.
+  bucket : str
+    'month', 'week' or 'hour'.
+
+  Returns
+  -------
+  buckets : np.ndarray
+    int64 months since January 1970, weeks since the Monday 1970-01-05, or
+    hours of the day.
+
+  """
+
+  occurred = np.asarray( occurred, dtype = 'datetime64[ns]' )
+
+  if bucket == 'month':
+    return occurred.astype( 'datetime64[M]' ).astype( np.int64 )
+
+  if bucket == 'week':
+    days = occurred.astype( 'datetime64[D]' ).astype( np.int64 )
+    return ( days - first_monday ) // 7
+
+  if bucket == 'hour':
+    return occurred.astype( 'datetime64[h]' ).astype( np.int64 ) % 24
+
+  raise ValueError(
+    f'unknown time bucket {bucket!r}, expected one of {time_buckets}' )
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+def bucket_label( value, bucket ):
+
+  """Return a readable label of a time bucket, e.g. '2019-10'.
+  """
+
+  if bucket == 'month':
+    return str( np.datetime64( int( value ), 'M' ) )
+
+  if bucket == 'week':
+    return str( np.datetime64( int( value ) * 7 + first_monday, 'D' ) )
+
+  return f'{int( value ):02d}:00'
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+class CrimeCube:
+
+  """Sparse counts of crimes by time bucket, category and grid pixel.
+
+  Every non-empty (bucket, category, pixel) cell is stored once, with its
+  count, sorted by bucket, so the cells of a range of buckets are contiguous.
+
+  Parameters
+  ----------
+  grid : austin_grid.PixelGrid
+    Pixel grid crimes are counted on.
+  lons, lats : array_like
+    Longitudes and latitudes of the crimes.
+  occurred : array_like
+    Timestamps of the crimes.
+  codes : array_like
+    Category code of each crime; crimes with a negative code are ignored.
+  n_categories : int
+    Number of crime categories.
+  bucket : str
+    Time bucket, 'month', 'week' or 'hour'.
+
+  """
+
+  def __init__( self, grid, lons, lats, occurred, codes, n_categories, bucket ):
+
+    self.bucket = bucket
+    self.n_categories = n_categories
+    self.grid = grid
+    self.shape = grid.shape
+
+    n_pixels = grid.size
+
+    times = bucket_times( occurred, bucket )
+    pixels = grid.pixels( lons, lats )
+    codes = np.asarray( codes, dtype = np.int64 )
+
+    keep = ( pixels >= 0 ) & ( codes >= 0 ) & ( codes < n_categories )
+    times, pixels, codes = times[keep], pixels[keep], codes[keep]
+
+    # every hour of the day is a bucket, otherwise the span of the data
+    if bucket == 'hour':
+      self.first = 0
+      n_buckets = 24
+    elif len( times ):
+      self.first = int( times.min( ) )
+      n_buckets = int( times.max( ) ) - self.first + 1
+    else:
+      self.first = 0
+      n_buckets = 0
+
+    self.values = np.arange( self.first, self.first + n_buckets )
+    self.labels = [ bucket_label( value, bucket ) for value in self.values ]
+
+    keys = (
+      ( ( times - self.first ) * n_categories + codes ) * n_pixels + pixels )
+    self.keys, counts = np.unique( keys, return_counts = True )
+    self.counts = counts.astype( np.uint32 )
+
+    # offsets[t] is the position of the first cell of bucket t
+    self.offsets = np.searchsorted(
+      self.keys,
+      np.arange( n_buckets + 1 ) * n_categories * n_pixels )
+
+  def __len__( self ):
+    return len( self.values )
+
+  def _accumulate( self, out, start, stop, sign = 1 ):
+
+    """Add the counts of a range of buckets into a dense (code, y, x) array.
+    """
+
+    flat = out.reshape( -1 )
+
+    # cells are unique within a bucket, so add one bucket at a time
+    for t in range( start, stop ):
+
+      lo, hi = self.offsets[t], self.offsets[t + 1]
+
+      # the position within a bucket is the flat (code, y, x) index
+      cells = self.keys[lo:hi] % flat.size
+
+      if sign > 0:
+        flat[cells] += self.counts[lo:hi]
+      else:
+        flat[cells] -= self.counts[lo:hi]
+
+  def frame( self, start, stop = None ):
+
+    """Return the counts of a range of time buckets.
+
+    Parameters
+    ----------
+    start : int
+      Index of the first bucket.
+    stop : int or None
+      Index one past the last bucket. If None, only bucket `start`.
+
+    Returns
+    -------
+    agg : xr.DataArray
+      (lat, lon, code) counts, as aggregated by datashader on the grid.
+
+    """
+
+    if stop is None:
+      stop = start + 1
+
+    counts = np.zeros( ( self.n_categories, ) + self.shape, dtype = np.int64 )
+    self._accumulate( counts, start, stop )
+
+    return self.grid.as_aggregate( counts )
+
+  def rolling( self, window = 1, step = 1 ):
+
+    """Yield the counts of a rolling window of time buckets.
+
+    Each frame is updated from the previous one by adding the buckets entering
+    the window and subtracting those leaving it.
+
+    Parameters
+    ----------
+    window : int
+      Number of buckets in each frame.
+    step : int
+      Number of buckets the window moves between frames.
+
+    Yields
+    ------
+    start : int
+      Index of the first bucket of the window.
+    agg : xr.DataArray
+      (lat, lon, code) counts of the window.
+
+    """
+
+    for start, counts in self._rolling_counts( window, step ):
+      yield start, self.grid.as_aggregate( counts )
+
+  def _rolling_counts( self, window, step ):
+
+    """Yield dense (code, y, x) counts of a rolling window, updated in place.
+    """
+
+    counts = np.zeros( ( self.n_categories, ) + self.shape, dtype = np.int64 )
+    stop = 0
+
+    for start in range( 0, len( self ) - window + 1, step ):
+
+      # buckets leaving and entering the window since the last frame
+      if stop > start:
+        self._accumulate( counts, start - step, start, sign = -1 )
+        self._accumulate( counts, stop, start + window )
+      else:
+        counts[:] = 0
+        self._accumulate( counts, start, start + window )
+
+      stop = start + window
+
+      yield start, counts
+
+  def totals( self ):
+
+    """Return the number of crimes in each time bucket and category.
+
+    Returns
+    -------
+    totals : np.ndarray
+      (bucket, code) int64 counts.
+
+    """
+
+    n_pixels = self.shape[0] * self.shape[1]
+
+    return np.bincount(
+      self.keys // n_pixels,
+      weights = self.counts,
+      minlength = len( self ) * self.n_categories ).astype( np.int64 ).reshape(
+        len( self ),
+        self.n_categories )
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+def write_cube_animation(
+  cube,
+  video_file,
+  colors,
+  window = 1,
+  step = 1,
+  fps = 4 ):
+
+  """Shade rolling windows of a cube and write them into an animation.
+
+  Frames share one color scale, so that brightness can be compared over time.
+
+  Parameters
+  ----------
+  cube : CrimeCube
+    Counts to animate.
+  video_file : str
+    Name of the animation file; its extension selects the format, e.g. 'gif'.
+  colors : sequence of str
+    Color of each category.
+  window, step : int
+    Number of buckets in each frame, and between frames, see
+    `CrimeCube.rolling`.
+  fps : float
+    Frame rate of the animation.
+
+  """
+
+  # otherwise the animation would have no frames
+  if window < 1 or step < 1 or window > len( cube ):
+    raise ValueError(
+      f'window of {window} and step of {step} buckets, expected at least 1 '
+      f'and a window of at most the {len( cube )} buckets of the cube' )
+
+  # largest count of a pixel over all windows, for a common color scale
+  span_max = 1
+  for _, counts in cube._rolling_counts( window, step ):
+    span_max = max( span_max, int( counts.sum( axis = 0 ).max( ) ) )
+
+  with imageio.get_writer( video_file, fps = fps ) as writer:
+
+    for start, agg in cube.rolling( window, step ):
+
+      img = tf.set_background(
+        tf.shade(
+          agg,
+          color_key = colors,
+          how = 'log',
+          span = ( 1, span_max ) ),
+        'black' )
+
+      # label the frame with its period; images put north up
+      image = img.to_pil( ).convert( 'RGB' )
+      label = cube.labels[start]
+      if window > 1:
+        label = f'{label} to {cube.labels[start + window - 1]}'
+      ImageDraw.Draw( image ).text(
+        ( image.width - 10, 10 ),
+        label,
+        fill = 'white',
+        anchor = 'rt' )
+
+      writer.append_data( np.asarray( image ) )
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
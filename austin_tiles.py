@@ -0,0 +1,469 @@
+# -*- coding: UTF-8 -*-
+
+"""Zoomable web-mercator (XYZ) tile pyramids of point data.
+
+Points are sorted once along a Z-order curve of their tiles at the deepest
+zoom level, so the points in any tile of any zoom level are a contiguous range.
+The pyramid is rendered depth-first: only tiles containing points are visited,
+tiles at the deepest level are aggregated from their points, and every other
+tile is aggregated by downsampling the aggregates of its four children.
+"""
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+import os
+import json
+import shutil
+
+import numpy as np
+import xarray as xr
+
+from datashader import transfer_functions as tf
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+# directory tiles are written to, as '{mode}/{z}/{x}/{y}.png'
+tile_dir = 'crime_tiles'
+
+# range of zoom levels rendered
+min_zoom, max_zoom = 10, 16
+
+# width and height of tiles in pixels
+tile_size = 256
+
+# minimal Leaflet page for browsing the tiles
+viewer_html = '''<!DOCTYPE html>
+<html>
+<head>
+  <meta charset="utf-8">
+  <link rel="stylesheet" href="https://unpkg.com/leaflet@1.9.4/dist/leaflet.css">
+  <script src="https://unpkg.com/leaflet@1.9.4/dist/leaflet.js"></script>
+  <style>html, body, #map {{ height: 100%; margin: 0; background: black; }}</style>
+</head>
+<body>
+  <div id="map"></div>
+  <script>
+    var options = {{ minZoom: {min_zoom}, maxNativeZoom: {max_zoom}, maxZoom: 19 }};
+    var layers = {{ {layers} }};
+    var map = L.map('map').setView([{lat}, {lon}], {min_zoom});
+    layers[Object.keys(layers)[0]].addTo(map);
+    L.control.layers(layers).addTo(map);
+  </script>
+</body>
+</html>
+'''
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+def lonlat_to_pixels( lons, lats, zoom ):
+
+  """Project longitudes and latitudes onto global web-mercator pixels.
+
+  Parameters
+  ----------
+  lons, lats : array_like
+    Longitudes and latitudes, in degrees.
+  zoom : int
+    Zoom level.
+
+  Returns
+  -------
+  px, py : np.ndarray
+    int64 pixel coordinates, counted from the north-west corner of the world.
+
+  """
+
+  scale = tile_size * 2**zoom
+
+  lons = np.asarray( lons, dtype = np.float64 )
+  lats = np.radians( np.asarray( lats, dtype = np.float64 ) )
+
+  x = ( lons + 180. ) / 360. * scale
+  y = ( 1. - np.log( np.tan( lats ) + 1. / np.cos( lats ) ) / np.pi ) / 2. * scale
+
+  px = np.clip( np.floor( x ), 0, scale - 1 ).astype( np.int64 )
+  py = np.clip( np.floor( y ), 0, scale - 1 ).astype( np.int64 )
+
+  return px, py
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+def _interleave( tx, ty, bits ):
+
+  """Return the Z-order (quadkey) index of tiles.
+  """
+
+  key = np.zeros( len( tx ), dtype = np.int64 )
+
+  for bit in range( bits ):
+    key |= ( ( ty >> bit ) & 1 ) << ( 2 * bit + 1 )
+    key |= ( ( tx >> bit ) & 1 ) << ( 2 * bit )
+
+  return key
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+def prepare_points( lons, lats, codes, n_categories, max_zoom = max_zoom ):
+
+  """Project points and sort them along the Z-order curve of their tiles.
+
+  Parameters
+  ----------
+  lons, lats : array_like
+    Longitudes and latitudes of points.
+  codes : array_like
+    Category code of each point, -1 for points without a category.
+  n_categories : int
+    Number of categories.
+  max_zoom : int
+    Deepest zoom level of the pyramid.
+
+  Returns
+  -------
+  points : dict
+    Sorted tile keys, in-tile pixel indices and category layers of the points,
+    along with `max_zoom` and `n_categories`.
+
+  """
+
+  px, py = lonlat_to_pixels( lons, lats, max_zoom )
+
+  keys = _interleave( px // tile_size, py // tile_size, max_zoom )
+  order = np.argsort( keys, kind = 'stable' )
+
+  # points without a category go into an extra, last layer
+  layers = np.asarray( codes, dtype = np.int64 )
+  layers = np.where( layers < 0, n_categories, layers )
+
+  return dict(
+    keys = keys[order],
+    pixels = (
+      ( py[order] % tile_size ) * tile_size + px[order] % tile_size ),
+    layers = layers[order],
+    max_zoom = max_zoom,
+    n_categories = n_categories )
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+def zoom_spans( points, min_zoom = min_zoom ):
+
+  """Return the largest per-pixel count of all points at each zoom level.
+
+  Tiles of a zoom level are shaded on the same scale, so they line up without
+  seams.
+  """
+
+  max_zoom = points['max_zoom']
+
+  # recover global pixel coordinates at the deepest zoom level from the keys
+  tx = np.zeros( len( points['keys'] ), dtype = np.int64 )
+  ty = np.zeros( len( points['keys'] ), dtype = np.int64 )
+  for bit in range( max_zoom ):
+    tx |= ( ( points['keys'] >> ( 2 * bit ) ) & 1 ) << bit
+    ty |= ( ( points['keys'] >> ( 2 * bit + 1 ) ) & 1 ) << bit
+
+  px = tx * tile_size + points['pixels'] % tile_size
+  py = ty * tile_size + points['pixels'] // tile_size
+
+  spans = dict( )
+  for zoom in range( min_zoom, max_zoom + 1 ):
+    shift = max_zoom - zoom
+    _, counts = np.unique(
+      ( px >> shift ) * ( tile_size << zoom ) + ( py >> shift ),
+      return_counts = True )
+    spans[zoom] = ( 1, max( int( counts.max( initial = 1 ) ), 2 ) )
+
+  return spans
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+def _tile_range( points, zoom, x, y ):
+
+  """Return the range of sorted points inside a tile.
+  """
+
+  shift = 2 * ( points['max_zoom'] - zoom )
+  key = int( _interleave( np.array( [ x ] ), np.array( [ y ] ), zoom )[0] )
+
+  return np.searchsorted(
+    points['keys'],
+    [ key << shift, ( key + 1 ) << shift ] )
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+def _tile_files( out_dir, modes, zoom, x, y ):
+
+  """Return the PNG file of a tile for each mode.
+  """
+
+  return {
+    mode : os.path.join( out_dir, mode, str( zoom ), str( x ), f'{y}.png' )
+    for mode in modes }
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+def shade_tile( counts, mode, spans, zoom, cmap, colors ):
+
+  """Shade the aggregate of a tile.
+
+  Parameters
+  ----------
+  counts : np.ndarray
+    (layers, tile_size, tile_size) counts of each category, plus the counts of
+    uncategorized points in the last layer, with the first row at the north.
+  mode : str
+    'all' shades the total counts using `cmap`, 'by_category' shades the
+    categorized counts using `colors`.
+  spans : dict
+    Shading span of each zoom level, see `zoom_spans`.
+  zoom : int
+    Zoom level of the tile.
+  cmap : list
+    Colormap of the 'all' mode.
+  colors : list
+    Color of each category of the 'by_category' mode.
+
+  Returns
+  -------
+  img : datashader.transfer_functions.Image
+    Shaded tile.
+
+  """
+
+  # datashader puts the first row of an aggregate at the bottom of an image
+  counts = counts[:, ::-1, :]
+
+  if mode == 'all':
+    agg = xr.DataArray( counts.sum( axis = 0 ), dims = ( 'y', 'x' ) )
+    return tf.shade( agg, cmap = cmap, how = 'log', span = spans[zoom] )
+
+  agg = xr.DataArray(
+    np.moveaxis( counts[:len( colors )], 0, -1 ),
+    dims = ( 'y', 'x', 'code' ),
+    coords = dict( code = np.arange( len( colors ) ) ) )
+
+  return tf.shade( agg, color_key = colors, how = 'log', span = spans[zoom] )
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+def render_tile(
+  points,
+  zoom,
+  x,
+  y,
+  spans,
+  cmap,
+  colors,
+  out_dir = tile_dir,
+  min_zoom = min_zoom,
+  reuse = True ):
+
+  """Render a tile and all tiles below it that contain points.
+
+  Parameters
+  ----------
+  points : dict
+    Points, as returned by `prepare_points`.
+  zoom, x, y : int
+    Zoom level and XYZ index of the tile.
+  spans : dict
+    Shading span of each zoom level, see `zoom_spans`.
+  cmap : list
+    Colormap of the 'all' tiles.
+  colors : list
+    Color of each category of the 'by_category' tiles.
+  out_dir : str
+    Directory tiles are written to.
+  min_zoom : int
+    Shallowest zoom level written to disk; shallower tiles are only aggregated.
+  reuse : bool
+    If True, tiles already on disk, and the tiles below them, are not rendered
+    again.
+
+  Returns
+  -------
+  counts : np.ndarray or None
+    (n_categories + 1, tile_size, tile_size) aggregate of the tile, or None if
+    the tile and the tiles below it were reused from disk.
+
+  """
+
+  modes = ( 'all', 'by_category' )
+  files = _tile_files( out_dir, modes, zoom, x, y )
+
+  # tiles are written after the tiles below them, so if a tile exists its
+  # subtree is complete
+  if reuse and zoom >= min_zoom and all( map( os.path.exists, files.values() ) ):
+    return None
+
+  n_layers = points['n_categories'] + 1
+
+  if zoom == points['max_zoom']:
+
+    # aggregate the points of the tile
+    start, stop = _tile_range( points, zoom, x, y )
+    counts = np.bincount(
+      points['layers'][start:stop] * tile_size**2 +
+      points['pixels'][start:stop],
+      minlength = n_layers * tile_size**2 ).reshape(
+        n_layers, tile_size, tile_size )
+
+  else:
+
+    # aggregate the tile from its children, each shrunk to a quadrant
+    counts = np.zeros( ( n_layers, tile_size, tile_size ), dtype = np.int64 )
+    half = tile_size // 2
+
+    for dy in range( 2 ):
+      for dx in range( 2 ):
+
+        start, stop = _tile_range( points, zoom + 1, 2 * x + dx, 2 * y + dy )
+        if start == stop:
+          continue
+
+        child = render_tile(
+          points,
+          zoom + 1,
+          2 * x + dx,
+          2 * y + dy,
+          spans,
+          cmap,
+          colors,
+          out_dir = out_dir,
+          min_zoom = min_zoom,
+          reuse = reuse )
+
+        # a child reused from disk has to be aggregated again, without
+        # rendering its subtree
+        if child is None:
+          child = render_tile(
+            points,
+            zoom + 1,
+            2 * x + dx,
+            2 * y + dy,
+            spans,
+            cmap,
+            colors,
+            out_dir = out_dir,
+            min_zoom = points['max_zoom'] + 1,
+            reuse = False )
+
+        counts[:, dy*half:(dy+1)*half, dx*half:(dx+1)*half] = child.reshape(
+          n_layers, half, 2, half, 2 ).sum( axis = ( 2, 4 ) )
+
+  if zoom >= min_zoom:
+    for mode, filename in files.items( ):
+      os.makedirs( os.path.dirname( filename ), exist_ok = True )
+      img = shade_tile( counts, mode, spans, zoom, cmap, colors )
+      img.to_pil( ).save( filename )
+
+  return counts
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+def render_pyramid(
+  lons,
+  lats,
+  codes,
+  cmap,
+  colors,
+  out_dir = tile_dir,
+  min_zoom = min_zoom,
+  max_zoom = max_zoom,
+  fingerprint = None ):
+
+  """Render XYZ tile pyramids of points, overall and by category.
+
+  Tiles are written to '{out_dir}/all/{z}/{x}/{y}.png' and
+  '{out_dir}/by_category/{z}/{x}/{y}.png', along with an 'index.html' viewer.
+  Tiles already on disk are reused if they were rendered from data with the
+  same fingerprint.
+
+  Parameters
+  ----------
+  lons, lats : array_like
+    Longitudes and latitudes of points.
+  codes : array_like
+    Category code of each point, -1 for points without a category.
+  cmap : list
+    Colormap of the 'all' tiles.
+  colors : list
+    Color of each category of the 'by_category' tiles.
+  out_dir : str
+    Directory tiles are written to.
+  min_zoom, max_zoom : int
+    Range of zoom levels rendered.
+  fingerprint : str or None
+    Identifies the data, e.g. by the largest incident number. If None, or if
+    it differs from the fingerprint of the tiles on disk, the tiles on disk
+    are removed and all tiles are rendered again.
+
+  """
+
+  meta_file = os.path.join( out_dir, 'meta.json' )
+  meta = dict(
+    fingerprint = fingerprint,
+    n_points = len( lons ),
+    min_zoom = min_zoom,
+    max_zoom = max_zoom )
+
+  reuse = False
+  if fingerprint is not None and os.path.exists( meta_file ):
+    with open( meta_file ) as f:
+      reuse = json.load( f ) == meta
+
+  # invalidate the tiles on disk until the pyramid is complete, so that an
+  # interrupted run doesn't leave a mix of old and new tiles behind a
+  # matching fingerprint
+  if os.path.exists( meta_file ):
+    os.remove( meta_file )
+
+  # tiles rendered from other data may not be overwritten, e.g. where there
+  # are no points anymore
+  if not reuse:
+    for mode in ( 'all', 'by_category' ):
+      shutil.rmtree( os.path.join( out_dir, mode ), ignore_errors = True )
+
+  points = prepare_points( lons, lats, codes, len( colors ), max_zoom )
+  spans = zoom_spans( points, min_zoom )
+
+  os.makedirs( out_dir, exist_ok = True )
+
+  # tiles at the shallowest zoom level containing points
+  shift = 2 * ( max_zoom - min_zoom )
+  for key in np.unique( points['keys'] >> shift ):
+
+    x = y = 0
+    for bit in range( min_zoom ):
+      x |= int( ( key >> ( 2 * bit ) ) & 1 ) << bit
+      y |= int( ( key >> ( 2 * bit + 1 ) ) & 1 ) << bit
+
+    render_tile(
+      points,
+      min_zoom,
+      x,
+      y,
+      spans,
+      cmap,
+      colors,
+      out_dir = out_dir,
+      min_zoom = min_zoom,
+      reuse = reuse )
+
+  with open( meta_file, 'w' ) as f:
+    json.dump( meta, f, indent = 2 )
+
+  layers = ', '.join(
+    f"'{mode}': L.tileLayer('{mode}/{{z}}/{{x}}/{{y}}.png', options)"
+    for mode in ( 'all', 'by_category' ) )
+
+  with open( os.path.join( out_dir, 'index.html' ), 'w' ) as f:
+    f.write(
+      viewer_html.format(
+        min_zoom = min_zoom,
+        max_zoom = max_zoom,
+        layers = layers,
+        lat = float( np.median( lats ) ),
+        lon = float( np.median( lons ) ) ) )
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
@@ -0,0 +1,519 @@
+# -*- coding: UTF-8 -*-
+
+"""Benchmark the Austin and polygon pipelines on seeded synthetic data.
+
+Synthetic exports shaped like Crime_Reports.csv and
+Issued_Construction_Permits.csv are generated inside the Austin extent, so no
+city data is needed; the Twitter video downloader is run against a local mock
+of Twitter, see `twitter_mock.py`. Each run appends its timings to a JSON lines
+history, and is compared with the previous run on the same host to catch
+regressions.
+"""
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import platform
+import subprocess
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+# latitude and longitude of the city of Austin
+from austin_grid import x_lb, x_ub, y_lb, y_ub
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+# directory synthetic data is generated in, and reused from
+data_dir = 'benchmark_data'
+
+# file the timings of every run are appended to
+results_file = 'benchmark_results.jsonl'
+
+# named numbers of rows of the synthetic exports
+sizes = {
+  '10k' : 10_000,
+  '1M' : 1_000_000,
+  '10M' : 10_000_000 }
+
+# mask sizes of the polygon sweep benchmark
+polygon_sizes = ( 256, 512, 1024, 2048 )
+
+# a benchmark is a regression if it is this much slower than the last run
+regression_ratio = 1.25
+
+# seconds quick commands may take to start, e.g. `python austin.py --help`
+import_budget = 1.0
+
+# startup benchmarks, each timed in a fresh interpreter
+startup_commands = {
+  'startup.austin_help' : [ 'austin.py', '--help' ],
+  'startup.import_crime' : [ '-c', 'import austin_crime' ],
+  'startup.import_permits' : [ '-c', 'import austin_permits' ] }
+
+
+# offenses of the synthetic crime data, categorized or not
+offenses = (
+  'THEFT',
+  'BURGLARY OF VEHICLE',
+  'FAMILY DISTURBANCE',
+  'CRIMINAL MISCHIEF',
+  'THEFT BY SHOPLIFTING',
+  'ASSAULT W/INJURY-FAM/DATE VIOL',
+  'HARASSMENT',
+  'DWI',
+  'POSS CONTROLLED SUB/NARCOTIC',
+  'AUTO THEFT',
+  'BURGLARY OF RESIDENCE',
+  'CRED CARD ABUSE - OTHER',
+  'THEFT OF CATALYTIC CONVERTER',
+  'AGG KIDNAPPING',
+  'WARRANT ARREST NON TRAFFIC',
+  'FOUND PROPERTY' )
+
+work_classes = ( 'New', 'Remodel', 'Addition', 'Repair', 'Demolition' )
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+def _points( rng, rows ):
+
+  """Return clustered longitudes and latitudes inside the Austin extent.
+  """
+
+  # a mix of dense neighborhoods and uniform background
+  centers = rng.uniform( ( x_lb, y_lb ), ( x_ub, y_ub ), size = ( 50, 2 ) )
+  which = rng.integers( 0, len( centers ), rows )
+  points = centers[which] + rng.normal( 0, 0.01, size = ( rows, 2 ) )
+
+  uniform = rng.random( rows ) < 0.2
+  points[uniform] = rng.uniform(
+    ( x_lb, y_lb ),
+    ( x_ub, y_ub ),
+    size = ( uniform.sum( ), 2 ) )
+
+  return np.round( points, 6 ).T
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+def make_crime_csv( path, rows, seed = 0 ):
+
+  """Write a synthetic export shaped like Crime_Reports.csv.
+
+  Parameters
+  ----------
+  path : str
+    Name of the CSV file.
+  rows : int
+    Number of crime reports.
+  seed : int
+    Seed of the random number generator.
+
+  """
+
+  rng = np.random.default_rng( seed )
+
+  lons, lats = _points( rng, rows )
+
+  # about 1% of reports have no location
+  missing = rng.random( rows ) < 0.01
+  lons[missing] = np.nan
+  lats[missing] = np.nan
+
+  occurred = (
+    np.datetime64( '2010-01-01T00:00:00' ) +
+    rng.integers( 0, 10 * 365 * 86400, rows ).astype( 'timedelta64[s]' ) )
+
+  pd.DataFrame( {
+    'Incident Number' : 20100000000 + np.sort(
+      rng.choice( 10 * rows, rows, replace = False ) ),
+    'Highest Offense Description' : rng.choice( offenses, rows ),
+    'Family Violence' : rng.choice( [ 'N', 'Y' ], rows ),
+    'Occurred Date Time' : pd.to_datetime( occurred ).strftime(
+      '%m/%d/%Y %I:%M:%S %p' ),
+    'Latitude' : lats,
+    'Longitude' : lons } ).to_csv( path, index = False )
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+def make_permits_csv( path, rows, seed = 0 ):
+
+  """Write a synthetic export shaped like Issued_Construction_Permits.csv.
+
+  Parameters
+  ----------
+  path : str
+    Name of the CSV file.
+  rows : int
+    Number of permits.
+  seed : int
+    Seed of the random number generator.
+
+  """
+
+  rng = np.random.default_rng( seed )
+
+  lons, lats = _points( rng, rows )
+
+  # more permits in later years, and a few without a year
+  years = np.floor( 1981 + 38 * np.sqrt( rng.random( rows ) ) )
+  years[rng.random( rows ) < 0.01] = np.nan
+
+  pd.DataFrame( {
+    'Permit Num' : np.arange( rows ),
+    'Calendar Year Issued' : years,
+    'Work Class' : rng.choice( work_classes, rows ),
+    'Latitude' : lats,
+    'Longitude' : lons } ).to_csv( path, index = False )
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+def synthetic_csv( kind, size, seed = 0 ):
+
+  """Return the name of a synthetic CSV file, generating it if needed.
+  """
+
+  os.makedirs( data_dir, exist_ok = True )
+  path = os.path.join( data_dir, f'{kind}_{size}_seed={seed}.csv' )
+
+  if not os.path.exists( path ):
+    make = make_crime_csv if kind == 'crime' else make_permits_csv
+    make( f'{path}.tmp', sizes[size], seed )
+    os.replace( f'{path}.tmp', path )
+
+  return path
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+def timeit( func, repeat = 3 ):
+
+  """Return the best wall time of a function over a number of runs, and its
+  last result.
+  """
+
+  best = np.inf
+  for _ in range( repeat ):
+    start = time.perf_counter( )
+    result = func( )
+    best = min( best, time.perf_counter( ) - start )
+
+  return best, result
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+def bench_crime( size, repeat ):
+
+  """Time the stages of the crime pipeline on synthetic data.
+  """
+
+  from datashader import transfer_functions as tf
+  import colorcet
+
+  import austin_ingest
+  import austin_crime
+  from austin_aggregates import aggregate_crimes
+
+  input_csv = synthetic_csv( 'crime', size )
+  cache_dir = os.path.join( data_dir, 'ingest_cache' )
+
+  timings = dict( )
+
+  timings['crime.ingest_csv'], ndf = timeit(
+    lambda: austin_ingest.read_columns( input_csv, austin_ingest.crime_columns ),
+    repeat )
+
+  # make sure the cache exists before timing reads from it
+  austin_ingest.load_crime( input_csv, cache_dir = cache_dir )
+  timings['crime.ingest_cached'], ndf = timeit(
+    lambda: austin_ingest.load_crime( input_csv, cache_dir = cache_dir ),
+    repeat )
+
+  rules = austin_crime.compile_offense_rules(
+    austin_crime.category_codes,
+    austin_crime.category_crimes,
+    austin_crime.category_patterns )
+
+  # step 2. of the pipeline, including the frame of categorized crimes
+  timings['crime.categorize'], nndf = timeit(
+    lambda: austin_crime.categorize_crimes(
+      ndf,
+      rules,
+      len( austin_crime.category_codes ) ),
+    repeat )
+
+  grid = austin_crime.crime_grid( )
+
+  timings['crime.aggregate'], aggregates = timeit(
+    lambda: aggregate_crimes(
+      grid,
+      ndf,
+      nndf,
+      len( austin_crime.category_codes ) ),
+    repeat )
+
+  colors = colorcet.palette.glasbey_light[:9]
+
+  def shade( ):
+    tf.shade( aggregates['all'], cmap = colorcet.palette.fire, how = 'eq_hist' )
+    tf.shade( aggregates['by_category'], color_key = colors )
+    for code in range( 9 ):
+      tf.shade(
+        aggregates['by_category'].isel( code = [ code ] ),
+        color_key = [ colors[code] ] )
+
+  timings['crime.shade'], _ = timeit( shade, repeat )
+
+  return timings
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+def bench_permits( size, repeat ):
+
+  """Time the stages of the permit pipeline on synthetic data.
+  """
+
+  import austin_ingest
+  import austin_permits as ap
+
+  input_csv = synthetic_csv( 'permits', size )
+
+  timings = dict( )
+
+  timings['permits.ingest_csv'], ndf = timeit(
+    lambda: austin_ingest.read_columns(
+      input_csv,
+      austin_ingest.permit_columns,
+      dropna = [ 'year', 'lat', 'lon' ] ),
+    repeat )
+
+  timings['permits.index'], index = timeit(
+    lambda: ap.PermitIndex( ndf ),
+    repeat )
+
+  superyears = range( ap.first_year, ap.last_year )
+
+  timings['permits.bin'], layers = timeit(
+    lambda: [ ap.bin_points( index.select( year ) ) for year in superyears ],
+    repeat )
+
+  colors = [ 'C0' ] * len( layers )
+  timings['permits.composite'], _ = timeit(
+    lambda: [ frame for frame in ap.cumulative_frames( layers, colors ) ],
+    repeat )
+
+  # rendering is timed per frame, on the last one
+  frame = np.zeros( layers[0].shape + ( 3, ), dtype = np.uint8 )
+  for frame in ap.cumulative_frames( layers, colors ):
+    pass
+  timings['permits.render_frame'], _ = timeit(
+    lambda: ap.render_frame( frame, str( superyears[-1] ) ),
+    repeat )
+
+  return timings
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+def bench_polygon( repeat, batch = 16 ):
+
+  """Time mask rasterization and batched log spectra at several mask sizes.
+  """
+
+  import polygon
+
+  timings = dict( )
+
+  for N in polygon_sizes:
+
+    ns = np.linspace( 3, 8, batch )
+    masks = np.empty( ( batch, N, N ), dtype = np.float32 )
+
+    timings[f'polygon.masks.N={N}'], _ = timeit(
+      lambda: [ polygon.polygon_mask( N, n, out = masks[i] )
+        for i, n in enumerate( ns ) ],
+      repeat )
+
+    timings[f'polygon.spectra.N={N}'], _ = timeit(
+      lambda: polygon.log_spectra( masks ),
+      repeat )
+
+  return timings
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+def bench_twitter( repeat, n_tweets = 400 ):
+
+  """Time crawls of a local mock of Twitter, without and with failures.
+  """
+
+  import tempfile
+  from twitter_mock import MockTwitter, run_crawl
+
+  scenarios = {
+    'twitter.crawl' : dict( ),
+    'twitter.crawl_resume' : dict( error_rate = 0.05, drop_rate = 0.1 ) }
+
+  timings = dict( )
+
+  for name, failures in scenarios.items( ):
+
+    best = np.inf
+    for _ in range( repeat ):
+
+      # a new server and directory for each run, so every run downloads the
+      # same videos from scratch
+      with MockTwitter(
+        n_tweets = n_tweets,
+        video_size = 2 << 20,
+        latency = 0.01,
+        **failures ) as mock, \
+        tempfile.TemporaryDirectory( ) as out_dir:
+        result = run_crawl( mock, out_dir )
+
+      # otherwise the resume scenario times plain downloads again
+      server = result['server']
+      if server.get( 'drops' ) and not server.get( 'resumes' ):
+        raise RuntimeError(
+          f'{name}: {server["drops"]} connections were dropped, but no video '
+          f'was resumed' )
+
+      best = min( best, result['wall'] )
+
+    timings[name] = best
+
+  return timings
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+def bench_startup( repeat ):
+
+  """Time the startup of quick commands, each in a fresh interpreter.
+  """
+
+  here = os.path.dirname( os.path.abspath( __file__ ) )
+
+  timings = dict( )
+
+  for name, argv in startup_commands.items( ):
+    timings[name], _ = timeit(
+      lambda: subprocess.run(
+        [ sys.executable ] + argv,
+        cwd = here,
+        stdout = subprocess.DEVNULL,
+        check = True ),
+      repeat )
+
+  return timings
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+def git_commit( ):
+
+  """Return the current git commit, or None outside of a git repository.
+  """
+
+  try:
+    return subprocess.run(
+      [ 'git', 'rev-parse', '--short', 'HEAD' ],
+      capture_output = True,
+      text = True,
+      check = True ).stdout.strip( )
+  except ( OSError, subprocess.CalledProcessError ):
+    return None
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+def previous_timings( host, size ):
+
+  """Return the timings of the last run on a host with a given data size.
+  """
+
+  timings = dict( )
+
+  if not os.path.exists( results_file ):
+    return timings
+
+  with open( results_file ) as f:
+    for line in f:
+      record = json.loads( line )
+      if record['host'] == host and record['size'] == size:
+        timings = record['timings']
+
+  return timings
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+if __name__ == '__main__':
+
+  parser = argparse.ArgumentParser(
+    description = 'Benchmark the Austin and polygon pipelines.' )
+  parser.add_argument( '--sizes', nargs = '+', default = [ '10k', '1M' ],
+    choices = list( sizes ), help = 'numbers of rows of the synthetic data' )
+  parser.add_argument( '--only', nargs = '+',
+    default = [ 'crime', 'permits', 'polygon', 'startup', 'twitter' ],
+    choices = [ 'crime', 'permits', 'polygon', 'startup', 'twitter' ],
+    help = 'pipelines to benchmark' )
+  parser.add_argument( '--repeat', type = int, default = 3,
+    help = 'number of runs of each benchmark, the best is kept' )
+  parser.add_argument( '--check', action = 'store_true',
+    help = 'exit with an error if any benchmark regressed' )
+  args = parser.parse_args( )
+
+  host = socket.gethostname( )
+  regressions = list( )
+
+  # the polygon, startup and twitter benchmarks don't depend on the data size
+  runs = [ ( size, [ p for p in args.only if p in ( 'crime', 'permits' ) ] )
+    for size in args.sizes ]
+  runs.append( ( None, [
+    p for p in args.only if p in ( 'polygon', 'startup', 'twitter' ) ] ) )
+
+  for size, pipelines in runs:
+
+    if not pipelines:
+      continue
+
+    timings = dict( )
+    if 'crime' in pipelines:
+      timings.update( bench_crime( size, args.repeat ) )
+    if 'permits' in pipelines:
+      timings.update( bench_permits( size, args.repeat ) )
+    if 'polygon' in pipelines:
+      timings.update( bench_polygon( args.repeat ) )
+    if 'startup' in pipelines:
+      timings.update( bench_startup( args.repeat ) )
+    if 'twitter' in pipelines:
+      timings.update( bench_twitter( args.repeat ) )
+
+    previous = previous_timings( host, size )
+
+    for name, seconds in timings.items( ):
+      line = f'{name:<32} {size or "":>4} {seconds:10.4f} s'
+      if name in previous:
+        ratio = seconds / previous[name]
+        line += f'  {ratio:5.2f}x'
+        if ratio > regression_ratio:
+          line += '  REGRESSION'
+          regressions.append( ( name, size ) )
+      if name in startup_commands and seconds > import_budget:
+        line += '  OVER BUDGET'
+        regressions.append( ( name, size ) )
+      print( line )
+
+    with open( results_file, 'a' ) as f:
+      f.write( json.dumps( dict(
+        time = datetime.now( ).isoformat( timespec = 'seconds' ),
+        commit = git_commit( ),
+        host = host,
+        python = platform.python_version( ),
+        size = size,
+        timings = timings ) ) + '\n' )
+
+  if args.check and regressions:
+    sys.exit( f'{len( regressions )} benchmarks regressed' )
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
@@ -1,18 +1,28 @@
 # -*- coding: UTF-8 -*-
 
-"""Download all videos from tweets containing a given hashtag, since a \
-specified date.
+"""Download all videos from tweets containing any of a list of hashtags, \
+since a specified date.
 """
 
 #+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
 
 import os
+import sys
 import csv
+import hashlib
+import sqlite3
+import time
+import threading
+import traceback
+from collections import deque, Counter
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
 
 import numpy as np
 import tweepy
 import pandas as pd
 import requests
+from requests.adapters import HTTPAdapter
 
 #+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
 
@@ -32,12 +42,34 @@ access_token_secret = ''
 #IraqProtests
 #IraqRevolution
 
-# hashtag to download videos of
-hashtag = 'Iraq'
+# hashtags to download videos of; each gets a directory of videos and a CSV
+# file, and search requests are shared between them within one quota
+hashtags = [ 'Iraq' ]
+
+# SQLite index of the seen tweets and videos of all hashtags
+index_file = 'twitter_videos.sqlite'
 
 # starting date (i.e. download videos from tweets since this date)
 start_date = "2019-10-04"
 
+# maximum number of videos downloaded at the same time
+max_downloads = 8
+
+# size of the chunks videos are streamed to disk in, in bytes; a chunk is only
+# written once it was fully received, so this is at most what an interrupted
+# download loses before it is resumed
+chunk_size = 64 << 10
+
+# videos at least this large, in bytes, are downloaded in this many byte ranges
+# in parallel
+parallel_size = 64 << 20
+n_ranges = 4
+
+# search requests allowed per rate-limit window, and its length in seconds,
+# until the rate-limit headers of a response tell otherwise
+search_limit = 180
+search_window = 15 * 60
+
 #+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
 
 def get_video_url( tweet ):
@@ -77,70 +109,1118 @@ def get_video_url( tweet ):
 
 #+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
 
-if __name__ == '__main__':
+def get_media_id( tweet ):
 
-  # create output directory of hashtag name if it doesn't exist already
-  os.makedirs( hashtag, exist_ok = True )
+  """If a tweet contains media, return the ID of its first media.
 
-  auth = tweepy.OAuthHandler(consumer_key, consumer_secret)
-  auth.set_access_token(access_token, access_token_secret)
-  api = tweepy.API(auth,wait_on_rate_limit=True)
-
-  # Open/Create a file to append data
-  csvFile = open(f'{hashtag}.csv', 'a')
-  #Use csv Writer
-  csvWriter = csv.writer(csvFile)
-  csvWriter.writerow([
-    'tweet.id',
-    'tweet.created_at',
-    'tweet.text',
-    'video_url',
-    'video_name' ] )
-
-  # initialize list of URLs; initializing with None so we don't have to worry
-  # about downloading nonexistant video urls.
-  urls_list = [None]
-
-  # initialize CSV file to save tweet data toy
-
-
-  # loop over all tweets since specified start_date and containing hashtag
-  for tweet in tweepy.Cursor(
-    api.search,
-    q = hashtag,
-    count = 100,
-    include_entities = True,
-    since=start_date).items():
+  Retweets and quote tweets of a video carry the media ID of the original
+  upload, even when the URLs of its variants differ.
+
+  Parameters
+  ----------
+  tweet : tweepy.Status
+    TweePy Status object containing information about a single tweet.
+
+  Returns
+  -------
+  media_id : int or None
+    Twitter ID of the media, or None if the tweet doesn't contain media.
 
-    # print(tweet.text)
+  """
 
-    # extract url from tweet, if it contains a video
-    url = get_video_url( tweet )
+  try:
+    return int( tweet.extended_entities['media'][0]['id'] )
+  except ( AttributeError, KeyError, IndexError, TypeError, ValueError ):
+    return None
 
+#+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
 
-    # check to make sure we haven't already downloaded the video for the given
-    # url
-    if url not in urls_list:
+def video_name( url ):
 
-      urls_list.append( url )
+  """Return the file name of a video URL, without its query string.
+  """
 
-      # video GET request
-      r = requests.get( url )
+  return os.path.basename( urlsplit( url ).path )
 
-      # printing status of request (should be 200 if nothing went wrong)
-      print(url.split('/')[-1], r)
-
-      # write video to file
-      fname = os.path.join( hashtag, url.split('/')[-1] )
-      with open(fname, 'wb') as f:
-        f.write( r.content )
-
-      # write tweet data to row
-      csvWriter.writerow([
-        str(tweet.id),
-        tweet.created_at,
-        tweet.text.encode('utf-8'),
+#+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+def link_duplicate( fname, duplicate ):
+
+  """Replace a file by a hardlink to another file with the same content.
+
+  Parameters
+  ----------
+  fname : str
+    Name of the file that is kept.
+  duplicate : str
+    Name of a file with the same content as `fname`.
+
+  Returns
+  -------
+  fname : str
+    `duplicate`, now a hardlink to `fname`, or `fname` if the file system
+    doesn't support hardlinks; the duplicate is removed either way.
+
+  """
+
+  tmp_fname = f'{duplicate}.link'
+
+  try:
+    os.link( fname, tmp_fname )
+  except OSError:
+    os.remove( duplicate )
+    return fname
+
+  os.replace( tmp_fname, duplicate )
+
+  return duplicate
+
+#+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+def make_session( pool_size = max_downloads ):
+
+  """Return a requests Session whose connection pool fits all downloads.
+
+  Parameters
+  ----------
+  pool_size : int
+    Number of connections kept open per host.
+
+  Returns
+  -------
+  session : requests.Session
+    Session to share between download threads.
+
+  """
+
+  session = requests.Session( )
+
+  adapter = HTTPAdapter( pool_connections = pool_size, pool_maxsize = pool_size )
+  session.mount( 'https://', adapter )
+  session.mount( 'http://', adapter )
+
+  return session
+
+#+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+def _total_size( r, offset = 0 ):
+
+  """Return the size of a whole video from the headers of a response to a GET
+  request starting at a byte offset, or None if unknown.
+  """
+
+  # 'bytes start-stop/total' or 'bytes */total'
+  content_range = r.headers.get( 'Content-Range', '' )
+  if '/' in content_range:
+    total = content_range.rsplit( '/', 1 )[1]
+    return int( total ) if total.isdigit( ) else None
+
+  if 'Content-Length' in r.headers:
+    return offset + int( r.headers['Content-Length'] )
+
+  return None
+
+#+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+def _probe_size( session, url ):
+
+  """Return the size of a video, and whether it can be downloaded in byte
+  ranges, without requesting its body.
+
+  The size is read from the response to a HEAD request, or else from the
+  'Content-Range' of a request for the first byte.
+
+  Returns
+  -------
+  r : requests.Response
+    Last response of the probe.
+  total : int or None
+    Size of the video in bytes, or None if unknown.
+  ranges : bool
+    Whether the server serves byte ranges of the video.
+
+  """
+
+  r = session.head( url, allow_redirects = True, timeout = 60 )
+  if r.ok and 'Content-Length' in r.headers:
+    return (
+      r,
+      int( r.headers['Content-Length'] ),
+      r.headers.get( 'Accept-Ranges' ) == 'bytes' )
+
+  headers = dict( Range = 'bytes=0-0' )
+  with session.get( url, headers = headers, stream = True, timeout = 60 ) as r:
+    if r.status_code == 206:
+      return r, _total_size( r ), True
+
+  return r, None, False
+
+#+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+def _hash_file( fname, digest, chunk_size = chunk_size ):
+
+  """Update a hash with the content of a file, read in chunks.
+  """
+
+  with open( fname, 'rb' ) as f:
+    for chunk in iter( lambda: f.read( chunk_size ), b'' ):
+      digest.update( chunk )
+
+#+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+def _download_range(
+  session,
+  url,
+  fname,
+  start,
+  stop,
+  chunk_size = chunk_size ):
+
+  """Download a byte range of a video to a file, resuming the file if it was
+  partially written.
+
+  Parameters
+  ----------
+  start, stop : int
+    First and last byte of the range, inclusive.
+
+  """
+
+  offset = start
+  if os.path.exists( fname ):
+    offset += os.path.getsize( fname )
+
+  if offset > stop:
+    return
+
+  headers = dict( Range = f'bytes={offset}-{stop}' )
+  with session.get( url, headers = headers, stream = True, timeout = 60 ) as r:
+
+    r.raise_for_status( )
+    if r.status_code != 206:
+      raise IOError( f'{url} does not support byte ranges' )
+
+    with open( fname, 'ab' ) as f:
+      for chunk in r.iter_content( chunk_size = chunk_size ):
+        f.write( chunk )
+
+#+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+def _download_ranges( session, url, part, total, n_ranges, chunk_size ):
+
+  """Download a video in parallel byte ranges, and join them into a file.
+
+  Each range is written to its own file, `part` followed by the number of the
+  range, so an interrupted download resumes every range where it stopped.
+
+  Returns
+  -------
+  digest : hashlib.sha256
+    Hash of the joined file.
+
+  """
+
+  bounds = np.linspace( 0, total, n_ranges + 1 ).astype( np.int64 )
+  fnames = [ f'{part}.{k}' for k in range( n_ranges ) ]
+
+  with ThreadPoolExecutor( max_workers = n_ranges ) as executor:
+    futures = [
+      executor.submit(
+        _download_range,
+        session,
+        url,
+        fname,
+        int( start ),
+        int( stop ) - 1,
+        chunk_size )
+      for fname, start, stop in zip( fnames, bounds[:-1], bounds[1:] ) ]
+    for future in futures:
+      future.result( )
+
+  # hash the ranges while joining them
+  digest = hashlib.sha256( )
+
+  with open( part, 'wb' ) as f:
+    for fname in fnames:
+      with open( fname, 'rb' ) as range_file:
+        for chunk in iter( lambda: range_file.read( chunk_size ), b'' ):
+          digest.update( chunk )
+          f.write( chunk )
+
+  for fname in fnames:
+    os.remove( fname )
+
+  return digest
+
+#+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+def _download_stream( session, url, part, offset, chunk_size ):
+
+  """Stream a video to a file in a single request, resuming the file from a
+  byte offset if it was partially written.
+
+  Returns
+  -------
+  r : requests.Response
+    Response of the request.
+  total : int or None
+    Size of the whole video in bytes, or None if unknown.
+  digest : hashlib.sha256
+    Hash of the file.
+
+  """
+
+  headers = dict( Range = f'bytes={offset}-' ) if offset else dict( )
+  digest = hashlib.sha256( )
+
+  with session.get( url, headers = headers, stream = True, timeout = 60 ) as r:
+
+    # the partial video is already complete
+    if r.status_code == 416 and _total_size( r ) == offset:
+      _hash_file( part, digest, chunk_size )
+      return r, offset, digest
+
+    r.raise_for_status( )
+
+    # the server ignored the range, so restart from the first byte
+    if r.status_code != 206:
+      offset = 0
+
+    total = _total_size( r, offset )
+
+    # bytes written before the interruption are part of the hash
+    if offset:
+      _hash_file( part, digest, chunk_size )
+
+    with open( part, 'ab' if offset else 'wb' ) as f:
+      for chunk in r.iter_content( chunk_size = chunk_size ):
+        digest.update( chunk )
+        f.write( chunk )
+
+  return r, total, digest
+
+#+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+def download_video(
+  session,
+  url,
+  fname,
+  chunk_size = chunk_size,
+  sha256 = None,
+  parallel_size = parallel_size,
+  n_ranges = n_ranges ):
+
+  """Stream a video to a file in chunks, without holding it in memory.
+
+  The video is written to `fname` followed by '.part', which is only renamed to
+  `fname` once its size, and checksum if known, are verified; a video that was
+  partially written by an interrupted download is resumed with an HTTP Range
+  request. Large videos are downloaded in several byte ranges in parallel; the
+  size of a new video is probed first, with a HEAD request, to choose between
+  ranges and a single stream.
+
+  The SHA-256 of the video is computed from the chunks as they are written.
+
+  Parameters
+  ----------
+  session : requests.Session
+    Session the request is made with.
+  url : str
+    URL of the video.
+  fname : str
+    Name of the file the video is written to.
+  chunk_size : int
+    Size of the chunks written, in bytes.
+  sha256 : str or None
+    Expected hexadecimal SHA-256 of the video, if known.
+  parallel_size : int
+    Videos at least this large, in bytes, are downloaded in byte ranges.
+  n_ranges : int
+    Number of byte ranges downloaded in parallel; 1 disables them.
+
+  Returns
+  -------
+  r : requests.Response
+    Response of the video GET request, or of the size probe of a video
+    downloaded in byte ranges.
+  sha256 : str
+    Hexadecimal SHA-256 of the video.
+
+  Raises
+  ------
+  IOError
+    If the size or checksum of the downloaded video is wrong. A video of the
+    wrong size is kept, to be resumed by the next attempt.
+
+  """
+
+  part = f'{fname}.part'
+
+  # an interrupted download in byte ranges is resumed in the same ranges
+  ranges = os.path.exists( f'{part}.0' )
+
+  offset = 0
+  if not ranges and os.path.exists( part ):
+    offset = os.path.getsize( part )
+
+  # the size of a new video decides whether it is downloaded in byte ranges,
+  # and a video partially downloaded in ranges is split into the same ranges
+  # again; the size is probed without requesting the body
+  if ranges or ( offset == 0 and n_ranges > 1 ):
+
+    r, total, accepts_ranges = _probe_size( session, url )
+
+    if ranges and total is None:
+      raise IOError( f'{url} has no size, cannot resume its byte ranges' )
+
+    ranges = ranges or (
+      accepts_ranges and
+      total is not None and
+      total >= parallel_size )
+
+  if ranges:
+    digest = _download_ranges(
+      session,
+      url,
+      part,
+      total,
+      n_ranges,
+      chunk_size )
+  else:
+    r, total, digest = _download_stream(
+      session,
+      url,
+      part,
+      offset,
+      chunk_size )
+
+  size = os.path.getsize( part )
+  if total is not None and size != total:
+    raise IOError( f'{part} has {size} bytes, expected {total}' )
+
+  if sha256 is not None and digest.hexdigest( ) != sha256:
+    os.remove( part )
+    raise IOError(
+      f'{part} has SHA-256 {digest.hexdigest( )}, expected {sha256}' )
+
+  os.replace( part, fname )
+
+  return r, digest.hexdigest( )
+
+#+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+class VideoDownloader:
+
+  """Download videos in a bounded pool of threads.
+
+  Downloads run in the background while the caller keeps paginating through
+  tweets; `submit` only blocks once `max_pending` downloads are queued or in
+  progress, so memory use stays bounded.
+
+  Parameters
+  ----------
+  max_downloads : int
+    Number of videos downloaded at the same time.
+  max_pending : int or None
+    Number of downloads queued or in progress before `submit` blocks. If None,
+    twice `max_downloads`.
+
+  """
+
+  def __init__( self, max_downloads = max_downloads, max_pending = None ):
+
+    self.session = make_session( max_downloads )
+    self.executor = ThreadPoolExecutor( max_workers = max_downloads )
+    self.slots = threading.BoundedSemaphore( max_pending or 2 * max_downloads )
+
+  def submit( self, url, fname, callback = None ):
+
+    """Queue the download of a video.
+
+    Parameters
+    ----------
+    url : str
+      URL of the video.
+    fname : str
+      Name of the file the video is written to.
+    callback : callable or None
+      Called from the download thread with the response and the SHA-256 of the
+      video, as returned by `download_video`, once the video has been written,
+      or with the raised exception if the download failed.
+
+    """
+
+    self.slots.acquire( )
+
+    def task( ):
+      try:
+        result = download_video( self.session, url, fname )
+      except Exception as e:
+        result = e
+      finally:
+        self.slots.release( )
+      if callback is not None:
+        callback( result )
+
+    # the executor would otherwise drop exceptions raised by the callback
+    def report( future ):
+      error = future.exception( )
+      if error is not None:
+        print( f'download callback of {url} failed:', file = sys.stderr )
+        traceback.print_exception(
+          type( error ), error, error.__traceback__, file = sys.stderr )
+
+    self.executor.submit( task ).add_done_callback( report )
+
+  def close( self ):
+
+    """Wait for all queued downloads to finish.
+    """
+
+    self.executor.shutdown( wait = True )
+    self.session.close( )
+
+  def __enter__( self ):
+    return self
+
+  def __exit__( self, *args ):
+    self.close( )
+
+#+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+class CrawlIndex:
+
+  """On-disk index of seen tweets and videos, and of crawl progress.
+
+  Backed by an SQLite database, so lookups don't slow down as the crawl grows
+  and survive restarts. Safe to use from download threads.
+
+  Videos are also indexed by Twitter media ID and by content hash, so a video
+  shared under several URLs is only downloaded, or only stored, once.
+
+  Parameters
+  ----------
+  path : str
+    Name of the SQLite database file.
+
+  """
+
+  def __init__( self, path ):
+
+    self.lock = threading.Lock( )
+    self.db = sqlite3.connect( path, check_same_thread = False )
+
+    with self.db:
+      self.db.executescript( """
+        CREATE TABLE IF NOT EXISTS tweets (
+          id INTEGER PRIMARY KEY );
+        CREATE TABLE IF NOT EXISTS videos (
+          url TEXT PRIMARY KEY,
+          fname TEXT,
+          tweet_id INTEGER,
+          created_at TEXT,
+          text BLOB,
+          done INTEGER DEFAULT 0 );
+        CREATE INDEX IF NOT EXISTS videos_fname ON videos (fname);
+        CREATE TABLE IF NOT EXISTS media (
+          id INTEGER PRIMARY KEY,
+          fname TEXT );
+        CREATE TABLE IF NOT EXISTS contents (
+          sha256 TEXT PRIMARY KEY,
+          fname TEXT );
+        CREATE TABLE IF NOT EXISTS checkpoints (
+          query TEXT PRIMARY KEY,
+          since_id INTEGER,
+          max_id INTEGER,
+          newest_id INTEGER );
+        """ )
+
+  def add_tweet( self, tweet_id ):
+
+    """Record a tweet, returning False if it was already seen.
+    """
+
+    with self.lock, self.db:
+      cursor = self.db.execute(
+        'INSERT OR IGNORE INTO tweets (id) VALUES (?)', ( tweet_id, ) )
+
+    return cursor.rowcount == 1
+
+  def add_video( self, url, fname, tweet ):
+
+    """Record a video to download, returning False if it was already seen.
+
+    A video is also seen if another URL, e.g. differing only in its query
+    string, is downloaded to the same file, which two downloads can't share.
+    """
+
+    with self.lock, self.db:
+
+      if self.db.execute(
+        'SELECT 1 FROM videos WHERE fname = ?',
+        ( fname, ) ).fetchone( ) is not None:
+        return False
+
+      cursor = self.db.execute(
+        'INSERT OR IGNORE INTO videos '
+        '(url, fname, tweet_id, created_at, text) VALUES (?, ?, ?, ?, ?)',
+        (
+          url,
+          fname,
+          tweet.id,
+          str( tweet.created_at ),
+          tweet.text.encode( 'utf-8' ) ) )
+
+    return cursor.rowcount == 1
+
+  def add_media( self, media_id, fname ):
+
+    """Record the file a media is downloaded to.
+
+    Returns
+    -------
+    fname : str
+      File of the first video recorded with this media ID, which is `fname`
+      if the media wasn't seen before.
+
+    """
+
+    with self.lock, self.db:
+      self.db.execute(
+        'INSERT OR IGNORE INTO media (id, fname) VALUES (?, ?)',
+        ( media_id, fname ) )
+      return self.db.execute(
+        'SELECT fname FROM media WHERE id = ?',
+        ( media_id, ) ).fetchone( )[0]
+
+  def add_content( self, sha256, fname ):
+
+    """Record the file holding a downloaded video, by its content hash.
+
+    Returns
+    -------
+    fname : str
+      First file recorded with this content, which is `fname` if the content
+      wasn't seen before.
+
+    """
+
+    with self.lock, self.db:
+      self.db.execute(
+        'INSERT OR IGNORE INTO contents (sha256, fname) VALUES (?, ?)',
+        ( sha256, fname ) )
+      return self.db.execute(
+        'SELECT fname FROM contents WHERE sha256 = ?',
+        ( sha256, ) ).fetchone( )[0]
+
+  def video_done( self, url ):
+
+    """Record that a video was downloaded.
+    """
+
+    with self.lock, self.db:
+      self.db.execute( 'UPDATE videos SET done = 1 WHERE url = ?', ( url, ) )
+
+  def pending_videos( self ):
+
+    """Return the videos recorded, but not downloaded, by an earlier run.
+
+    Returns
+    -------
+    videos : list of tuple
+      Tuples of (url, fname, tweet_id, created_at, text).
+
+    """
+
+    with self.lock:
+      return self.db.execute(
+        'SELECT url, fname, tweet_id, created_at, text FROM videos '
+        'WHERE done = 0' ).fetchall( )
+
+  def checkpoint( self, query ):
+
+    """Return the crawl progress of a query.
+
+    Returns
+    -------
+    since_id : int or None
+      Newest tweet of the last completed crawl; older tweets were all seen.
+    max_id : int or None
+      If a crawl was interrupted, the newest tweet it still has to fetch.
+    newest_id : int or None
+      Newest tweet of the interrupted crawl.
+
+    """
+
+    with self.lock:
+      row = self.db.execute(
+        'SELECT since_id, max_id, newest_id FROM checkpoints WHERE query = ?',
+        ( query, ) ).fetchone( )
+
+    return row or ( None, None, None )
+
+  def save_checkpoint( self, query, since_id, max_id, newest_id ):
+
+    """Save the crawl progress of a query, see `checkpoint`.
+    """
+
+    with self.lock, self.db:
+      self.db.execute(
+        'INSERT OR REPLACE INTO checkpoints VALUES (?, ?, ?, ?)',
+        ( query, since_id, max_id, newest_id ) )
+
+  def close( self ):
+
+    self.db.close( )
+
+#+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+class RateLimit:
+
+  """Token bucket of search requests, shared by all queries of a crawl.
+
+  Each request takes a token. The bucket is set from the rate-limit headers of
+  every response, so it follows the quota actually left, and is refilled when
+  the rate-limit window resets. Only when it is empty does `acquire` sleep, and
+  only until the reset.
+
+  Parameters
+  ----------
+  limit : int
+    Number of requests allowed per window, until a response tells otherwise.
+  window : float
+    Length of the rate-limit window, in seconds.
+
+  """
+
+  def __init__( self, limit = search_limit, window = search_window ):
+
+    self.lock = threading.Lock( )
+    self.limit = limit
+    self.window = window
+    self.tokens = limit
+    self.reset = time.time( ) + window
+
+  def acquire( self ):
+
+    """Take a token, sleeping until the window resets if there is none left.
+    """
+
+    while True:
+
+      with self.lock:
+
+        now = time.time( )
+        if now >= self.reset:
+          self.tokens = self.limit
+          self.reset = now + self.window
+
+        if self.tokens >= 1:
+          self.tokens -= 1
+          return
+
+        wait = self.reset - now
+
+      time.sleep( wait )
+
+  def update( self, headers ):
+
+    """Set the bucket from the 'x-rate-limit-*' headers of a response.
+    """
+
+    with self.lock:
+
+      if 'x-rate-limit-limit' in headers:
+        self.limit = int( headers['x-rate-limit-limit'] )
+
+      if 'x-rate-limit-remaining' in headers:
+        self.tokens = int( headers['x-rate-limit-remaining'] )
+
+      # epoch seconds; one more second as the server clock may be ahead
+      if 'x-rate-limit-reset' in headers:
+        self.reset = int( headers['x-rate-limit-reset'] ) + 1
+
+  def exhaust( self, headers ):
+
+    """Empty the bucket after a response saying the quota ran out.
+    """
+
+    self.update( headers )
+
+    with self.lock:
+      self.tokens = 0
+
+#+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+def _rate_limited( e ):
+
+  """Return whether an exception of the API is an HTTP 429 response.
+  """
+
+  response = getattr( e, 'response', None )
+
+  return response is not None and response.status_code == 429
+
+#+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+def search_pages( api, query, index, rate_limit = None, **kwargs ):
+
+  """Yield the pages of tweets matching a query, resuming from the last
+  checkpoint.
+
+  Tweets are fetched from newest to oldest, one page at a time. After each page
+  the crawl progress is saved in the index, so an interrupted crawl resumes
+  below the last page it finished, and a completed crawl is followed by one
+  that only fetches tweets newer than it.
+
+  Parameters
+  ----------
+  api : tweepy.API
+    Twitter API, created with `wait_on_rate_limit = False` if `rate_limit` is
+    given.
+  query : str
+    Search query, e.g. a hashtag.
+  index : CrawlIndex
+    Index the crawl progress is saved in.
+  rate_limit : RateLimit or None
+    Bucket every request takes a token from. If None, requests are made
+    without checking the quota.
+  **kwargs
+    Additional keyword arguments passed to `api.search`, e.g. `since`.
+
+  Yields
+  ------
+  page : list of tweepy.Status
+    Tweets matching the query.
+
+  """
+
+  since_id, max_id, newest_id = index.checkpoint( query )
+
+  while True:
+
+    if rate_limit is not None:
+      rate_limit.acquire( )
+
+    try:
+      page = api.search(
+        q = query,
+        since_id = since_id,
+        max_id = max_id,
+        **kwargs )
+    except Exception as e:
+      # the quota ran out despite the bucket, e.g. used by another client;
+      # wait for the reset and retry the same page
+      if rate_limit is None or not _rate_limited( e ):
+        raise
+      rate_limit.exhaust( e.response.headers )
+      continue
+
+    if rate_limit is not None and api.last_response is not None:
+      rate_limit.update( api.last_response.headers )
+
+    # the crawl is complete, the next one only needs newer tweets
+    if len( page ) == 0:
+      index.save_checkpoint( query, newest_id or since_id, None, None )
+      return
+
+    ids = [ tweet.id for tweet in page ]
+    newest_id = max( ids + [ newest_id or 0 ] )
+
+    yield page
+
+    max_id = min( ids ) - 1
+    index.save_checkpoint( query, since_id, max_id, newest_id )
+
+#+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+def search_tweets( api, query, index, rate_limit = None, **kwargs ):
+
+  """Yield the tweets matching a query, resuming from the last checkpoint.
+
+  See `search_pages`.
+
+  Yields
+  ------
+  tweet : tweepy.Status
+    Tweet matching the query.
+
+  """
+
+  for page in search_pages( api, query, index, rate_limit, **kwargs ):
+    for tweet in page:
+      yield tweet
+
+#+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+def search_queries( api, queries, index, rate_limit = None, **kwargs ):
+
+  """Yield the tweets matching several queries, one page of each in turn.
+
+  Pages are fetched round-robin, so every query progresses at the same pace
+  within the shared quota, and a query whose crawl is complete stops using it.
+
+  Parameters
+  ----------
+  api : tweepy.API
+    Twitter API.
+  queries : sequence of str
+    Search queries, e.g. hashtags.
+  index : CrawlIndex
+    Index the crawl progress of every query is saved in.
+  rate_limit : RateLimit or None
+    Bucket shared by the requests of all queries, see `search_pages`.
+  **kwargs
+    Additional keyword arguments passed to `api.search`, e.g. `since`.
+
+  Yields
+  ------
+  query : str
+    Query the tweet matched.
+  tweet : tweepy.Status
+    Tweet matching the query.
+
+  """
+
+  crawls = deque(
+    ( query, search_pages( api, query, index, rate_limit, **kwargs ) )
+    for query in queries )
+
+  while crawls:
+
+    query, pages = crawls.popleft( )
+
+    try:
+      page = next( pages )
+    except StopIteration:
+      continue
+
+    for tweet in page:
+      yield query, tweet
+
+    crawls.append( ( query, pages ) )
+
+#+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+def crawl(
+  api,
+  queries,
+  index,
+  out_dir = '.',
+  rate_limit = None,
+  max_downloads = max_downloads,
+  **kwargs ):
+
+  """Download the videos of all tweets matching any of several queries.
+
+  Videos of each query are downloaded into a directory named after it, and the
+  data of their tweets is appended to a CSV file named after it. Videos an
+  earlier crawl with the same index didn't finish downloading are retried
+  first.
+
+  Parameters
+  ----------
+  api : tweepy.API
+    Twitter API.
+  queries : sequence of str
+    Search queries, e.g. hashtags.
+  index : CrawlIndex
+    Index of seen tweets and videos, and of crawl progress.
+  out_dir : str
+    Directory the video directories and CSV files are written in.
+  rate_limit : RateLimit or None
+    Bucket shared by the search requests, see `search_pages`.
+  max_downloads : int
+    Number of videos downloaded at the same time.
+  **kwargs
+    Additional keyword arguments passed to `api.search`, e.g. `since`.
+
+  Returns
+  -------
+  counts : collections.Counter
+    Number of videos 'downloaded', 'failed', 'linked' to a video with the same
+    content, and 'shared' with an earlier tweet of the same media, and number
+    of 'bytes' downloaded.
+
+  """
+
+  # create output directory of each query name if it doesn't exist already
+  for query in queries:
+    os.makedirs( os.path.join( out_dir, query ), exist_ok = True )
+
+  counts = Counter( )
+
+  # CSV file of each query, opened when its first row is written
+  csv_files = dict( )
+
+  # CSV rows and counts are written from the download threads
+  csv_lock = threading.Lock( )
+
+  def write_csv( query, url, fname, tweet_id, created_at, text ):
+
+    """Write the tweet data of a video to the CSV file of a query.
+    """
+
+    with csv_lock:
+
+      if query not in csv_files:
+
+        # Open/Create a file to append data, only writing the header to a new
+        # file
+        csv_name = os.path.join( out_dir, f'{query}.csv' )
+        new_csv = not os.path.exists( csv_name )
+        csvFile = open(csv_name, 'a')
+        #Use csv Writer
+        csvWriter = csv.writer(csvFile)
+        if new_csv:
+          csvWriter.writerow([
+            'tweet.id',
+            'tweet.created_at',
+            'tweet.text',
+            'video_url',
+            'video_name' ] )
+
+        csv_files[query] = ( csvFile, csvWriter )
+
+      # videos first found through another query are in its directory
+      csv_files[query][1].writerow([
+        str(tweet_id),
+        created_at,
+        text,
         url,
-        url.split('/')[-1] ] )
+        os.path.relpath( fname, os.path.join( out_dir, query ) ) ] )
+
+  def write_row( url, fname, tweet_id, created_at, text ):
+
+    """Return a download callback that writes the tweet data to the CSV file.
+    """
+
+    # videos are downloaded into the directory of their query
+    query = os.path.basename( os.path.dirname( fname ) )
+
+    def callback( result ):
+
+      if isinstance( result, Exception ):
+        print( os.path.basename( fname ), result )
+        with csv_lock:
+          counts['failed'] += 1
+        return
+
+      r, sha256 = result
+
+      # printing status of request (should be 200 if nothing went wrong)
+      print( os.path.basename( fname ), r )
+
+      # a video with the same content was already downloaded under another
+      # URL, so keep a hardlink to it instead of a second copy
+      stored = index.add_content( sha256, fname )
+      video = fname
+      if stored != fname:
+        video = link_duplicate( stored, fname )
+
+      index.video_done( url )
+
+      with csv_lock:
+        counts['downloaded'] += 1
+        counts['linked'] += stored != fname
+        counts['bytes'] += os.path.getsize( stored )
+
+      write_csv( query, url, video, tweet_id, created_at, text )
+
+    return callback
+
+  try:
 
-#+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
\ No newline at end of file
+    # videos are downloaded in background threads while we keep paginating
+    with VideoDownloader( max_downloads ) as downloader:
+
+      # first retry videos an earlier run didn't finish downloading
+      for video in index.pending_videos( ):
+        downloader.submit( video[0], video[1], write_row( *video ) )
+
+      # loop over all tweets containing any of the queries, one page of each
+      # in turn, skipping those fetched by earlier runs
+      for query, tweet in search_queries(
+        api,
+        queries,
+        index,
+        rate_limit,
+        **kwargs ):
+
+        # check to make sure we haven't already seen the tweet, under any of
+        # the queries
+        if not index.add_tweet( tweet.id ):
+          continue
+
+        # extract url from tweet, if it contains a video
+        url = get_video_url( tweet )
+        if url is None:
+          continue
+
+        fname = os.path.join( out_dir, query, video_name( url ) )
+
+        # retweets and re-shares of a video already recorded under another URL
+        # only get a CSV row naming the file of the first one
+        media_id = get_media_id( tweet )
+        if media_id is not None:
+          stored = index.add_media( media_id, fname )
+          if stored != fname:
+            write_csv(
+              query,
+              url,
+              stored,
+              tweet.id,
+              str( tweet.created_at ),
+              tweet.text.encode( 'utf-8' ) )
+            with csv_lock:
+              counts['shared'] += 1
+            continue
+
+        # check to make sure we haven't already downloaded the video for the
+        # given url, then queue video download
+        if index.add_video( url, fname, tweet ):
+          downloader.submit(
+            url,
+            fname,
+            write_row(
+              url,
+              fname,
+              tweet.id,
+              str( tweet.created_at ),
+              tweet.text.encode( 'utf-8' ) ) )
+
+  finally:
+    for csvFile, _ in csv_files.values( ):
+      csvFile.close( )
+
+  return counts
+
+#+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+if __name__ == '__main__':
+
+  auth = tweepy.OAuthHandler(consumer_key, consumer_secret)
+  auth.set_access_token(access_token, access_token_secret)
+
+  # the rate limit is handled by the bucket shared by all hashtags, instead of
+  # blocking in the API
+  api = tweepy.API(auth,wait_on_rate_limit=False)
+
+  # index of seen tweets and videos of all hashtags, and of crawl progress
+  index = CrawlIndex( index_file )
+
+  # download videos of all tweets since specified start_date and containing
+  # any of the hashtags
+  crawl(
+    api,
+    hashtags,
+    index,
+    rate_limit = RateLimit( ),
+    max_downloads = max_downloads,
+    count = 100,
+    include_entities = True,
+    since = start_date )
+
+  index.close( )
+
+#+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
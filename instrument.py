@@ -0,0 +1,378 @@
+# -*- coding: UTF-8 -*-
+
+"""Per-stage timing and memory instrumentation of the pipeline scripts.
+
+Each numbered step of a script runs inside `StageLog.stage`, which records its
+wall and CPU time, resident memory, optionally Python allocations, and the
+number of rows going in and out. A run is saved as JSON, and as a Chrome trace that can be
+opened in chrome://tracing or https://ui.perfetto.dev. Stages can optionally be
+profiled with cProfile or py-spy.
+"""
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+import os
+import re
+import sys
+import json
+import time
+import signal
+import cProfile
+import platform
+import threading
+import tracemalloc
+import subprocess
+import warnings
+from datetime import datetime
+from contextlib import contextmanager
+
+try:
+  import resource
+except ImportError:
+  resource = None
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+# directory run statistics and profiles are written to
+stats_dir = 'run_stats'
+
+# profilers that can be run on each top-level stage
+profilers = ( 'cprofile', 'py-spy' )
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+def _rss( ):
+
+  """Return the current resident set size in bytes, or None if unknown.
+  """
+
+  try:
+    with open( '/proc/self/statm' ) as f:
+      return int( f.read( ).split( )[1] ) * os.sysconf( 'SC_PAGE_SIZE' )
+  except ( OSError, ValueError ):
+    return None
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+def _peak_rss( ):
+
+  """Return the peak resident set size in bytes, or None if unknown.
+
+  On Linux, this is the peak since the last call of `_reset_peak_rss`; on other
+  platforms, the peak over the lifetime of the process.
+  """
+
+  try:
+    with open( '/proc/self/status' ) as f:
+      for line in f:
+        if line.startswith( 'VmHWM:' ):
+          return int( line.split( )[1] ) * 1024
+  except OSError:
+    pass
+
+  if resource is None:
+    return None
+
+  peak = resource.getrusage( resource.RUSAGE_SELF ).ru_maxrss
+
+  # kilobytes, except on macOS
+  return peak if sys.platform == 'darwin' else peak * 1024
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+def _reset_peak_rss( ):
+
+  """Reset the peak resident set size to the current one, where supported.
+  """
+
+  try:
+    with open( '/proc/self/clear_refs', 'w' ) as f:
+      f.write( '5' )
+  except OSError:
+    pass
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+def _children_cpu( ):
+
+  """Return the CPU time of terminated child processes, in seconds.
+  """
+
+  if resource is None:
+    return 0.
+
+  usage = resource.getrusage( resource.RUSAGE_CHILDREN )
+
+  return usage.ru_utime + usage.ru_stime
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+def _max( a, b ):
+
+  """Return the larger of two values, either of which may be None.
+  """
+
+  if a is None:
+    return b
+  if b is None:
+    return a
+
+  return max( a, b )
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+class StageLog:
+
+  """Record the time and memory used by the stages of a run.
+
+  Stages may be nested; the peaks of a stage include those of its sub-stages.
+  CPU time covers all threads of the process, plus child processes that
+  terminated during the stage, such as the workers of a process pool that was
+  shut down within it.
+
+  Parameters
+  ----------
+  name : str
+    Name of the run, used to name its output files, e.g. 'austin_crime'.
+  trace_memory : bool
+    Whether to trace Python allocations with `tracemalloc`. This covers NumPy
+    arrays but slows down code that allocates many small objects, several
+    times over for the pipeline scripts, so it is off by default.
+  profiler : str or None
+    If 'cprofile' or 'py-spy', profile each top-level stage and save one
+    profile per stage next to the run statistics.
+  out_dir : str
+    Directory run statistics and profiles are written to.
+
+  """
+
+  def __init__(
+    self,
+    name,
+    trace_memory = False,
+    profiler = None,
+    out_dir = stats_dir ):
+
+    if profiler is not None and profiler not in profilers:
+      raise ValueError(
+        f'unknown profiler {profiler!r}, expected one of {profilers}' )
+
+    self.name = name
+    self.trace_memory = trace_memory
+    self.profiler = profiler
+    self.out_dir = out_dir
+
+    self.started = datetime.now( ).isoformat( timespec = 'seconds' )
+    self.t0 = time.perf_counter( )
+    self.stages = list( )
+    self._stack = list( )
+
+    if trace_memory and not tracemalloc.is_tracing( ):
+      tracemalloc.start( )
+
+  @contextmanager
+  def stage( self, name, rows_in = None ):
+
+    """Record a stage of the run.
+
+    Parameters
+    ----------
+    name : str
+      Name of the stage, e.g. '1 load'.
+    rows_in : int or None
+      Number of rows going into the stage, if meaningful.
+
+    Yields
+    ------
+    record : dict
+      Statistics of the stage, filled in when it ends. Set its 'rows_out' item
+      to record the number of rows coming out of the stage.
+
+    """
+
+    parent = self._stack[-1] if self._stack else None
+
+    # fold the peaks so far into the parent stage before resetting them
+    if parent is not None:
+      self._update_peaks( parent )
+
+    record = dict(
+      name = name,
+      depth = len( self._stack ),
+      rows_in = rows_in,
+      rows_out = None )
+
+    self.stages.append( record )
+    self._stack.append( record )
+
+    _reset_peak_rss( )
+    if self.trace_memory:
+      tracemalloc.reset_peak( )
+      traced_start = tracemalloc.get_traced_memory( )[0]
+
+    record['rss_start'] = _rss( )
+    record['peak_rss'] = None
+    record['traced_peak'] = None
+
+    stop_profiler = self._start_profiler( name ) if parent is None else None
+
+    start = time.perf_counter( )
+    cpu_start = time.process_time( )
+    children_start = _children_cpu( )
+
+    try:
+      yield record
+    finally:
+
+      record['start'] = start - self.t0
+      record['wall'] = time.perf_counter( ) - start
+      record['cpu'] = time.process_time( ) - cpu_start
+      record['children_cpu'] = _children_cpu( ) - children_start
+
+      if stop_profiler is not None:
+        stop_profiler( )
+
+      record['rss_end'] = _rss( )
+      self._update_peaks( record )
+
+      if self.trace_memory:
+        record['traced_delta'] = (
+          tracemalloc.get_traced_memory( )[0] - traced_start )
+        record['traced_peak'] -= traced_start
+
+      self._stack.pop( )
+
+      if parent is not None:
+        parent['peak_rss'] = _max( parent['peak_rss'], record['peak_rss'] )
+        if self.trace_memory:
+          parent['traced_peak'] = _max(
+            parent['traced_peak'],
+            record['traced_peak'] + traced_start )
+
+  def _update_peaks( self, record ):
+
+    """Fold the current peaks of resident and traced memory into a stage.
+    """
+
+    record['peak_rss'] = _max( record['peak_rss'], _peak_rss( ) )
+
+    if self.trace_memory:
+      record['traced_peak'] = _max(
+        record['traced_peak'],
+        tracemalloc.get_traced_memory( )[1] )
+
+  def _start_profiler( self, name ):
+
+    """Start profiling a stage, and return a function stopping the profiler.
+    """
+
+    if self.profiler is None:
+      return None
+
+    os.makedirs( self.out_dir, exist_ok = True )
+    stem = os.path.join(
+      self.out_dir,
+      self.name + '.' + re.sub( r'[^\w.-]+', '_', name ) )
+
+    if self.profiler == 'cprofile':
+
+      profile = cProfile.Profile( )
+      profile.enable( )
+
+      def stop( ):
+        profile.disable( )
+        profile.dump_stats( f'{stem}.prof' )
+
+      return stop
+
+    try:
+      process = subprocess.Popen( [
+        'py-spy', 'record',
+        '--pid', str( os.getpid( ) ),
+        '--subprocesses',
+        '--output', f'{stem}.svg' ],
+        stdout = subprocess.DEVNULL )
+    except OSError as e:
+      warnings.warn( f'cannot start py-spy, not profiling {name!r}: {e}' )
+      return None
+
+    def stop( ):
+      # py-spy writes its output when interrupted
+      process.send_signal( signal.SIGINT )
+      process.wait( )
+
+    return stop
+
+  def report( self ):
+
+    """Return a table of the statistics of all stages, as a string.
+    """
+
+    def mb( value ):
+      return '' if value is None else f'{value / 2**20:.0f}'
+
+    lines = [
+      f'{"stage":<32} {"wall s":>8} {"cpu s":>8} {"peak MB":>8} '
+      f'{"alloc MB":>8} {"rows in":>10} {"rows out":>10}' ]
+
+    for record in self.stages:
+      lines.append(
+        f'{"  " * record["depth"] + record["name"]:<32} '
+        f'{record["wall"]:8.2f} '
+        f'{record["cpu"] + record["children_cpu"]:8.2f} '
+        f'{mb( record["peak_rss"] ):>8} '
+        f'{mb( record.get( "traced_peak" ) ):>8} '
+        f'{"" if record["rows_in"] is None else record["rows_in"]:>10} '
+        f'{"" if record["rows_out"] is None else record["rows_out"]:>10}' )
+
+    return '\n'.join( lines )
+
+  def save( self ):
+
+    """Save the run statistics as JSON, and as a Chrome trace.
+
+    Returns
+    -------
+    stats_file, trace_file : str
+      Names of the JSON file and of the trace file.
+
+    """
+
+    os.makedirs( self.out_dir, exist_ok = True )
+
+    stats_file = os.path.join( self.out_dir, f'{self.name}.json' )
+    trace_file = os.path.join( self.out_dir, f'{self.name}.trace.json' )
+
+    with open( stats_file, 'w' ) as f:
+      json.dump(
+        dict(
+          name = self.name,
+          started = self.started,
+          argv = sys.argv,
+          python = platform.python_version( ),
+          stages = self.stages ),
+        f,
+        indent = 2 )
+
+    # complete events, in microseconds since the start of the run
+    pid = os.getpid( )
+    tid = threading.get_ident( )
+    events = [
+      dict(
+        name = record['name'],
+        ph = 'X',
+        ts = record['start'] * 1e6,
+        dur = record['wall'] * 1e6,
+        pid = pid,
+        tid = tid,
+        args = {
+          key : value for key, value in record.items( )
+          if key not in ( 'name', 'start', 'wall' ) } )
+      for record in self.stages ]
+
+    with open( trace_file, 'w' ) as f:
+      json.dump( dict( traceEvents = events ), f )
+
+    return stats_file, trace_file
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
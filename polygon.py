@@ -3,21 +3,47 @@
 #++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
 
 import os
+import json
+import math
+import argparse
+from functools import lru_cache, partial
+from contextlib import nullcontext
+from concurrent.futures import ProcessPoolExecutor
 
 import numpy as np
+import scipy.fft
 
 import matplotlib.pyplot as plt
 
-from PIL import Image, ImageDraw
-
 import imageio
 
-from skimage.morphology import binary_dilation
+from instrument import StageLog, profilers
 
 #++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
 
-fft_dir = 'polygons_2048/polygons_fft'
-polygon_dir = 'polygons_2048/polygons'
+# output directory, formatted with the mask size N, and its subdirectories
+output_dir = 'polygons_{N}'
+polygon_subdir = 'polygons'
+fft_subdir = 'polygons_fft'
+
+# names of the memory-mapped arrays of a sweep, and of their metadata sidecar
+masks_file = 'masks.npy'
+spectra_file = 'spectra.npy'
+done_file = 'done.npy'
+metadata_file = 'metadata.json'
+
+# last 12 bytes of every complete PNG file: the empty IEND chunk
+png_trailer = b'\x00\x00\x00\x00IEND\xaeB`\x82'
+
+# number of masks transformed together
+batch_size = 16
+
+# width of polygon outlines in pixels, and whether they are anti-aliased
+stroke_width = 5
+antialias = False
+
+# number of threads used by the FFTs, -1 for one per CPU
+fft_workers = -1
 
 #++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
 
@@ -34,7 +60,7 @@ def polygon_vertices(N, n):
   v[:, 1] = c0 + r * np.cos(2 * np.pi * x / float(n))
   v[:, 0] = c1 + r * np.sin(2 * np.pi * x / float(n))
 
-  return np.array(v, dtype = np.int)
+  return np.array(v, dtype = int)
 
 #++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
 
@@ -52,45 +78,576 @@ def scale_values_unity( array ):
 
 #++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
 
+@lru_cache( maxsize = None )
+def spectrum_plan( N, M ):
+
+  """Return the gather indices turning a real FFT into a shifted spectrum.
+
+  The real FFT of an (N, M) array only holds the M // 2 + 1 non-negative
+  frequencies of its last axis; the others follow from the Hermitian symmetry
+  |F[k1, k2]| = |F[-k1, -k2]|. For every element of the full, fftshifted
+  (N, M) spectrum, the returned array holds the flat index of the element of
+  the real FFT with the same magnitude.
+  """
+
+  half = M // 2 + 1
+
+  # frequencies of the full spectrum at each fftshifted position
+  rows = ( np.arange( N ) - N // 2 ) % N
+  cols = ( np.arange( M ) - M // 2 ) % M
+
+  rows, cols = np.meshgrid( rows, cols, indexing = 'ij' )
+
+  # mirror the frequencies missing from the real FFT
+  mirror = cols >= half
+  rows = np.where( mirror, ( -rows ) % N, rows )
+  cols = np.where( mirror, M - cols, cols )
+
+  return ( rows * half + cols ).ravel( )
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+def log_spectra( masks, out = None, workers = fft_workers ):
+
+  """Return the log of the normalized magnitude spectra of a batch of masks.
+
+  Equivalent to applying `np.fft.fftshift(np.abs(np.fft.fft2(mask)))`,
+  `scale_values_unity` and `np.log(fft + 1e-8)` to each mask, but computed
+  in float32 with a multi-threaded real FFT over the whole batch, and
+  normalized in place.
+
+  Parameters
+  ----------
+  masks : np.ndarray
+    (batch, N, M) array of masks.
+  out : np.ndarray or None
+    (batch, N, M) float32 array the spectra are written to. If None, a new
+    array is allocated.
+  workers : int
+    Number of threads used by the FFT, -1 for one per CPU.
+
+  Returns
+  -------
+  out : np.ndarray
+    (batch, N, M) float32 array of log spectra.
+
+  """
+
+  masks = np.asarray( masks, dtype = np.float32 )
+  batch, N, M = masks.shape
+
+  if out is None:
+    out = np.empty( ( batch, N, M ), dtype = np.float32 )
+
+  mag = np.abs( scipy.fft.rfft2( masks, workers = workers ) )
+
+  # expand the real FFT into the full, fftshifted spectrum in a single gather
+  np.take(
+    mag.reshape( batch, -1 ),
+    spectrum_plan( N, M ),
+    axis = 1,
+    out = out.reshape( batch, -1 ) )
+
+  # scale each spectrum to [0, 1], then take the log
+  min_vals = out.min( axis = ( 1, 2 ), keepdims = True )
+  max_vals = out.max( axis = ( 1, 2 ), keepdims = True )
+  out -= min_vals
+  out /= ( max_vals - min_vals )
+  out += 1e-8
+  np.log( out, out = out )
+
+  return out
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+# default size of masks, range of the number of sides n and number of samples
 N = 512
+n_range = (3, 8)
+n_samples = 501
 
 #++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
 
-if __name__ == '__main__':
+def n_digits( ns ):
+
+  """Return the number of decimals needed to tell sampled n values apart.
+  """
 
-  os.makedirs( polygon_dir, exist_ok = True )
-  os.makedirs( fft_dir, exist_ok = True )
+  if len( ns ) < 2:
+    return 2
 
+  step = np.min( np.diff( np.sort( ns ) ) )
+  if step <= 0:
+    raise ValueError( 'n values must be distinct' )
 
-  ns = np.linspace(3, 8, 501)
-  selem = np.ones((5, 5))
+  return max( 2, int( math.ceil( -math.log10( step ) - 1e-9 ) ) )
 
-  for i, n in enumerate(ns):
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
 
-    p = polygon_vertices( N = N, n = n )
-    pl = [tuple(i) for i in p]
+def output_files( out_dir, n, digits ):
 
-    im = Image.new('L', (N, N), 0)
-    ImageDraw.Draw(im).polygon(pl, outline = 1, fill = 0)
-    mask = np.array(im)
+  """Return the names of the mask and spectrum PNGs of a given n.
+  """
 
-    mask = binary_dilation(image = mask, selem = selem)
+  return (
+    os.path.join( out_dir, polygon_subdir, f'n={n:.{digits}f}.png' ),
+    os.path.join( out_dir, fft_subdir, f'fft_n={n:.{digits}f}.png' ) )
 
-    imageio.imwrite(
-      os.path.join(
-        polygon_dir,
-        f'n={n:.2f}.png'),
-      mask.astype(np.float))
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
 
-    fft = np.fft.fftshift(np.abs(np.fft.fft2(mask)))
-    fft = scale_values_unity(fft)
+def is_complete_png( filename ):
+
+  """Return whether a file exists and is a PNG that was completely written.
+  """
+
+  try:
+    with open( filename, 'rb' ) as f:
+      if f.read( 8 ) != b'\x89PNG\r\n\x1a\n':
+        return False
+      f.seek( -len( png_trailer ), os.SEEK_END )
+      return f.read( ) == png_trailer
+  except OSError:
+    return False
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+def write_png( filename, image ):
+
+  """Write a PNG through a temporary file, so it is either complete or absent.
+
+  Float images are scaled from their range of values to 8 bits, as older
+  versions of imageio did implicitly.
+  """
+
+  if image.dtype.kind == 'f':
+    image = scale_values_unity( image.astype( np.float64 ) )
+    image = np.round( image * 255 ).astype( np.uint8 )
+
+  tmp_filename = f'{filename}.tmp'
+  imageio.imwrite( tmp_filename, image, format = 'PNG' )
+  os.replace( tmp_filename, filename )
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+def rasterize_outline( vertices, N, width = stroke_width, antialias = antialias,
+  out = None ):
+
+  """Rasterize the thick outline of a closed polygon.
+
+  A pixel is part of the outline if its center lies within `width / 2` of an
+  edge. Distances are only evaluated in the bounding box of each edge, so the
+  cost scales with the length of the outline rather than the size of the mask.
+
+  Parameters
+  ----------
+  vertices : np.ndarray
+    (n, 2) array of the (x, y) coordinates of the vertices, in pixels.
+  N : int
+    Size of the mask.
+  width : float
+    Width of the outline, in pixels.
+  antialias : bool
+    If True, pixels at the border of the outline are given a partial coverage
+    between 0 and 1, rather than being either in or out.
+  out : np.ndarray or None
+    (N, N) array the mask is written to, e.g. a slice of a preallocated batch.
+    If None, a new float32 array is allocated.
+
+  Returns
+  -------
+  out : np.ndarray
+    (N, N) mask of the outline.
+
+  """
+
+  if out is None:
+    out = np.empty( ( N, N ), dtype = np.float32 )
+  out[...] = 0
+
+  vertices = np.asarray( vertices, dtype = np.float64 )
+  half = width / 2.
+
+  # pixels further than this from an edge are never covered
+  margin = int( np.ceil( half + 1 ) )
+
+  for ( x0, y0 ), ( x1, y1 ) in zip( vertices, np.roll( vertices, -1, axis = 0 ) ):
+
+    # bounding box of the edge, grown by the margin and clipped to the mask
+    r_lo = max( int( np.floor( min( y0, y1 ) ) ) - margin, 0 )
+    r_hi = min( int( np.ceil( max( y0, y1 ) ) ) + margin + 1, N )
+    c_lo = max( int( np.floor( min( x0, x1 ) ) ) - margin, 0 )
+    c_hi = min( int( np.ceil( max( x0, x1 ) ) ) + margin + 1, N )
+    if r_lo >= r_hi or c_lo >= c_hi:
+      continue
+
+    rows = np.arange( r_lo, r_hi, dtype = np.float64 )[:, None]
+    cols = np.arange( c_lo, c_hi, dtype = np.float64 )[None, :]
+
+    # distance from each pixel to the closest point of the edge
+    dx, dy = x1 - x0, y1 - y0
+    length2 = dx * dx + dy * dy
+    if length2 > 0:
+      t = np.clip( ( ( cols - x0 ) * dx + ( rows - y0 ) * dy ) / length2, 0, 1 )
+    else:
+      t = 0.
+    dist = np.hypot( cols - ( x0 + t * dx ), rows - ( y0 + t * dy ) )
+
+    if antialias:
+      coverage = np.clip( half + 0.5 - dist, 0, 1 )
+    else:
+      coverage = dist <= half
+
+    window = out[r_lo:r_hi, c_lo:c_hi]
+    np.maximum( window, coverage, out = window )
+
+  return out
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+def polygon_mask( N, n, width = stroke_width, antialias = antialias,
+  out = None ):
+
+  """Return the mask of the thick outline of a polygon with n sides.
+
+  See `rasterize_outline` for the parameters.
+  """
+
+  return rasterize_outline(
+    polygon_vertices( N = N, n = n ),
+    N,
+    width = width,
+    antialias = antialias,
+    out = out )
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+class SweepStore:
+
+  """Masks and log spectra of a sweep, in memory-mapped arrays indexed by n.
+
+  The sweep is stored in `out_dir` as three .npy files: 'masks.npy' and
+  'spectra.npy', of shape (len(ns), N, N), and 'done.npy', flagging the n
+  values that were computed, along with a 'metadata.json' sidecar holding the
+  parameters of the sweep. Arrays are memory-mapped, so slicing a subset of
+  the sweep only reads that subset from disk.
+
+  Parameters
+  ----------
+  out_dir : str
+    Directory of the sweep.
+  mode : str
+    'r' to open the arrays read-only, 'r+' to also write to them.
+
+  """
 
-    lfft = np.log( fft + 1e-8)
+  def __init__( self, out_dir, mode = 'r' ):
 
-    imageio.imwrite(
-      os.path.join(
-        fft_dir,
-        f'fft_n={n:.2f}.png'),
-      lfft)
+    self.out_dir = out_dir
 
-#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
\ No newline at end of file
+    with open( os.path.join( out_dir, metadata_file ) ) as f:
+      self.metadata = json.load( f )
+
+    self.ns = np.asarray( self.metadata['ns'] )
+    self.N = self.metadata['N']
+
+    self.masks = np.load( os.path.join( out_dir, masks_file ), mmap_mode = mode )
+    self.spectra = np.load(
+      os.path.join( out_dir, spectra_file ),
+      mmap_mode = mode )
+    self.done = np.load( os.path.join( out_dir, done_file ), mmap_mode = mode )
+
+  @classmethod
+  def create( cls, out_dir, ns, N, width = stroke_width, antialias = antialias ):
+
+    """Open the store of a sweep, preallocating it if it doesn't exist yet.
+
+    Raises
+    ------
+    ValueError
+      If `out_dir` already holds a sweep with different parameters.
+
+    """
+
+    metadata = dict(
+      N = int( N ),
+      ns = [ float( n ) for n in ns ],
+      digits = n_digits( ns ),
+      width = float( width ),
+      antialias = bool( antialias ),
+      mask_dtype = 'float32' if antialias else 'uint8',
+      spectrum_dtype = 'float32' )
+
+    path = os.path.join( out_dir, metadata_file )
+
+    if os.path.exists( path ):
+      with open( path ) as f:
+        if json.load( f ) != metadata:
+          raise ValueError(
+            f'{out_dir} holds a sweep with different parameters' )
+      return cls( out_dir, mode = 'r+' )
+
+    os.makedirs( out_dir, exist_ok = True )
+
+    shape = ( len( ns ), N, N )
+    for filename, dtype in [
+      ( masks_file, metadata['mask_dtype'] ),
+      ( spectra_file, metadata['spectrum_dtype'] ),
+      ( done_file, 'bool' ) ]:
+      np.lib.format.open_memmap(
+        os.path.join( out_dir, filename ),
+        mode = 'w+',
+        dtype = dtype,
+        shape = shape if filename != done_file else shape[:1] ).flush( )
+
+    # the sidecar is written last, so its presence means the arrays exist
+    with open( path, 'w' ) as f:
+      json.dump( metadata, f, indent = 2 )
+
+    return cls( out_dir, mode = 'r+' )
+
+  def __len__( self ):
+    return len( self.ns )
+
+  def index( self, n ):
+
+    """Return the index of the sampled n value closest to n.
+    """
+
+    return int( np.argmin( np.abs( self.ns - n ) ) )
+
+  def select( self, n_min = None, n_max = None ):
+
+    """Select the part of the sweep with n in [n_min, n_max].
+
+    Returns
+    -------
+    ns : np.ndarray
+      Selected n values.
+    masks, spectra : np.ndarray
+      Memory-mapped views of the masks and log spectra of the selected n
+      values; nothing is read from disk until they are accessed.
+
+    """
+
+    lo = 0 if n_min is None else np.searchsorted( self.ns, n_min, 'left' )
+    hi = len( self ) if n_max is None else np.searchsorted( self.ns, n_max, 'right' )
+
+    return self.ns[lo:hi], self.masks[lo:hi], self.spectra[lo:hi]
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+def render_batch( indices, out_dir, workers = 1 ):
+
+  """Compute the masks and log spectra of a batch of n values of a sweep.
+
+  Parameters
+  ----------
+  indices : sequence of int
+    Indices of the n values in the store of the sweep.
+  out_dir : str
+    Directory of the sweep, see `SweepStore`.
+  workers : int
+    Number of threads used by the FFT.
+
+  Returns
+  -------
+  count : int
+    Number of n values processed.
+
+  """
+
+  store = SweepStore( out_dir, mode = 'r+' )
+  meta = store.metadata
+
+  masks = np.empty((len(indices), store.N, store.N), dtype = np.float32)
+
+  for i, index in enumerate(indices):
+    polygon_mask(
+      store.N,
+      store.ns[index],
+      width = meta['width'],
+      antialias = meta['antialias'],
+      out = masks[i] )
+
+  store.masks[indices] = masks
+
+  # transform the whole batch at once, in place
+  store.spectra[indices] = log_spectra( masks, out = masks, workers = workers )
+
+  store.masks.flush( )
+  store.spectra.flush( )
+
+  # only flag the batch as done once its arrays are on disk
+  store.done[indices] = True
+  store.done.flush( )
+
+  return len(indices)
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+def export_pngs( out_dir ):
+
+  """Export the masks and log spectra of a sweep as PNGs.
+
+  PNGs are a derived, 8-bit view of the store; those already complete are not
+  written again.
+
+  Parameters
+  ----------
+  out_dir : str
+    Directory of the sweep, see `SweepStore`.
+
+  """
+
+  store = SweepStore( out_dir )
+  digits = store.metadata['digits']
+
+  os.makedirs( os.path.join( out_dir, polygon_subdir ), exist_ok = True )
+  os.makedirs( os.path.join( out_dir, fft_subdir ), exist_ok = True )
+
+  for index in np.flatnonzero( store.done ):
+
+    mask_png, fft_png = output_files( out_dir, store.ns[index], digits )
+
+    if not is_complete_png( mask_png ):
+      write_png( mask_png, np.asarray( store.masks[index], dtype = np.float32 ) )
+
+    if not is_complete_png( fft_png ):
+      write_png( fft_png, np.asarray( store.spectra[index] ) )
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+def sweep(
+  ns,
+  N = N,
+  out_dir = None,
+  processes = None,
+  batch_size = batch_size,
+  width = stroke_width,
+  antialias = antialias,
+  png = False,
+  log = None ):
+
+  """Compute masks and log spectra over a range of n, in a process pool.
+
+  Results are written to a memory-mapped `SweepStore`. Values of n already
+  computed by an earlier run are skipped, so an interrupted sweep can be
+  restarted cheaply.
+
+  Parameters
+  ----------
+  ns : array_like
+    Numbers of sides of the polygons, in increasing order.
+  N : int
+    Size of the masks.
+  out_dir : str or None
+    Output directory. If None, `output_dir` formatted with N.
+  processes : int or None
+    Number of worker processes, None for one per CPU.
+  batch_size : int
+    Number of n values each worker transforms together.
+  width : float
+    Width of the polygon outlines, in pixels.
+  antialias : bool
+    Whether the polygon outlines are anti-aliased.
+  png : bool
+    If True, also export the results as PNGs.
+  log : StageLog or None
+    If given, records the time and memory used by each stage of the sweep.
+
+  """
+
+  def stage( name, rows_in = None ):
+    if log is None:
+      return nullcontext( dict( ) )
+    return log.stage( name, rows_in = rows_in )
+
+  if out_dir is None:
+    out_dir = output_dir.format( N = N )
+
+  ns = np.asarray( ns, dtype = np.float64 )
+
+  with stage( '1 open store', rows_in = len( ns ) ) as record:
+
+    store = SweepStore.create( out_dir, ns, N, width, antialias )
+
+    todo = np.flatnonzero( ~store.done )
+    del store
+
+    record['rows_out'] = len( todo )
+
+  print( f'{len(ns) - len(todo)} of {len(ns)} n values already done' )
+
+  batches = [
+    todo[start:start + batch_size]
+    for start in range( 0, len( todo ), batch_size ) ]
+
+  # each process runs single-threaded FFTs, the pool provides the parallelism
+  with stage( '2 masks and spectra', rows_in = len( todo ) ), \
+    ProcessPoolExecutor( max_workers = processes ) as executor:
+
+    done = len(ns) - len(todo)
+    for count in executor.map(
+      partial( render_batch, out_dir = out_dir ),
+      batches ):
+
+      done += count
+      print( f'{done} of {len(ns)} n values done' )
+
+  if png:
+    with stage( '3 export PNGs', rows_in = len( ns ) ):
+      export_pngs( out_dir )
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+if __name__ == '__main__':
+
+  parser = argparse.ArgumentParser(
+    description = 'Compute masks of polygons with a non-integer number of '
+      'sides n, and their log spectra, over a range of n.' )
+  parser.add_argument( '--N', type = int, default = N,
+    help = 'size of the masks in pixels' )
+  parser.add_argument( '--n-min', type = float, default = n_range[0],
+    help = 'smallest n' )
+  parser.add_argument( '--n-max', type = float, default = n_range[1],
+    help = 'largest n' )
+  parser.add_argument( '--samples', type = int, default = n_samples,
+    help = 'number of n values' )
+  parser.add_argument( '--out-dir', default = None,
+    help = f'output directory, by default {output_dir!r} with N filled in' )
+  parser.add_argument( '--processes', type = int, default = None,
+    help = 'number of worker processes, by default one per CPU' )
+  parser.add_argument( '--batch-size', type = int, default = batch_size,
+    help = 'number of n values transformed together' )
+  parser.add_argument( '--stroke-width', type = float, default = stroke_width,
+    help = 'width of the polygon outlines in pixels' )
+  parser.add_argument( '--antialias', action = 'store_true', default = antialias,
+    help = 'anti-alias the polygon outlines' )
+  parser.add_argument( '--png', action = 'store_true',
+    help = 'also export masks and log spectra as 8-bit PNGs' )
+  parser.add_argument( '--profile', choices = profilers, default = None,
+    help = 'profile each stage of the sweep' )
+  parser.add_argument( '--trace-memory', action = 'store_true',
+    help = 'trace Python allocations of each stage, which slows them down' )
+  args = parser.parse_args( )
+
+  # record the time and memory used by each stage
+  log = StageLog(
+    'polygon',
+    trace_memory = args.trace_memory,
+    profiler = args.profile )
+
+  sweep(
+    np.linspace( args.n_min, args.n_max, args.samples ),
+    N = args.N,
+    out_dir = args.out_dir,
+    processes = args.processes,
+    batch_size = args.batch_size,
+    width = args.stroke_width,
+    antialias = args.antialias,
+    png = args.png,
+    log = log )
+
+  log.save( )
+  print( log.report( ) )
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
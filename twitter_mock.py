@@ -0,0 +1,683 @@
+# -*- coding: UTF-8 -*-
+
+"""Local stand-in for the Twitter search API and media server, to load test
+`download_twitter_videos.py` offline.
+
+`MockTwitter` serves paginated search results of synthetic tweets with video
+variants, as the v1.1 search endpoint does, and the synthetic videos they link
+to, with configurable latency, bandwidth, server errors, dropped connections
+and rate limits. `MockAPI` searches it in place of `tweepy.API`, and
+`run_crawl` measures the throughput of a crawl against it.
+"""
+
+#+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+import os
+import re
+import json
+import time
+import random
+import argparse
+import tempfile
+import threading
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+
+import requests
+
+#+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+# path of the search endpoint
+search_path = '/1.1/search/tweets.json'
+
+# bitrates of the MP4 variants of each video; the largest is the full video
+bitrates = ( 256000, 832000, 2176000 )
+
+# size of the blocks videos are sent in, and throttled by
+block_size = 1 << 16
+
+# date of the newest synthetic tweet
+newest_date = datetime( 2019, 11, 1, tzinfo = timezone.utc )
+
+#+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+class MockRateLimitError( Exception ):
+
+  """HTTP 429 response of the mock search endpoint.
+
+  Parameters
+  ----------
+  response : requests.Response
+    The response, with its rate-limit headers.
+
+  """
+
+  def __init__( self, response ):
+
+    super( ).__init__( 'Rate limit exceeded' )
+    self.response = response
+
+#+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+class _Handler( BaseHTTPRequestHandler ):
+
+  """Serve search results and videos of the `MockTwitter` of the server.
+  """
+
+  protocol_version = 'HTTP/1.1'
+
+  def log_message( self, *args ):
+    pass
+
+  def _send( self, status, body = b'', headers = None ):
+
+    self.send_response( status )
+    for key, value in ( headers or dict( ) ).items( ):
+      self.send_header( key, str( value ) )
+    self.send_header( 'Content-Length', str( len( body ) ) )
+    self.end_headers( )
+    self.wfile.write( body )
+
+  def do_GET( self ):
+
+    mock = self.server.mock
+    url = urlsplit( self.path )
+
+    if mock.latency:
+      time.sleep( mock.latency )
+
+    if url.path == search_path:
+      self._search( mock, parse_qs( url.query ) )
+    else:
+      self._video( mock, url.path )
+
+  def do_HEAD( self ):
+
+    mock = self.server.mock
+    url = urlsplit( self.path )
+
+    if mock.latency:
+      time.sleep( mock.latency )
+
+    if url.path == search_path:
+      self.send_response( 405 )
+      self.send_header( 'Content-Length', '0' )
+      self.end_headers( )
+    else:
+      self._video( mock, url.path, head = True )
+
+  def _search( self, mock, params ):
+
+    headers, allowed = mock._take_search( )
+
+    if not allowed:
+      body = json.dumps( dict( errors = [
+        dict( code = 88, message = 'Rate limit exceeded' ) ] ) )
+      self._send( 429, body.encode( ), headers )
+      return
+
+    statuses = mock.search(
+      params.get( 'q', [ '' ] )[0],
+      since_id = int( params.get( 'since_id', [ 0 ] )[0] ),
+      max_id = int( params['max_id'][0] ) if 'max_id' in params else None,
+      count = int( params.get( 'count', [ 15 ] )[0] ) )
+
+    body = json.dumps( dict( statuses = statuses, search_metadata = dict( ) ) )
+    headers['Content-Type'] = 'application/json'
+    self._send( 200, body.encode( ), headers )
+
+  def _video( self, mock, path, head = False ):
+
+    match = re.match( r'/ext_tw_video/(\d+)/', path )
+    if match is None or int( match[1] ) not in mock.media:
+      self._send( 404 )
+      return
+
+    media_id = int( match[1] )
+
+    if mock._roll( 'error_rate' ):
+      mock._count( 'errors' )
+      self._send( 503 )
+      return
+
+    blob = mock.blob( media_id )
+    start, stop = 0, len( blob ) - 1
+    status = 200
+    headers = { 'Accept-Ranges' : 'bytes', 'Content-Type' : 'video/mp4' }
+
+    # the size of the video, as probed before downloading it
+    if head:
+      mock._count( 'head_requests' )
+      self.send_response( status )
+      for key, value in headers.items( ):
+        self.send_header( key, value )
+      self.send_header( 'Content-Length', str( len( blob ) ) )
+      self.end_headers( )
+      return
+
+    content_range = self.headers.get( 'Range' )
+    if content_range is not None:
+
+      mock._count( 'range_requests' )
+
+      first, _, last = content_range.split( '=', 1 )[1].partition( '-' )
+      start = int( first )
+      stop = min( int( last ), stop ) if last else stop
+
+      # a range continuing a response that was cut off resumes it; other
+      # ranges are those of a download in parallel byte ranges
+      if start > 0:
+        resumed = mock._resume( media_id, start )
+        mock._count( 'resumes' if resumed else 'parallel_ranges' )
+
+      if start >= len( blob ):
+        headers['Content-Range'] = f'bytes */{len( blob )}'
+        self._send( 416, b'', headers )
+        return
+
+      status = 206
+      headers['Content-Range'] = f'bytes {start}-{stop}/{len( blob )}'
+
+    mock._count( 'video_requests' )
+
+    body = memoryview( blob )[start:stop + 1]
+
+    # a dropped connection sends half of the video, then closes; a body of a
+    # single block has nothing to cut short
+    drop = len( body ) > block_size and mock._roll( 'drop_rate' )
+    if drop:
+      mock._count( 'drops' )
+
+    self.send_response( status )
+    for key, value in headers.items( ):
+      self.send_header( key, value )
+    self.send_header( 'Content-Length', str( len( body ) ) )
+    self.end_headers( )
+
+    sent = 0
+    try:
+      for offset in range( 0, len( body ), block_size ):
+
+        if drop and offset >= len( body ) // 2:
+          self.close_connection = True
+          break
+
+        block = body[offset:offset + block_size]
+        self.wfile.write( block )
+        sent += len( block )
+
+        if mock.bandwidth:
+          time.sleep( len( block ) / mock.bandwidth )
+
+    # the client gave up on the video, e.g. after a failed checksum
+    except ( BrokenPipeError, ConnectionResetError ):
+      self.close_connection = True
+
+    mock._count( 'bytes_sent', sent )
+
+    if drop:
+      mock._cut( media_id, start, start + sent )
+
+#+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+class MockTwitter:
+
+  """Local HTTP server of synthetic tweets with videos.
+
+  Tweets are tagged with one of the queries, newest first. A share of them
+  have a video; some of those are retweets of an earlier video, with the same
+  media ID and URLs, and some are re-uploads, with a new media ID and URLs but
+  the same content.
+
+  Parameters
+  ----------
+  queries : sequence of str
+    Hashtags the tweets are tagged with.
+  n_tweets : int
+    Number of tweets.
+  video_share, retweet_share, reupload_share : float
+    Share of tweets with a video, and share of those that are retweets or
+    re-uploads of an earlier video.
+  video_size : int
+    Mean size of the videos, in bytes; sizes vary by up to half of it. The
+    default is several times `download_twitter_videos.chunk_size`, so that
+    dropped connections leave partial videos to resume.
+  latency : float
+    Seconds every response is delayed by.
+  bandwidth : float or None
+    Bytes per second each video is sent at. If None, unlimited.
+  error_rate : float
+    Share of video requests answered with HTTP 503.
+  drop_rate : float
+    Share of video requests whose connection is closed halfway through, among
+    those larger than one block.
+  rate_limit : int
+    Number of search requests allowed per window, after which HTTP 429 is
+    returned until the window resets.
+  rate_window : float
+    Length of the rate-limit window, in seconds.
+  seed : int
+    Seed of the synthetic tweets and videos.
+  host : str
+    Address the server listens on.
+  port : int
+    Port the server listens on; 0 picks a free one.
+
+  """
+
+  def __init__(
+    self,
+    queries = ( 'Iraq', ),
+    n_tweets = 1000,
+    video_share = 0.5,
+    retweet_share = 0.2,
+    reupload_share = 0.05,
+    video_size = 4 << 20,
+    latency = 0.,
+    bandwidth = None,
+    error_rate = 0.,
+    drop_rate = 0.,
+    rate_limit = 180,
+    rate_window = 900.,
+    seed = 0,
+    host = '127.0.0.1',
+    port = 0 ):
+
+    self.latency = latency
+    self.bandwidth = bandwidth
+    self.error_rate = error_rate
+    self.drop_rate = drop_rate
+    self.rate_limit = rate_limit
+    self.rate_window = rate_window
+
+    self.lock = threading.Lock( )
+    self.stats = Counter( )
+
+    # (first, last) byte offsets of the responses cut off by a dropped
+    # connection, by media ID, to tell resumes from parallel byte ranges
+    self.cuts = dict( )
+    self.rng = random.Random( seed )
+
+    self.server = ThreadingHTTPServer( ( host, port ), _Handler )
+    self.server.daemon_threads = True
+    self.server.mock = self
+    self.url = 'http://{}:{}'.format( *self.server.server_address[:2] )
+    self.thread = None
+
+    self.remaining = rate_limit
+    self.reset = time.time( ) + rate_window
+
+    rng = random.Random( seed )
+
+    # one random block, shared by all videos; the first bytes of each video
+    # are its content ID, so only re-uploads have the same content
+    self.block = rng.randbytes( int( 1.5 * video_size ) + 8 )
+
+    # media ID of each video, and its (content ID, size)
+    self.media = dict( )
+
+    self.statuses = list( )
+    first_id = 1_180_000_000_000_000_000
+
+    for i in range( n_tweets ):
+
+      tweet_id = first_id + n_tweets - i
+      query = queries[ i % len( queries ) ]
+      created_at = newest_date - timedelta( minutes = i )
+
+      status = dict(
+        id = tweet_id,
+        id_str = str( tweet_id ),
+        created_at = created_at.strftime( '%a %b %d %H:%M:%S +0000 %Y' ),
+        text = f'#{query} synthetic tweet {i}',
+        truncated = False )
+
+      if rng.random( ) < video_share:
+
+        media_id = first_id + 2 * n_tweets - i
+        content_id = media_id
+        size = rng.randint( video_size // 2, video_size + video_size // 2 )
+
+        if self.media and rng.random( ) < retweet_share:
+          media_id = rng.choice( list( self.media ) )
+        elif self.media and rng.random( ) < reupload_share:
+          content_id, size = self.media[ rng.choice( list( self.media ) ) ]
+
+        self.media.setdefault( media_id, ( content_id, size ) )
+        status['extended_entities'] = dict( media = [
+          self._media_entity( media_id ) ] )
+
+      self.statuses.append( status )
+
+  def _media_entity( self, media_id ):
+
+    """Return the 'extended_entities' media of a video, as Twitter does.
+    """
+
+    prefix = f'{self.url}/ext_tw_video/{media_id}/pu'
+    variants = [
+      dict(
+        bitrate = bitrate,
+        content_type = 'video/mp4',
+        url = f'{prefix}/vid/{bitrate // 1000}k/{media_id:x}.mp4?tag=12' )
+      for bitrate in bitrates ]
+    variants.append( dict(
+      content_type = 'application/x-mpegURL',
+      url = f'{prefix}/pl/{media_id:x}.m3u8?tag=12' ) )
+
+    return dict(
+      id = media_id,
+      id_str = str( media_id ),
+      type = 'video',
+      video_info = dict( variants = variants ) )
+
+  def blob( self, media_id ):
+
+    """Return the content of a video.
+    """
+
+    content_id, size = self.media[media_id]
+
+    return content_id.to_bytes( 8, 'little' ) + self.block[8:size]
+
+  def search( self, query, since_id = 0, max_id = None, count = 15 ):
+
+    """Return the statuses matching a query, newest first, as JSON objects.
+    """
+
+    return [
+      status for status in self.statuses
+      if query in status['text'] and
+        status['id'] > since_id and
+        ( max_id is None or status['id'] <= max_id ) ][:count]
+
+  def _take_search( self ):
+
+    """Take a search request from the quota.
+
+    Returns
+    -------
+    headers : dict
+      Rate-limit headers of the response.
+    allowed : bool
+      Whether the request is within the quota.
+
+    """
+
+    with self.lock:
+
+      now = time.time( )
+      if now >= self.reset:
+        self.remaining = self.rate_limit
+        self.reset = now + self.rate_window
+
+      allowed = self.remaining > 0
+      if allowed:
+        self.remaining -= 1
+        self.stats['searches'] += 1
+      else:
+        self.stats['rate_limited'] += 1
+
+      headers = {
+        'x-rate-limit-limit' : self.rate_limit,
+        'x-rate-limit-remaining' : self.remaining,
+        'x-rate-limit-reset' : int( self.reset ) }
+
+    return headers, allowed
+
+  def _roll( self, rate ):
+
+    with self.lock:
+      return self.rng.random( ) < getattr( self, rate )
+
+  def _count( self, key, n = 1 ):
+
+    with self.lock:
+      self.stats[key] += n
+
+  def _cut( self, media_id, first, last ):
+
+    with self.lock:
+      self.cuts.setdefault( media_id, [ ] ).append( ( first, last ) )
+
+  def _resume( self, media_id, start ):
+
+    """Return whether a range starting at a byte offset continues a response
+    cut off before, i.e. keeps some of its bytes, and forget that response.
+    """
+
+    with self.lock:
+      cuts = self.cuts.get( media_id, [ ] )
+      for cut in cuts:
+        if cut[0] < start <= cut[1]:
+          cuts.remove( cut )
+          return True
+
+    return False
+
+  def start( self ):
+
+    """Serve requests in a background thread.
+    """
+
+    self.thread = threading.Thread(
+      target = self.server.serve_forever,
+      daemon = True )
+    self.thread.start( )
+
+    return self
+
+  def stop( self ):
+
+    """Stop serving requests.
+    """
+
+    self.server.shutdown( )
+    self.server.server_close( )
+
+  def __enter__( self ):
+    return self.start( )
+
+  def __exit__( self, *args ):
+    self.stop( )
+
+#+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+class MockAPI:
+
+  """Search a `MockTwitter` server, in place of a `tweepy.API`.
+
+  Implements the subset of `tweepy.API` used by `download_twitter_videos.py`:
+  `search`, returning `tweepy.Status` objects, and `last_response`.
+
+  Parameters
+  ----------
+  url : str
+    Base URL of the server, `MockTwitter.url`.
+
+  """
+
+  def __init__( self, url ):
+
+    self.url = url
+    self.session = requests.Session( )
+    self.last_response = None
+
+  def search( self, q, since_id = None, max_id = None, count = 15, **kwargs ):
+
+    """Return a page of tweets matching a query.
+
+    Raises
+    ------
+    MockRateLimitError
+      If the search quota ran out.
+
+    """
+
+    from tweepy.models import Status
+
+    params = dict( q = q, count = count )
+    if since_id is not None:
+      params['since_id'] = since_id
+    if max_id is not None:
+      params['max_id'] = max_id
+
+    r = self.session.get(
+      self.url + search_path,
+      params = params,
+      timeout = 60 )
+    self.last_response = r
+
+    if r.status_code == 429:
+      raise MockRateLimitError( r )
+    r.raise_for_status( )
+
+    return [ Status.parse( self, status ) for status in r.json( )['statuses'] ]
+
+#+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+def run_crawl( mock, out_dir, max_downloads = 8, passes = 5 ):
+
+  """Crawl all tweets of a mock server, and measure the throughput.
+
+  Videos that failed to download are retried by further crawls with the same
+  index, as when `download_twitter_videos.py` is restarted, which resumes
+  interrupted videos.
+
+  Parameters
+  ----------
+  mock : MockTwitter
+    Running server.
+  out_dir : str
+    Directory the videos, CSV files and index are written in.
+  max_downloads : int
+    Number of videos downloaded at the same time.
+  passes : int
+    Maximum number of crawls.
+
+  Returns
+  -------
+  result : dict
+    Number of 'videos' downloaded, of videos still 'pending', of 'passes',
+    'bytes' downloaded, 'wall' seconds, 'videos_per_s', 'mb_per_s' and
+    'peak_rss' in bytes, and the 'server' statistics of `mock`, among which
+    the number of 'drops', of 'resumes' continuing a dropped response, and
+    of 'parallel_ranges' of videos downloaded in byte ranges.
+
+  """
+
+  import contextlib
+  from instrument import StageLog
+  from download_twitter_videos import CrawlIndex, RateLimit, crawl
+
+  queries = sorted( {
+    status['text'].split( )[0][1:] for status in mock.statuses } )
+
+  api = MockAPI( mock.url )
+  index = CrawlIndex( os.path.join( out_dir, 'crawl.sqlite' ) )
+  log = StageLog( 'twitter_mock', trace_memory = False, out_dir = out_dir )
+
+  counts = Counter( )
+
+  with log.stage( 'crawl' ) as record, \
+    open( os.devnull, 'w' ) as devnull, \
+    contextlib.redirect_stdout( devnull ):
+
+    for n_passes in range( 1, passes + 1 ):
+
+      counts.update( crawl(
+        api,
+        queries,
+        index,
+        out_dir = out_dir,
+        rate_limit = RateLimit( mock.rate_limit, mock.rate_window ),
+        max_downloads = max_downloads,
+        count = 100 ) )
+
+      if not index.pending_videos( ):
+        break
+
+  pending = len( index.pending_videos( ) )
+  index.close( )
+  api.session.close( )
+
+  wall = record['wall']
+
+  return dict(
+    videos = counts['downloaded'],
+    pending = pending,
+    passes = n_passes,
+    bytes = counts['bytes'],
+    wall = wall,
+    videos_per_s = counts['downloaded'] / wall,
+    mb_per_s = counts['bytes'] / 2**20 / wall,
+    peak_rss = record['peak_rss'],
+    server = dict( mock.stats ) )
+
+#+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
+
+if __name__ == '__main__':
+
+  parser = argparse.ArgumentParser(
+    description = 'Load test the Twitter video downloader on a local mock.' )
+  parser.add_argument( '--tweets', type = int, default = 1000,
+    help = 'number of synthetic tweets' )
+  parser.add_argument( '--queries', nargs = '+', default = [ 'Iraq' ],
+    help = 'hashtags the tweets are tagged with' )
+  parser.add_argument( '--video-kb', type = int, default = 4096,
+    help = 'mean size of the videos, in KiB' )
+  parser.add_argument( '--latency', type = float, default = 0.02,
+    help = 'seconds every response is delayed by' )
+  parser.add_argument( '--bandwidth-mb', type = float, default = None,
+    help = 'MiB per second each video is sent at' )
+  parser.add_argument( '--error-rate', type = float, default = 0.,
+    help = 'share of video requests failing with HTTP 503' )
+  parser.add_argument( '--drop-rate', type = float, default = 0.,
+    help = 'share of video requests dropped halfway through' )
+  parser.add_argument( '--rate-limit', type = int, default = 180,
+    help = 'search requests allowed per rate-limit window' )
+  parser.add_argument( '--rate-window', type = float, default = 900.,
+    help = 'length of the rate-limit window, in seconds' )
+  parser.add_argument( '--max-downloads', type = int, nargs = '+',
+    default = [ 1, 4, 8, 16 ], help = 'numbers of concurrent downloads' )
+  args = parser.parse_args( )
+
+  print(
+    f'{"downloads":>9} {"videos":>7} {"pending":>7} {"passes":>6} '
+    f'{"wall s":>8} {"videos/s":>9} {"MB/s":>8} {"peak MB":>8} '
+    f'{"drops":>6} {"ranges":>6} {"resumes":>7}' )
+
+  for max_downloads in args.max_downloads:
+
+    # a new server for each run, so they download the same videos
+    with MockTwitter(
+      queries = args.queries,
+      n_tweets = args.tweets,
+      video_size = args.video_kb << 10,
+      latency = args.latency,
+      bandwidth = args.bandwidth_mb and args.bandwidth_mb * 2**20,
+      error_rate = args.error_rate,
+      drop_rate = args.drop_rate,
+      rate_limit = args.rate_limit,
+      rate_window = args.rate_window ) as mock, \
+      tempfile.TemporaryDirectory( ) as out_dir:
+
+      result = run_crawl( mock, out_dir, max_downloads )
+
+    print(
+      f'{max_downloads:9d} {result["videos"]:7d} {result["pending"]:7d} '
+      f'{result["passes"]:6d} {result["wall"]:8.2f} '
+      f'{result["videos_per_s"]:9.1f} {result["mb_per_s"]:8.1f} '
+      f'{( result["peak_rss"] or 0 ) / 2**20:8.0f} '
+      f'{result["server"].get( "drops", 0 ):6d} '
+      f'{result["server"].get( "range_requests", 0 ):6d} '
+      f'{result["server"].get( "resumes", 0 ):7d}' )
+
+    # dropped videos should be resumed rather than downloaded again
+    server = result['server']
+    if server.get( 'drops' ) and not server.get( 'resumes' ):
+      print( 'warning: connections were dropped, but no video was resumed' )
+
+#+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#